@@ -11,10 +11,16 @@ import time
 import glob
 import pprint
 
-from archivetools.backup_util import Util
+from archivetools.backup_util import Util, get_util, execute, executemany, update_summary, summary_class
 
 SECINWEEK = 60*60*24*7
 
+# the high water marks kept in BACKUP_WATERMARK of each scan, and the format of their values,
+# so that routine scans only look at the newest attempts and nites
+WATERMARKS = {'pipeline': '%Y-%m-%d %H:%M:%S',
+              'raw': '%Y%m%d',
+              'snmanifest': '%Y%m%d'}
+
 
 def parse_options():
     """ Parse any command line options
@@ -26,12 +32,76 @@ def parse_options():
     parser = argparse.ArgumentParser(description='Stage data to be archived to tape')
     parser.add_argument('--debug', default=False, action='store_true',
                         help='Toggle DEBUG mode',)
-    parser.add_argument('--des_services', action='store', help='DESDM Database Access File: %default',)
+    parser.add_argument('--des_services', action='store', help='DESDM Database Access File, or sqlite:<file> to use a local database: %default',)
     parser.add_argument('--verbose', '-v', default=False, action='store_true',
                         help='Turn on verbose mode. Default: %default',)
     parser.add_argument('--section', action='store', help='Database to use',)
+    parser.add_argument('--full', default=False, action='store_true',
+                        help='Scan the whole history rather than only what is newer than the last scan, to pick up anything missed, e.g. attempts whose state has changed since they were scanned',)
+    parser.add_argument('--overlap', default=7, type=int, action='store',
+                        help='Number of days before the last scan to start scanning from, to pick up late arrivals. Default: %(default)s',)
     return vars(parser.parse_args())
 
+def get_watermarks(cur):
+    """ Method to get the high water marks of the previous scans
+
+        Parameters
+        ----------
+        cur : cursor object
+
+        Returns
+        -------
+        dict of the marks, keyed by the names in WATERMARKS, None if there has not been a scan
+    """
+    marks = dict.fromkeys(WATERMARKS)
+    execute(cur, "select name,value from prod.backup_watermark")
+    for name, value in cur.fetchall() or []:
+        if name in marks:
+            marks[name] = value
+    return marks
+
+def scan_start(name, mark, overlap):
+    """ Method to get where a scan starts from, which is a number of days before its high water
+        mark, to pick up attempts and nites which are added late
+
+        Parameters
+        ----------
+        name : str
+            The name of the scan, a key of WATERMARKS
+        mark : str
+            The high water mark, None to scan everything
+        overlap : int
+            The number of days before the mark to start from
+
+        Returns
+        -------
+        str in the same format as the mark, or None to scan everything
+    """
+    if mark is None:
+        return None
+    fmt = WATERMARKS[name]
+    return (datetime.datetime.strptime(mark, fmt) - datetime.timedelta(days=overlap)).strftime(fmt)
+
+def set_watermarks(cur, marks, found):
+    """ Method to store the high water marks of this scan, in the same transaction as the
+        directories found. A mark is never moved backwards.
+
+        Parameters
+        ----------
+        cur : cursor object
+        marks : dict
+            The marks of the previous scans, from get_watermarks
+        found : dict
+            The newest value seen by each scan in this run, None if it found nothing
+    """
+    rows = []
+    for name in sorted(found):
+        value = max([val for val in (marks.get(name), found[name]) if val is not None] or [None])
+        if value is not None and value != marks.get(name):
+            rows.append((name, value, name, value))
+    executemany(cur, "merge into prod.backup_watermark bw using dual on (bw.name=:1) when matched then update set bw.value=:2,bw.last_date=SYSTIMESTAMP "
+                "when not matched then insert (name,value,last_date) values (:3,:4,SYSTIMESTAMP)", rows)
+
 def junk_runs(util):
     """ Method to remove any directories that have been marked as JUNK from the available backups list
 
@@ -43,28 +113,44 @@ def junk_runs(util):
     #con = util.get_connect(options.desdm, options.db)
     cur = util.cursor()
 
-    cur.execute("select archive_path from prod.pfw_attempt where data_state='JUNK' and archive_path in (select path from prod.backup_dir where status=0)")
+    execute(cur, "select path,class from prod.backup_dir where status=0 and path in (select archive_path from prod.pfw_attempt where data_state='JUNK')")
     dirs = cur.fetchall()
     util.log(Util.info, "  Dropping %i junked runs." % (len(dirs)))
-    cur.prepare("delete from prod.backup_dir where path=:1")
-    cur.executemany(None, dirs)
+    executemany(cur, "delete from prod.backup_dir where path=:1", [ddir[:1] for ddir in dirs])
+    update_summary(cur, [('DIR', summary_class(ddir[0], ddir[1]), 0, -1, 0) for ddir in dirs])
     util.commit()
 
-def add_dirs(cur, util, dirlist):
+def add_dirs(cur, util, dirlist, since=None):
     """ Method to get any new pipeline directories
 
         Parameters
         ----------
         cur : cursor object
         util : Util object
+        dirlist : list
+            list of directories to add
+        since : str
+            Only look at attempts which ended after this time, YYYY-MM-DD HH24:MI:SS (default is
+            None, look at all attempts)
+
+        Returns
+        -------
+        str, the latest end time of the attempts found, None if there were none
     """
-    cur.execute("select a.archive_path,a.data_state,c.end_time,b.pipeline,b.campaign,c.status,a.id from prod.pfw_attempt a inner join prod.pfw_request b on a.reqnum = b.reqnum inner join prod.task c on a.task_id = c.id where c.end_time is not null and a.data_state <> 'JUNK' and a.archive_path like '%OPS%' and a.archive_path not like '%/hostname/%' and archive_path not in (select path from prod.backup_dir)")
+    sql = "select a.archive_path,a.data_state,c.end_time,b.pipeline,b.campaign,c.status,a.id from prod.pfw_attempt a inner join prod.pfw_request b on a.reqnum = b.reqnum inner join prod.task c on a.task_id = c.id where c.end_time is not null and a.data_state <> 'JUNK' and a.archive_path like '%OPS%' and a.archive_path not like '%/hostname/%' and archive_path not in (select path from prod.backup_dir)"
+    if since is None:
+        execute(cur, sql)
+    else:
+        execute(cur, sql + " and c.end_time > TO_DATE(:1, 'YYYY-MM-DD HH24:MI:SS')", [since])
 
-    dirl = cur.fetchall()
+    dirl = cur.fetchall() or []
     util.log(Util.info, "  Found %i pipeline files to process." % (len(dirl)))
+    last = None
     # archive_path, data_state, state_change_date, pipeline, campaign, status, pfwid
     #     0              1              2              3        4        5      6
     for adir in dirl:
+        if adir[2] is not None and (last is None or adir[2] > last):
+            last = adir[2]
         if adir[4] is None:
             continue
         path = adir[0]
@@ -94,8 +180,11 @@ def add_dirs(cur, util, dirlist):
             priority = 10
         dirlist.append((path, pipeline, dtm.strftime('%Y-%m-%d %H:%M:%S'), priority, pfwid))
     util.log(Util.info, "  Added %i pipeline files." % (len(dirlist)))
+    if last is None:
+        return None
+    return last.strftime(WATERMARKS['pipeline'])
 
-def get_all_raw(cur, sql, ftype, dirlist):
+def get_all_raw(cur, sql, ftype, dirlist, since=None):
     """ Method to get raw/snmanifest directories
 
         Parameters
@@ -107,22 +196,36 @@ def get_all_raw(cur, sql, ftype, dirlist):
             the file type
         dirlist : list
             List of the directories
+        since : str
+            Only look at nites from this one on, YYYYMMDD, the statement is given it as :1
+            (default is None, look at all nites)
+
+        Returns
+        -------
+        Tuple of the number of directories added, and the latest nite found (None if there
+        were none)
     """
     count = 0
-    cur.execute(sql)
+    last = None
+    if since is None:
+        execute(cur, sql)
+    else:
+        execute(cur, sql + " and nite >= :1", [since])
 
-    nites = cur.fetchall()
+    nites = cur.fetchall() or []
     for nite in nites:
         date = nite[0]
+        if last is None or date > last:
+            last = date
         dtm = datetime.datetime(int(date[0:4]), int(date[4:6]), int(date[6:8]))
         if dtm > datetime.datetime(2014, 07, 01):
             dtm += datetime.timedelta(days=7)
             directory = os.path.join("DTS", ftype, date)
             dirlist.append((directory, "RAW", dtm.strftime('%Y-%m-%d %H:%M:%S'), 5, None))
             count += 1
-    return count
+    return count, last
 
-def get_raw(cur, util, dirlist):
+def get_raw(cur, util, dirlist, since=None):
     """ Method to get any new raw directories
 
         Parameters
@@ -131,12 +234,20 @@ def get_raw(cur, util, dirlist):
         util : Util object
         dirlist : list
             list of directories to add
+        since : str
+            Only look at nites from this one on, YYYYMMDD (default is None, look at all nites)
+
+        Returns
+        -------
+        str, the latest nite found, None if there were none
     """
     sql = "select distinct nite from prod.exposure where 'DTS/raw/' || nite not in (select path from prod.backup_dir) and nite not like '%2013%' and nite not like '%2012%' and nite not like '%2016%'"
 
-    util.log(Util.info, "  Found %i nites to process" % (get_all_raw(cur, sql, 'raw', dirlist)))
+    count, last = get_all_raw(cur, sql, 'raw', dirlist, since)
+    util.log(Util.info, "  Found %i nites to process" % (count))
+    return last
 
-def get_sne(cur, util, dirlist):
+def get_sne(cur, util, dirlist, since=None):
     """ Method to get any new sne directories
 
         Parameters
@@ -145,10 +256,18 @@ def get_sne(cur, util, dirlist):
         util : Util object
         dirlist : list
             list of directories to add
+        since : str
+            Only look at nites from this one on, YYYYMMDD (default is None, look at all nites)
+
+        Returns
+        -------
+        str, the latest nite found, None if there were none
     """
     sql = "select distinct nite from prod.manifest_exposure where 'DTS/snmanifest/' || nite not in (select path from prod.backup_dir) and nite not like '%2013%' and nite not like '%2012%'"
 
-    util.log(Util.info, "  Found %i sn nites to process" % (get_all_raw(cur, sql, 'snmanifest', dirlist)))
+    count, last = get_all_raw(cur, sql, 'snmanifest', dirlist, since)
+    util.log(Util.info, "  Found %i sn nites to process" % (count))
+    return last
 
 def get_db(cur, util):
     """ Method to add DB backup directories
@@ -177,7 +296,7 @@ def get_db(cur, util):
             # stop if the file is less than 24 hours old
             if lmtime > (ctime - 86400.):
                 continue
-            cur.execute("select count(*) from backup_db where path='%s'" % (root))
+            execute(cur, "select count(*) from backup_db where path=:1", [root])
             if cur.fetchall()[0][0] > 0:
                 print "skipping ", root
                 continue
@@ -192,8 +311,7 @@ def get_db(cur, util):
             for fnm in fnames:
                 print "ADDING", os.path.join(root, fnm)
                 dbfiles.append((root, fnm, dbf))
-    cur.prepare("insert into backup_db (path, filename, run_date) values (:1,:2,TO_DATE(:3, 'YYYYMMDD'))")
-    cur.executemany(None, dbfiles)
+    executemany(cur, "insert into backup_db (path, filename, run_date) values (:1,:2,TO_DATE(:3, 'YYYYMMDD'))", dbfiles)
     util.log(Util.info, "  Added %i database files" % (len(dbfiles)))
 
 def main():  # pragma: no cover
@@ -223,27 +341,35 @@ def main():  # pragma: no cover
         else:
             level = logging.INFO
         # initialize the logging and db connection
-        util = Util(args['des_services'], args['section'], "/local_big/backups/logs/backup_setup.log", "SETUP", level)
+        util = get_util(args['des_services'], args['section'], "/local_big/backups/logs/backup_setup.log", "SETUP", level)
         util.log(Util.info, " Starting backup scan at %s" % (now.strftime('%Y-%m-%d %H:%M:%S')))
 
         junk_runs(util)
 
         #conn = util.get_connect(options.desdm, options.db)
         cur = util.cursor()
+        # only scan what is newer than the last scan, unless a full scan is asked for
+        marks = get_watermarks(cur)
+        since = {}
+        for name in WATERMARKS:
+            since[name] = None if args['full'] else scan_start(name, marks[name], args['overlap'])
+        util.log(Util.info, "  Scanning from %s" % (", ".join(["%s: %s" % (name, since[name] or 'the start') for name in sorted(since)])))
         dirlist = []
+        found = {}
         # first get pipeline stuff
-        add_dirs(cur, util, dirlist)
+        found['pipeline'] = add_dirs(cur, util, dirlist, since['pipeline'])
 
         # now get the raw data
-        get_raw(cur, util, dirlist)
+        found['raw'] = get_raw(cur, util, dirlist, since['raw'])
 
         # SN data
-        get_sne(cur, util, dirlist)
+        found['snmanifest'] = get_sne(cur, util, dirlist, since['snmanifest'])
 
         # store what was found
 
-        cur.prepare("insert into prod.backup_dir (path, status, class, release_date, priority, pfw_attempt_id) values (:1,0,:2,TO_DATE(:3, 'YYYY-MM-DD HH24:MI:SS'),:4,:5)")
-        cur.executemany(None, dirlist)
+        executemany(cur, "insert into prod.backup_dir (path, status, class, release_date, priority, pfw_attempt_id) values (:1,0,:2,TO_DATE(:3, 'YYYY-MM-DD HH24:MI:SS'),:4,:5)", dirlist)
+        update_summary(cur, [('DIR', summary_class(ddir[0], ddir[1]), 0, 1, 0) for ddir in dirlist])
+        set_watermarks(cur, marks, found)
 
         # now scan for database files, this has to be done on disk
         get_db(cur, util)
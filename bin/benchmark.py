@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+""" Module to benchmark the archiving pipeline on a synthetic archive, using a local stand-in
+    for the database and a local directory in place of tape
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import pprint
+import resource
+import tempfile
+import threading
+import argparse
+
+import archivetools.synthetic as syn
+import archivetools.backup_util as bu
+from archivetools.localdb import LocalUtil
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import run_backup
+import transfer
+import archive_setup
+
+
+def parse_options():
+    """ Method to parse command line options
+
+        Returns
+        -------
+        Tuple containing the options, and the remaining arguments which are passed on to
+        run_backup
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the archiving pipeline on a synthetic archive. Any other options are passed on to run_backup, e.g. --workers or --compression.')
+    parser.add_argument('--debug', default=False, action='store_true',
+                        help='Toggle DEBUG mode')
+    parser.add_argument('--workdir', action='store',
+                        help='Directory to build the archive, staging, transfer and tape areas in. DEFAULT: a temporary directory, which is removed afterwards')
+    parser.add_argument('--dirs', default='finalcut:4,coadd:1,raw:2', action='store',
+                        help='Comma separated list of class:number of directories to generate. DEFAULT: %(default)s')
+    parser.add_argument('--scale', default=0.01, type=float, action='store',
+                        help='Factor to scale the file sizes by, 1 gives production sized files. DEFAULT: %(default)s')
+    parser.add_argument('--seed', default=0, type=int, action='store',
+                        help='Seed for the file sizes. DEFAULT: %(default)s')
+    parser.add_argument('--catalog', default=0, type=int, action='store',
+                        help='Number of pipeline attempts to add to the catalog without any files on disk, to time the pipeline and archive_setup against a catalog of production size. DEFAULT: %(default)s')
+    parser.add_argument('--catalog_files', default=100, type=int, action='store',
+                        help='Number of files in each of the --catalog attempts. DEFAULT: %(default)s')
+    parser.add_argument('--keep', default=False, action='store_true',
+                        help='Keep the work directory afterwards')
+    parser.add_argument('--json', action='store',
+                        help='File to write the results to, for comparing between versions')
+    parser.add_argument('--hash_file', action='store',
+                        help='Instead of running the pipeline, time hashing this file with different block sizes, with and without mmap')
+    parser.add_argument('--checksums', default='md5,adler32', action='store',
+                        help='Comma separated list of checksums to time with --hash_file. DEFAULT: %(default)s')
+    args, rest = parser.parse_known_args()
+    return vars(args), rest
+
+def disk_usage(path):
+    """ Method to get the space used by the files under a directory
+
+        Parameters
+        ----------
+        path : str
+            The directory
+
+        Returns
+        -------
+        int, the size in bytes
+    """
+    total = 0
+    for dirpath, _, fnames in os.walk(path):
+        for fname in fnames:
+            try:
+                total += os.lstat(os.path.join(dirpath, fname)).st_size
+            except OSError:
+                # removed while walking
+                pass
+    return total
+
+def peak_rss():
+    """ Method to get the peak resident memory of this process and of its finished children
+
+        Returns
+        -------
+        float, the larger of the two in MB
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024.
+
+
+class UsageMonitor(object):
+    """ Class which samples the space used in a set of directories in a thread, to find the
+        peak usage while a stage runs
+
+        Parameters
+        ----------
+        dirs : list
+            The directories to monitor
+        interval : float
+            The time between samples in seconds (default is 0.2)
+    """
+    def __init__(self, dirs, interval=0.2):
+        self.dirs = dirs
+        self.interval = interval
+        self.peak = 0
+        self.event = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def sample(self):
+        """ Method to take one sample
+        """
+        self.peak = max(self.peak, sum([disk_usage(ddir) for ddir in self.dirs]))
+
+    def run(self):
+        """ Method run by the sampling thread
+        """
+        while not self.event.is_set():
+            self.sample()
+            self.event.wait(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.event.set()
+        self.thread.join()
+        self.sample()
+
+def run_stage(name, func, dirs):
+    """ Method to run and time one stage of the pipeline
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage
+        func : function
+            The function running the stage, it returns a tuple of the number of bytes and
+            number of files processed
+        dirs : list
+            The directories whose peak usage is to be reported
+
+        Returns
+        -------
+        dict of the results
+    """
+    bu.reset_statement_stats()
+    with UsageMonitor(dirs) as monitor:
+        start = time.time()
+        nbytes, nfiles = func()
+        seconds = time.time() - start
+    stats = bu.get_statement_stats()
+    return {'stage': name,
+            'seconds': seconds,
+            'mbytes': nbytes / 1024.**2,
+            'files': nfiles,
+            'mb_per_s': nbytes / 1024.**2 / max(seconds, 1e-6),
+            'files_per_s': nfiles / max(seconds, 1e-6),
+            'peak_rss_mb': peak_rss(),
+            'peak_staging_mb': monitor.peak / 1024.**2,
+            'parses': stats['parses'],
+            'executes': stats['executes']}
+
+def format_results(results):
+    """ Method to generate a report of the results
+
+        Parameters
+        ----------
+        results : list
+            The results of each stage, from run_stage
+
+        Returns
+        -------
+        str containing the report
+    """
+    lines = ["%-10s %10s %10s %10s %10s %10s %12s %12s %8s %8s" % ('stage', 'seconds', 'MB', 'files', 'MB/s', 'files/s', 'peak RSS MB', 'peak disk MB', 'parses', 'executes')]
+    for res in results:
+        lines.append("%-10s %10.2f %10.1f %10i %10.1f %10.1f %12.1f %12.1f %8i %8i" % (res['stage'], res['seconds'], res['mbytes'], res['files'], res['mb_per_s'],
+                                                                                      res['files_per_s'], res['peak_rss_mb'], res['peak_staging_mb'], res['parses'], res['executes']))
+    return "\n".join(lines)
+
+def hash_benchmark(filename, algorithms, blksizes=(2**16, 2**20, 2**22, 2**24)):
+    """ Method to time hashing a file with different block sizes, with and without mmap. The
+        file is read once beforehand so that all timings are from the page cache, if it fits.
+
+        Parameters
+        ----------
+        filename : str
+            The file to hash
+        algorithms : list
+            The names of the checksums to calculate
+        blksizes : list
+            The block sizes to try, in bytes (default is 64 kB to 16 MB)
+
+        Returns
+        -------
+        list of dicts of the results
+    """
+    size = os.path.getsize(filename)
+    bu.hash_file(filename, [])
+    results = []
+    for use_mmap in (False, True):
+        for blksize in blksizes:
+            start = time.time()
+            bu.hash_file(filename, algorithms, blksize, use_mmap)
+            seconds = time.time() - start
+            results.append({'mmap': use_mmap,
+                            'blksize': blksize,
+                            'seconds': seconds,
+                            'mb_per_s': size / 1024.**2 / max(seconds, 1e-6)})
+    return results
+
+def format_hash_results(results):
+    """ Method to generate a report of the hashing results
+
+        Parameters
+        ----------
+        results : list
+            The results, from hash_benchmark
+
+        Returns
+        -------
+        str containing the report
+    """
+    lines = ["%-6s %10s %10s %10s" % ('mmap', 'block kB', 'seconds', 'MB/s')]
+    for res in results:
+        lines.append("%-6s %10i %10.2f %10.1f" % (res['mmap'], res['blksize'] / 1024, res['seconds'], res['mb_per_s']))
+    return "\n".join(lines)
+
+def benchmark(opts, rest, workdir):
+    """ Method to generate the synthetic archive, then pack it and transfer it
+
+        Parameters
+        ----------
+        opts : dict
+            Command line options
+        rest : list
+            Command line options for run_backup
+        workdir : str
+            The directory to work in
+
+        Returns
+        -------
+        list of the results of each stage
+    """
+    root = os.path.join(workdir, 'archive')
+    stgdir = os.path.join(workdir, 'staging')
+    xferdir = os.path.join(workdir, 'transfer')
+    tapedir = os.path.join(workdir, 'tape')
+    for ddir in (root, stgdir, xferdir, tapedir):
+        if not os.path.isdir(ddir):
+            os.makedirs(ddir)
+    util = LocalUtil(os.path.join(workdir, 'benchmark.db'), ltype='BENCHMARK')
+    argv = sys.argv
+    sys.argv = ['run_backup', '--stgdir', stgdir, '--xferdir', xferdir, '--forcex', '--free', '0b'] + rest
+    try:
+        args = run_backup.parse_options()
+    finally:
+        sys.argv = argv
+    if opts['debug']:
+        pprint.pprint(args)
+    dirs = []
+
+    def generate():
+        for item in opts['dirs'].split(','):
+            clss, count = item.split(':')
+            dirs.extend(syn.make_tree(root, clss, int(count), opts['scale'], opts['seed'], len(dirs) + 1))
+        syn.load_catalog(util, root, dirs)
+        files = sum([d['files'] for d in dirs], [])
+        return sum([f[2] for f in files]), len(files)
+
+    def catalog():
+        return 0, syn.make_catalog(util, opts['catalog'], opts['catalog_files'], opts['seed'])
+
+    def setup():
+        dirlist = []
+        archive_setup.add_dirs(util.cursor(), util, dirlist)
+        return 0, len(dirlist)
+
+    def pack():
+        run_backup.archive_files(util, args)
+        files = sum([d['files'] for d in dirs], [])
+        return sum([f[2] for f in files]), len(files)
+
+    def transfer_tapes():
+        cur = util.cursor()
+        cur.execute("select count(*),sum(TAR_SIZE) from BACKUP_TAPE where STATUS=0")
+        count, size = cur.fetchall()[0]
+        xfer = transfer.Transfer(util, {'max_pri': args['max_pri'], 'mssdir': tapedir, 'server': '', 'xfer_method': 'copy'})
+        xfer.transfer()
+        return size or 0, count
+
+    results = []
+    results.append(run_stage('generate', generate, [root]))
+    if opts['catalog']:
+        results.append(run_stage('catalog', catalog, [workdir]))
+        results.append(run_stage('setup', setup, [workdir]))
+    results.append(run_stage('pack', pack, [stgdir, xferdir]))
+    results.append(run_stage('transfer', transfer_tapes, [xferdir, tapedir]))
+    util.close()
+    return results
+
+def main():
+    """ Main entry
+    """
+    opts, rest = parse_options()
+    if opts['hash_file']:
+        results = hash_benchmark(opts['hash_file'], bu.get_checksum_list(opts['checksums']))
+        print format_hash_results(results)
+        if opts['json']:
+            with open(opts['json'], 'w') as flh:
+                json.dump(results, flh, indent=2)
+        return
+    workdir = opts['workdir']
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='archive_benchmark')
+    try:
+        results = benchmark(opts, rest, workdir)
+    finally:
+        if not opts['keep'] and opts['workdir'] is None:
+            shutil.rmtree(workdir)
+    print format_results(results)
+    if opts['json']:
+        with open(opts['json'], 'w') as flh:
+            json.dump(results, flh, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -47,11 +47,13 @@ def parse_options():
     parser = argparse.ArgumentParser(description='Monitor the backup status and software')
     parser.add_argument('--debug', default=False, action='store_true',
                         help='Toggle DEBUG mode')
-    parser.add_argument('--des_services', action='store', help='DESDM Database Access File: %default')
+    parser.add_argument('--des_services', action='store', help='DESDM Database Access File, or sqlite:<file> to use a local database: %default')
     parser.add_argument('--section', action='store', help='Database to use')
     parser.add_argument('--dlen', default="14", action='store',
                         help='Length of time to produce the report for Default: %default')
     parser.add_argument('--dblen', default=6, type=int, action='store')
+    parser.add_argument('--rebuild_summary', default=False, action='store_true',
+                        help='Recount the backup summary from the catalog tables before reporting. Use it to start the summary, and to correct it after BACKUP_DIR, BACKUP_UNIT or BACKUP_TAPE rows are changed by anything other than the archiving scripts, e.g. deleted by hand')
     return vars(parser.parse_args())
 
 def getproc(name):
@@ -201,7 +203,7 @@ def get_size(path):
 
 def get_size_db(curs, pfwid):
     start = time.time()
-    curs.execute('select sum(df.filesize) from desfile df, file_archive_info fai where df.pfw_attempt_id=%s and df.id=fai.desfile_id' % (pfwid))
+    bu.execute(curs, 'select sum(df.filesize) from desfile df, file_archive_info fai where df.pfw_attempt_id=:1 and df.id=fai.desfile_id', [pfwid])
     res = curs.fetchall()
     size = int(res[0][0])
     print size, time.time()-start
@@ -224,108 +226,72 @@ def df(path):
     output = subp.communicate()[0].split('\n')[1].split()
     return float(output[1]), float(output[2])
 
-def get_tape_data(curs):
+def get_tape_data(summary):
     """ Method to gather data on tar files backed up to tape
 
         Parameters
         ----------
-        curs : cursor object
+        summary : dict
+            The backup summary, from get_summary
 
         Returns
         -------
         Tuple containing the number of transferred files, the total size of transferred files,
         number to be transferred, and the total size of the files to be transferred
     """
-    curs.execute('select status, sum(tar_size), count(*) from backup_tape where status=1 or status=0 group by status')
-    results = curs.fetchall()
     xfer = xfersize = nxfer = nxfersize = 0
-    for res in results:
-        if res[0] == 0:
-            nxfer = res[2]
-            nxfersize = res[1]
-        else:
-            xfer = res[2]
-            xfersize = res[1]
+    for (item, _, status), val in summary.iteritems():
+        if item != 'TAPE':
+            continue
+        if status == 0:
+            nxfer += val['num']
+            nxfersize += val['size']
+        elif status == 1:
+            xfer += val['num']
+            xfersize += val['size']
 
     return xfer, xfersize, nxfer, nxfersize
 
-def get_backupdir_data(cur, archive_root):
+def get_backupdir_data(summary):
     """ Method to gather data on the directories that have been archived
 
         Parameters
         ----------
-        cur : cursor object
+        summary : dict
+            The backup summary, from get_summary
 
         Returns
         -------
         Tuple containing number of pipeline directories processed, the number of pipeline directories
         to be processed, the number of raw directories processed, and the number of raw directories
-        to be processed
+        to be processed. The directories to be processed include those which have not passed
+        their release date.
     """
-    print "START"
-    cur.execute("select class, path from backup_dir where release_date>SYSTIMESTAMP and status=0")
-    cur.execute("insert into gtt_id (select pfw_attempt_id from backup_dir where release_date>SYSTIMESTAMP and status=0")
-    results = cur.fetchall()
-    print "RES"
-    future_raw_size = 0
-    future_pipe_size = 0
-    future_raw_count = 0
-    future_pipe_count = 0
-
-    future_pipe_count = len(results)
-    for res in results:
-        print res[1]
-        if 'RAW' in res[0]:
-            future_raw_size += get_size(os.path.join(archive_root, res[1]))
-            future_raw_count += 1
-        #else:
-        #    #future_pipe_size += get_size_db(cur, res[2])
-        #    future_pipe_count += 1
-    cur.execute('select sum(df.filesize) from desfile df, file_archive_info fai, gtt_id gtt where df.pfw_attempt_id=gtt.id and df.id=fai.desfile_id')
-    future_pipe_size = int(cur.fetchall()[0][0])
-
-    future_pipe_count -= future_raw_count
-    print '2'
-    cur.execute("select class, path from backup_dir where release_date<=SYSTIMESTAMP and status=0")
-    results = cur.fetchall()
-    print 'RES'
-    raw_size = 0
-    pipe_size = 0
-
-    for res in results:
-        if 'RAW' in res[0]:
-            raw_size += get_size(os.path.join(archive_root, res[1]))
-        else:
-            pipe_size += get_size(os.path.join(archive_root, res[1]))
-
-    cur.execute("select status, class, count(status) from backup_dir where path not like '%snmanifest%' and release_date<=SYSTIMESTAMP and status<3 group by class, status")
-    results = cur.fetchall()
-    print 'r3'
     pproc = 0
     ptoproc = 0
     rproc = 0
     rtoproc = 0
 
-    for res in results:
-        if 'RAW' in res[1]:
-            if res[0] == 1:
-                rproc = res[2]
+    for (item, clss, status), val in summary.iteritems():
+        # the SN manifest nites, and the directories with a status of 3 or more, are not reported
+        if item != 'DIR' or clss == bu.SNMANIFEST_CLASS or status >= 3:
+            continue
+        if 'RAW' in clss:
+            if status == 1:
+                rproc += val['num']
             else:
-                rtoproc = res[2]
+                rtoproc += val['num']
         else:
-            if res[0] == 1:
-                pproc += res[2]
+            if status == 1:
+                pproc += val['num']
             else:
-                ptoproc += res[2]
-    raw_size /= (math.pow(1024, 3))
-    future_raw_size /= (math.pow(1024, 3))
-    pipe_size /= (math.pow(1024, 3))
-    future_pipe_size /= (math.pow(1024, 3))
+                ptoproc += val['num']
 
-    return pproc, ptoproc, rproc, rtoproc, future_raw_size, future_pipe_size, raw_size, pipe_size, future_raw_count, future_pipe_count
+    return pproc, ptoproc, rproc, rtoproc
 
 def get_deprecated(cur):
-    """ Method to gather data on any deprecated archived data
+    """ Method to gather data on any deprecated archived data, units are deprecated by hand so
+        they are not counted in the summary
 
         Parameters
         ----------
@@ -339,71 +305,84 @@ def get_deprecated(cur):
     results = cur.fetchall()
     (deprec, depsize) = results[0]
 
-    return deprec, depsize
+    return deprec, depsize or 0
 
-def get_database(cur):
+def get_database(summary):
     """ Method to gather data on backed up database files
 
         Parameters
         ----------
-        cur : cursor object
+        summary : dict
+            The backup summary, from get_summary
 
         Returns
         -------
         Tuple containing the number of backed up db directories and their total size
     """
-    cur.execute("select count(*), sum(tar_size) from backup_tape where name like '%DB_BACKUP%'")
-    results = cur.fetchall()
-    (dbcount, dbsize) = results[0]
+    dbcount = 0
+    dbsize = 0.
+    for (item, clss, _), val in summary.iteritems():
+        if item == 'TAPE' and clss.startswith('DB'):
+            dbcount += val['num']
+            dbsize += val['size']
 
     dbsize /= (math.pow(1024, 4))
     return dbcount, dbsize
 
-def get_untransferred(cur):
+def get_untransferred(summary):
     """ Method to gather data on untransferred backups
 
         Parameters
         ----------
-        cur : cursor object
+        summary : dict
+            The backup summary, from get_summary
 
         Returns
         -------
         Tuple containing the sizes, and date information for the relevant files
     """
-    cur.execute("select file_type, max(created_date), sum(tar_size) from backup_unit where status=2 group by file_type")
-    results = cur.fetchall()
     untrans = {}
-    for res in results:
-        untrans[res[0]] = {'size': res[2],
-                           'last_date': res[1]}
+    for (item, clss, status), val in summary.iteritems():
+        # the units streamed into an open tape tar (status 3) are counted as in a tape tar
+        if item != 'UNIT' or status != 2 or not val['num']:
+            continue
+        if clss in untrans:
+            untrans[clss]['size'] += val['size']
+            untrans[clss]['last_date'] = max(untrans[clss]['last_date'], val['last_date'])
+        else:
+            untrans[clss] = {'size': val['size'],
+                             'last_date': val['last_date']}
     return untrans
 
-def get_total_data(cur):
+def get_total_data(summary):
     """ Method to gather data on all backup units
 
         Paramters
         ---------
-        cur : cursor object
+        summary : dict
+            The backup summary, from get_summary
 
         Returns
         -------
         Tuple containing the total size of unit tars, total size of raw tars, total tar sizes grouped
         by file type
     """
-    cur.execute("select file_type,sum(tar_size) from backup_unit where tape_tar is not null and file_type not like 'DB%' group by file_type")
-    results = cur.fetchall()
-
-    sizesbytype = {}
+    sizesbytype = {'DB': 0.}
     totaltarsize = 0
     rawsize = 0
-    for res in results:
-        sizesbytype[res[0]] = res[1] / math.pow(1024., 4)
-        if res[0] == 'RAW':
-            rawsize = res[1]/math.pow(1024., 4)
-        else:
-            totaltarsize += res[1] / math.pow(1024., 4)
-    cur.execute("select sum(tar_size) from backup_unit where file_type like 'DB%'")
-    sizesbytype['DB'] = cur.fetchall()[0][0] / math.pow(1024., 4)
+    for (item, clss, status), val in summary.iteritems():
+        if item != 'UNIT':
+            continue
+        size = val['size'] / math.pow(1024., 4)
+        if clss.startswith('DB'):
+            sizesbytype['DB'] += size
+        elif status in (1, 3):
+            # in a tape tar
+            sizesbytype[clss] = sizesbytype.get(clss, 0.) + size
+            if clss == 'RAW':
+                rawsize += size
+            else:
+                totaltarsize += size
     return totaltarsize, rawsize, sizesbytype
 
 def report_processes(html):
@@ -477,8 +456,7 @@ def report_untransferred(html, untrans):
 
 def report_archive_status(html, numxfer, xfersize, num_deprec, depsize, numproc, totaltarsize,
                           dbcount, dbsize, rawproc, rawsize, not_xfersize, num_not_xfer, numtoproc,
-                          rawtoproc, future_raw_size, future_pipe_size, raw_size, pipe_size,
-                          future_raw_count, future_pipe_count):
+                          rawtoproc):
     """ Method to print out the archive status
 
         Parameters
@@ -513,7 +491,7 @@ def report_archive_status(html, numxfer, xfersize, num_deprec, depsize, numproc,
         rawtoproc : int
             The number of RAW directories still to be processed
     """
-    html.write("Totals only include files which have passed their release date.<P>")
+    html.write("Directories to tar include those which have not passed their release date.<P>")
     html.write("<table border=0><tr><td>")
     html.write("<table border=1>\n")
     html.write("<tr><th></th><th>Count</th><th>Size (Tb)</th></tr>\n")
@@ -533,20 +511,14 @@ def report_archive_status(html, numxfer, xfersize, num_deprec, depsize, numproc,
         clr = YELLOW
     if numtoproc > 200:
         clr = RED
-    html.write("<tr><td>Pipeline Runs To Tar</td><td bgcolor=" + clr + " align='right'>" + str(numtoproc) + "</td><td align='right'>" + str(pipe_size) + "</td></tr>\n")
+    html.write("<tr><td>Pipeline Runs To Tar</td><td bgcolor=" + clr + " align='right'>" + str(numtoproc) + "</td><td></td></tr>\n")
     clr = GREEN
     if rawtoproc > 15:
         clr = YELLOW
     if rawtoproc > 200:
         clr = RED
-    html.write("<tr><td>Nites To Tar</td><td bgcolor=" + clr + " align='right'>" + str(rawtoproc) + "</td><td  align='right'>" + str(raw_size) +"</td></tr>\n")
+    html.write("<tr><td>Nites To Tar</td><td bgcolor=" + clr + " align='right'>" + str(rawtoproc) + "</td><td></td></tr>\n")
     html.write("</table>\n<P>")
-    html.write("<table border=1>\n")
-    html.write("<tr><th>Future</th><th># dirs</th><th>Size (Gb)</th></tr>\n")
-    html.write("<tr><td>Pipeline</td><td align='right'>" + str(future_pipe_count) + "</td><td align='right'>%.3f</td></tr>\n" % (future_pipe_size))
-    html.write("<tr><td>Raw</td><td align='right'>" + str(future_raw_count) + "</td><td align='right'>%.3f</td></tr>\n" % (future_raw_size))
-
-    html.write("</table>")
     html.write("</td><td>")
     html.write("<img src=\"https://desar2.cosmology.illinois.edu/DESFiles/desardata/QA/technical/backups/data_size_on_tape.png\">\n")
     html.write("</td></tr></table>\n")
@@ -572,7 +544,7 @@ def get_db_holdings(cur, db_name, length):
     """
     if db_name:
         db_name = '-' + db_name
-    cur.execute("select sum(tar_size) from backup_tape where file_type='DB%s' and created_date<add_months(SYSDATE, -%i)" % (db_name, length))
+    bu.execute(cur, "select sum(tar_size) from backup_tape where file_type=:1 and created_date<add_months(SYSDATE, :2)", ['DB' + db_name, -length])
     results = cur.fetchall()
     if results:
         return results[0][0]/math.pow(1024., 4)
@@ -614,7 +586,7 @@ def db_status(cur, html, db_proc, db_to_proc, length):
     html.write("</table></td><td valign='top'>\n")
     html.write("<table border=1>\n")
     for dbp in db_to_proc:
-        cur.execute("select filename from backup_db where path='%s' and status=1" % (dbp))
+        bu.execute(cur, "select filename from backup_db where path=:1 and status=1", [dbp])
         results = cur.fetchall()
         rsize = 0
         for res in results:
@@ -656,24 +628,23 @@ def main():
             level = logging.INFO
         # initialize the logging and db connection
         now = datetime.datetime.now()
-        util = bu.Util(args['des_services'], args['section'], "/local_big/backups/logs/monitor.log", "MONITOR", llevel=level)
+        util = bu.get_util(args['des_services'], args['section'], "/local_big/backups/logs/monitor.log", "MONITOR", llevel=level)
         util.log(bu.Util.info, " Starting monitor scan")
 
         cur = util.cursor()
-
-        # get the last date the script was run
-        #print 'a', datetime.datetime.now()
-        (numxfer, xfersize, num_not_xfer, not_xfersize) = get_tape_data(cur)
-        #print 'b',datetime.datetime.now()
-        (numproc, numtoproc, rawproc, rawtoproc, future_raw_size, future_pipe_size, raw_size, pipe_size, future_raw_count, future_pipe_count) = get_backupdir_data(cur, util.root)
-        #print 'c',datetime.datetime.now()
+        if args['rebuild_summary']:
+            util.log(bu.Util.info, " Rebuilding the backup summary")
+            bu.rebuild_summary(cur)
+            cur.execute('commit')
+
+        # the totals are all read from the summary, which the other scripts keep up to date
+        summary = bu.get_summary(cur)
+        (numxfer, xfersize, num_not_xfer, not_xfersize) = get_tape_data(summary)
+        (numproc, numtoproc, rawproc, rawtoproc) = get_backupdir_data(summary)
         (num_deprec, depsize) = get_deprecated(cur)
-        #print 'd',datetime.datetime.now()
-        (dbcount, dbsize) = get_database(cur)
-        #print 'e',datetime.datetime.now()
-        untrans = get_untransferred(cur)
-        #print 'f',datetime.datetime.now()
-        (totaltarsize, rawsize, sizesbytype) = get_total_data(cur)
+        (dbcount, dbsize) = get_database(summary)
+        untrans = get_untransferred(summary)
+        (totaltarsize, rawsize, sizesbytype) = get_total_data(summary)
 
         bu.Pie('/work/QA/technical/backups/data_size_on_tape.png', sizesbytype.values(),
                sizesbytype.keys()).generate()
@@ -682,10 +653,10 @@ def main():
 
         report_processes(html)
 
-        report_archive_status(html, numxfer, xfersize, num_deprec, depsize, numproc, totaltarsize, dbcount, dbsize, rawproc, rawsize, not_xfersize, num_not_xfer, numtoproc, rawtoproc,
-                              future_raw_size, future_pipe_size, raw_size, pipe_size, future_raw_count, future_pipe_count)
+        report_archive_status(html, numxfer, xfersize, num_deprec, depsize, numproc, totaltarsize, dbcount, dbsize, rawproc, rawsize, not_xfersize, num_not_xfer, numtoproc, rawtoproc)
 
-        cur.execute("insert into friedel.backup_monitor (number_transferred,number_not_transferred,size_transferred,size_to_be_transferred,number_deprecated,size_deprecated,pipe_processed,pipe_to_be_processed,raw_processed,raw_to_be_processed,run_time) values(%i,%i,%i,%i,%i,%i,%i,%i,%i,%i,TO_DATE('%s', 'YYYY-MM-DD HH24:MI:SS'))" % (numxfer, num_not_xfer, xfersize, not_xfersize, num_deprec, depsize, numproc, numtoproc, rawproc, rawtoproc, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        bu.execute(cur, "insert into friedel.backup_monitor (number_transferred,number_not_transferred,size_transferred,size_to_be_transferred,number_deprecated,size_deprecated,pipe_processed,pipe_to_be_processed,raw_processed,raw_to_be_processed,run_time) values(:1,:2,:3,:4,:5,:6,:7,:8,:9,:10,TO_DATE(:11, 'YYYY-MM-DD HH24:MI:SS'))",
+                   [numxfer, num_not_xfer, xfersize, not_xfersize, num_deprec, depsize, numproc, numtoproc, rawproc, rawtoproc, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')])
 
         cur.execute('commit')
 
@@ -719,7 +690,9 @@ def main():
         html.write("<img src=\"https://desar2.cosmology.illinois.edu/DESFiles/desardata/QA/technical/backups/local_med_status.png\">\n")
         html.write("</td></tr></table>")
 
-        cur.execute("select number_transferred,number_not_transferred,size_transferred,size_to_be_transferred,number_deprecated,size_deprecated,pipe_processed,pipe_to_be_processed,raw_processed,raw_to_be_processed,run_time from friedel.backup_monitor order by run_time desc")
+        # only the history being plotted is read
+        start = (now - datetime.timedelta(days=int(args['dlen']))).strftime('%Y-%m-%d %H:%M:%S')
+        bu.execute(cur, "select number_transferred,number_not_transferred,size_transferred,size_to_be_transferred,number_deprecated,size_deprecated,pipe_processed,pipe_to_be_processed,raw_processed,raw_to_be_processed,run_time from friedel.backup_monitor where run_time >= TO_DATE(:1, 'YYYY-MM-DD HH24:MI:SS') order by run_time desc", [start])
 
         results = cur.fetchall()
         tempx = []
@@ -761,7 +734,7 @@ def main():
 
         #cur.execute("select transfer_date,(tar_size/(1024*1024*1024)),(tar_size/(transfer_time*1024*1024*1024)) from backup_tape where transfer_date is not null and transfer_date >= TO_DATE('%s', 'YYYY-MM-DD HH24:MI:SS') order by transfer_date desc" % (start.strftime('%Y-%m-%d %H:%M:%S')))
         cur.execute("select transfer_date,(tar_size/(1024*1024*1024)),(tar_size/(transfer_time*1024*1024*1024)) from backup_tape where transfer_date is not null order by transfer_date desc")
-        res = cur.fetchall()
+        res = cur.fetchmany(14*8)
 
         transdate = []
         transsize = []
@@ -4,6 +4,8 @@
 """
 
 import os
+import shutil
+import tempfile
 import argparse
 import sys
 import tarfile
@@ -27,6 +29,170 @@ def get_tape(filename):
     #    print 'Error retrieving tape file from archive.'
     #    sys.exit(1)
 
+def extract_compressed(fileobj, codec, root_path, regex=None):
+    """ Method to extract files from a compressed unit tar, reading it as a stream
+
+        Parameters
+        ----------
+        fileobj : file object
+            The compressed unit tar
+        codec : str
+            The compression codec of the unit tar
+        root_path : str
+            The directory to extract the files to
+        regex : compiled regular expression
+            Only extract members whose names match this (Default is None, extract everything)
+
+        Returns
+        -------
+        dict of the TarInfo of the extracted members, keyed by name
+    """
+    members = {}
+    unit_tar = tarfile.open(fileobj=bu.DecompressingReader(fileobj, codec), mode='r|')
+    for tarinfo in unit_tar:
+        if regex and not regex.search(tarinfo.name):
+            continue
+        unit_tar.extract(tarinfo, path=root_path)
+        members[tarinfo.name] = tarinfo
+    return members
+
+def extract_indexed(tape, index, root_path, regex=None):
+    """ Method to extract files from a unit tar in a tape tar, using the index of the unit tar to
+        read only the requested files
+
+        Parameters
+        ----------
+        tape : str
+            The name of the tape tar
+        index : dict
+            The index of the unit tar, from the database or the index file of the tape tar.
+            Compressed unit tars are decompressed as they are read.
+        root_path : str
+            The directory to extract the files to
+        regex : compiled regular expression
+            Only extract members whose names match this (Default is None, extract everything)
+
+        Returns
+        -------
+        dict of the TarInfo of the extracted members, keyed by name
+    """
+    members = {}
+    with open(tape, 'rb') as flh:
+        section = bu.FileSection(flh, index['data_offset'], index['size'])
+        if index.get('compression'):
+            # a compressed unit tar cannot be seeked in, so it is read through
+            return extract_compressed(section, index['compression'], root_path, regex)
+        unit_tar = tarfile.open(fileobj=section, mode='r:')
+        for name in sorted(index['members']):
+            if regex and not regex.search(name):
+                continue
+            tarinfo = bu.read_member(unit_tar, index['members'][name][0])
+            unit_tar.extract(tarinfo, path=root_path)
+            members[name] = tarinfo
+    return members
+
+def extract_scan(tape, unit, root_path, regex=None):
+    """ Method to extract files from a unit tar in a tape tar, by reading through the tar files
+        to find them. This is used for tape tars which were not indexed.
+
+        Parameters
+        ----------
+        tape : str
+            The name of the tape tar
+        unit : str
+            The name of the unit tar
+        root_path : str
+            The directory to extract the files to
+        regex : compiled regular expression
+            Only extract members whose names match this (Default is None, extract everything)
+
+        Returns
+        -------
+        dict of the TarInfo of the extracted members, keyed by name
+    """
+    tape_tar = tarfile.open(tape, mode='r')
+    names = tape_tar.getnames()
+    if unit not in names:
+        raise Exception('Unit tar %s not found in tape tar %s, this should not happen' % (unit, tape))
+    codec = bu.codec_from_name(unit)
+    if codec:
+        return extract_compressed(tape_tar.extractfile(unit), codec, root_path, regex)
+    members = {}
+    unit_tar = tarfile.open(fileobj=tape_tar.extractfile(unit))
+    for tarinfo in unit_tar.getmembers():
+        if regex and not regex.search(tarinfo.name):
+            continue
+        members[tarinfo.name] = tarinfo
+    unit_tar.extractall(path=root_path, members=members.values())
+    return members
+
+def extract_member(util, unit, member, root_path):
+    """ Method to extract a single member of a unit tar
+
+        Parameters
+        ----------
+        util : Util instance
+        unit : str
+            The name of the unit tar
+        member : str
+            The name of the member
+        root_path : str
+            The directory to extract the member to
+
+        Returns
+        -------
+        TarInfo of the member
+    """
+    cur = util.cursor()
+    bu.execute(cur, "select TAPE_TAR from BACKUP_UNIT where NAME=:1", [unit])
+    res = cur.fetchall()
+    if not res or not res[0][0]:
+        raise Exception('Unit tar %s is not in a tape tar' % (unit))
+    tape = res[0][0]
+    get_tape(tape)
+    regex = re.compile(r'\A%s\Z' % (re.escape(member)))
+    index = bu.get_unit_index(util, unit)
+    if index is None and os.path.exists(tape + '.index'):
+        index = bu.read_index(tape + '.index').get(unit)
+    if index is not None:
+        members = extract_indexed(tape, index, root_path, regex)
+    else:
+        members = extract_scan(tape, unit, root_path, regex)
+    if member not in members:
+        raise Exception('Member %s not found in unit tar %s' % (member, unit))
+    return members[member]
+
+def resolve_references(util, members, root_path):
+    """ Method to replace extracted members which are references to identical files archived
+        earlier with the files they refer to
+
+        Parameters
+        ----------
+        util : Util instance
+        members : dict
+            The TarInfo of the extracted members, keyed by name, references are replaced by the
+            TarInfo of the files they refer to
+        root_path : str
+            The directory the members were extracted to
+    """
+    for name, tarinfo in members.items():
+        if not tarinfo.issym():
+            continue
+        ref = bu.parse_reference(tarinfo.linkname)
+        if ref is None:
+            continue
+        print "Restoring %s from %s in unit tar %s" % (name, ref[1], ref[0])
+        tmpdir = tempfile.mkdtemp(dir=root_path)
+        try:
+            reftarinfo = extract_member(util, ref[0], ref[1], tmpdir)
+            target = os.path.join(root_path, name)
+            os.remove(target)
+            os.rename(os.path.join(tmpdir, ref[1]), target)
+        finally:
+            shutil.rmtree(tmpdir)
+        reftarinfo.name = name
+        members[name] = reftarinfo
+
 def restore_files(util, args, data):
     """ Method to restore file to the file system
 
@@ -38,31 +204,32 @@ def restore_files(util, args, data):
         data : dict
             Data on the files to restore
     """
-    tape_tar = tarfile.open(args['tape'], mode='r')
-    names = tape_tar.getnames()
-    if args['unit'] not in names:
-        raise Exception('Unit tar %s not found in tape tar %s, this should not happen' % (args['unit'], args['tape']))
-    unit_tar = tarfile.open(fileobj=tape_tar.extractfile(args['unit']))
-
     root_path = '.'
     if args['restore']:
         root_path = data['archive']
     else:
         args['update_fai'] = False
 
+    regex = None
     if args['filename'] or args['path']:
         if args['filename']:
             regex = re.compile(r'%s\Z' % (args['filename']))
         else:
             regex = re.compile(r'\A%s' % (args['path']))
-        allnames = [m for m in unit_tar.getnames() if regex.search(m)]
-        unit_tar.extractall(path=root_path, members=[m for m in unit_tar.getmembers() if regex.search(m.name)])
+
+    # use the index of the tape tar, if there is one, to go straight to the requested files
+    index = bu.get_unit_index(util, args['unit'])
+    if index is None and os.path.exists(args['tape'] + '.index'):
+        index = bu.read_index(args['tape'] + '.index').get(args['unit'])
+    if index is not None:
+        members = extract_indexed(args['tape'], index, root_path, regex)
     else:
-        unit_tar.extractall(path=root_path)
-        allnames = unit_tar.getnames()
+        members = extract_scan(args['tape'], args['unit'], root_path, regex)
+    resolve_references(util, members, root_path)
+    allnames = sorted(members.keys())
     if args['update_fai']:
         # get only the file names
-        files = [m for m in allnames if unit_tar.getmember(m).isfile()]
+        files = [m for m in allnames if members[m].isfile()]
         full_listing = {}
         for fln in files:
             full_filename = fln.split('/')[-1]
@@ -149,8 +316,7 @@ def main():
     parser.add_argument('--update_fai', action='store_true', default=False)
     parser.add_argument('--restore', action='store_true', default=False,
                         help='Restore the requested files to their proper place in the archive if possible. Default is the current directory.')
-    args = parser.parse_args(sys.argv[1:])
-    vars(args)
+    args = vars(parser.parse_args(sys.argv[1:]))
     # validate the args
     triplet = [args['reqnum'], args['unitname'], args['attnum']]
     if not any(triplet + [args['filename'], args['path']]):
@@ -175,6 +341,8 @@ def main():
         print "Item is not in tape archive"
         return
     get_tape(data['tape'])
+    args['tape'] = data['tape']
+    args['unit'] = data['unit']
     restore_files(util, args, data)
 #    if args['filename']:
 #        restore_file(args['filename'], data, args['restore'])
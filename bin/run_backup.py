@@ -9,7 +9,8 @@ import datetime
 import argparse
 
 import archivetools.backup_util as bu
-from archivetools.DES_archive import DES_archive
+import archivetools.backup_plan as bp
+from archivetools.DES_archive import DES_archive, estimate_tar_size
 
 
 def parse_options():
@@ -34,16 +35,224 @@ def parse_options():
                         help='DESAR transfer directory DEFAULT:%default')
     parser.add_argument('--forcex', default=False, action='store_true',
                         help='Force the transfer of data, even if the minimum size is not met. DEFAULT:%default')
-    parser.add_argument('--des_services', action='store', help='DESDM Database Access File: %default',)
+    parser.add_argument('--des_services', action='store', help='DESDM Database Access File, or sqlite:<file> to use a local database: %default',)
     parser.add_argument('--section', action='store', help='Database to use')
-    parser.add_argument('--verify', default=False, action='store_true',
-                        help='Verify file md5sums, this can take a while')
+    parser.add_argument('--verify', default=True, action='store_true',
+                        help='Verify file md5sums against the database as they are tarred (this is the default)')
+    parser.add_argument('--noverify', dest='verify', action='store_false',
+                        help='Do not verify file md5sums as they are tarred')
+    parser.add_argument('--checksums', default='md5,adler32', action='store',
+                        help='Comma separated list of checksums (md5, adler32, sha256, xxhash) to calculate while writing the tar files, the adler32 of tape tars is checked after they are transferred. DEFAULT: %(default)s')
     parser.add_argument('--verbose', '-v', default=False, action='store_true',
                         help='Turn on verbose mode. Default: %default')
     parser.add_argument('--class', action='store',
                         help='Select a specific class to process')
+    parser.add_argument('--workers', default=1, type=int, action='store',
+                        help='Number of unit tars to generate concurrently. DEFAULT: %(default)s')
+    parser.add_argument('--compression', default='none', action='store',
+                        help='Compression of the unit tars, either a codec (gzip, zstd, lz4, none) with an optional :level for all classes, or a comma separated list of class=codec[:level]. Directories which are mostly compressed files are never compressed. DEFAULT: %(default)s')
+    parser.add_argument('--compress_threads', default=0, type=int, action='store',
+                        help='Number of threads to use for zstd compression, 0 compresses in the main thread. DEFAULT: %(default)s')
+    parser.add_argument('--dedup', default=False, action='store_true',
+                        help='Archive files whose contents are already on tape as references to the earlier copy, rather than archiving the contents again.')
+    parser.add_argument('--binpack', default=False, action='store_true',
+                        help='Plan which directories go in to which tape tars before tarring, so that the tape tars are within the tolerance of the archive size, rather than filling them in release date order.')
+    parser.add_argument('--plan', default=False, action='store_true',
+                        help='Print the tape tar plan which --binpack would use, and exit without tarring anything.')
+    parser.add_argument('--tolerance', default=0.05, type=float, action='store',
+                        help='Allowed fractional difference of the tape tar size from the archive size when planning. DEFAULT: %(default)s')
+    parser.add_argument('--stream', default=False, action='store_true',
+                        help='Write unit tars directly into the tape tar, rather than to the staging directory first. Unit tars are generated one at a time in this mode.')
+    parser.add_argument('--checkpoint', default='1g', action='store',
+                        help='Amount of data to write between checkpoints of tar files, so that an interrupted run resumes from the last checkpoint. Use 0b to turn off checkpointing. DEFAULT: %(default)s')
+    parser.add_argument('--order', default='name', choices=bu.ORDERS, action='store',
+                        help='Order to write the files of each directory in: name, inode number, or physical location on disk (extent). DEFAULT: %(default)s')
+    parser.add_argument('--prefetch_threads', default=4, type=int, action='store',
+                        help='Number of threads reading files ahead of them being tarred, with --verify the threads also md5sum the files in parallel. 0 turns off reading ahead. DEFAULT: %(default)s')
+    parser.add_argument('--prefetch_depth', default=16, type=int, action='store',
+                        help='Maximum number of files to read ahead. DEFAULT: %(default)s')
+    parser.add_argument('--prefetch_memory', default='256m', action='store',
+                        help='Maximum amount of data read ahead to hold in memory. DEFAULT: %(default)s')
+    parser.add_argument('--checksum_cache', default='/local_big/backups/checksum_cache.db', action='store',
+                        help='File holding the md5sums of files already checked, so that unchanged files are not md5summed again. DEFAULT: %(default)s')
+    parser.add_argument('--checksum_cache_size', default=10000000, type=int, action='store',
+                        help='Maximum number of md5sums to keep in the checksum cache. DEFAULT: %(default)s')
+    parser.add_argument('--no_checksum_cache', default=False, action='store_true',
+                        help='Do not use the checksum cache, every file is md5summed')
     return vars(parser.parse_args())
 
+def get_file_data(cur, path):
+    """ Method to get the size and md5sum of the files in a directory, and its subdirectories,
+        from the database
+
+        Parameters
+        ----------
+        cur : cursor object
+        path : str
+            The path of the directory, relative to the archive root
+
+        Returns
+        -------
+        dict of the file sizes and md5sums, keyed by file name
+    """
+    bu.execute(cur, "select t1.filename,t1.filesize,t1.md5sum,t2.compression from desfile t1, file_archive_info t2 where t1.filename = t2.filename and (t2.path=:1 or t2.path like :2 escape '\\') and ((t1.compression is null and t2.compression is null) or t1.compression = t2.compression)",
+               [path, bu.like_escape(path) + '/%'])
+    listing = cur.fetchall()
+    data = {}
+    for lst in listing:
+        if lst[3] is not None:
+            data[lst[0] + lst[3]] = [lst[1], lst[2]]
+        else:
+            data[lst[0]] = [lst[1], lst[2]]
+    return data
+
+def add_references(cur, path, data):
+    """ Method to find files in a directory whose contents, by md5sum and size, are already on tape.
+        The unit tar and member name holding the contents are added to the file info.
+
+        Parameters
+        ----------
+        cur : cursor object
+        path : str
+            The path of the directory, relative to the archive root
+        data : dict
+            The file info from get_file_data, keyed by file name
+
+        Returns
+        -------
+        int, the number of files found
+    """
+    bu.execute(cur, "select t1.filename,t2.compression,c.unit_name,c.member from desfile t1, file_archive_info t2, backup_content c, backup_unit u where t1.filename = t2.filename and (t2.path=:1 or t2.path like :2 escape '\\') and ((t1.compression is null and t2.compression is null) or t1.compression = t2.compression) and c.md5sum=t1.md5sum and c.file_size=t1.filesize and u.name=c.unit_name and u.status=1 and u.deprecated=0",
+               [path, bu.like_escape(path) + '/%'])
+    listing = cur.fetchall()
+    count = 0
+    for lst in listing:
+        if lst[1] is not None:
+            name = lst[0] + lst[1]
+        else:
+            name = lst[0]
+        if name in data and len(data[name]) == 2:
+            data[name].append((lst[2], lst[3]))
+            count += 1
+    return count
+
+def add_backup_paths(cur, path):
+    """ Method to record the tape paths of the files in a pipeline directory
+
+        Parameters
+        ----------
+        cur : cursor object
+        path : str
+            The path of the directory, relative to the archive root
+    """
+    bu.execute(cur, "select pfw_attempt_id from backup_dir where path=:1", [path])
+    res = cur.fetchone()
+    if not res:
+        raise Exception("Could not find pfw_attempt_id for path %s" % (path))
+
+    pfwid = res[0]
+    bu.execute(cur, 'select df.id,fai.path from desfile df, file_archive_info fai where df.id=fai.desfile_id and df.pfw_attempt_id=:1', [pfwid])
+    afiles = cur.fetchall()
+    data = []
+    for fln in afiles:
+        data.append({'desfile_id': fln[0], 'spinning_archive_path': fln[1], 'tape_path': fln[1]})
+    try:
+        bu.executemany(cur, 'insert into friedel.backup_path (desfile_id, spinning_archive_path, tape_path) values (:desfile_id,:spinning_archive_path,:tape_path)', data)
+        cur.execute('commit')
+    except:
+        print "Could not add path info to backup_path"
+        raise
+
+def make_job(util, cur, args, path):
+    """ Method to gather the information needed to tar a directory
+
+        Parameters
+        ----------
+        util : Util class
+        cur : cursor object
+        args : dict
+            Command line arguments
+        path : str
+            The path of the directory, relative to the archive root
+
+        Returns
+        -------
+        Tuple containing the path, the dictionary of file info, and the archive root
+    """
+    util.log(bu.Util.info, " ==> Processing %s" % (os.path.join(util.root, path)))
+    data = get_file_data(cur, path)
+    if args['dedup']:
+        count = add_references(cur, path, data)
+        if count:
+            util.log(bu.Util.info, " ==> %i files are already on tape and will be archived as references" % (count))
+    return (path, data, util.root)
+
+def tar_jobs(util, cur, archive, jobs, workers):
+    """ Method to tar a list of directories in to an archive, and record the tape paths of the
+        files of those which were tarred. A directory which fails its checks is logged and
+        skipped.
+
+        Parameters
+        ----------
+        util : Util class
+        cur : cursor object
+        archive : DES_archive instance
+        jobs : list
+            List of tuples from make_job
+        workers : int
+            The number of unit tars to generate concurrently
+
+        Returns
+        -------
+        list of the paths which were tarred
+    """
+    if workers > 1:
+        done = archive.make_directory_tars_parallel(jobs, workers)
+    else:
+        done = []
+        for job in jobs:
+            try:
+                archive.make_directory_tar(*job)
+            except bu.ChecksumError, ex:
+                util.log(bu.Util.error, str(ex))
+                continue
+            done.append(job[0])
+    for path in done:
+        util.log(bu.Util.info, " ==> Processing complete: %s" % (os.path.join(util.root, path)))
+        if archive.file_class != 'RAW':
+            add_backup_paths(cur, path)
+    return done
+
+def park_archives(archive):
+    """ Method to close any tape tars being streamed into, so they can be picked up by the next run
+
+        Parameters
+        ----------
+        archive : dict
+            The DES_archive instances, keyed by class
+    """
+    for arch in archive.itervalues():
+        arch.park()
+
+def queued_dirs(archive):
+    """ Method to get the directories which have been tarred, but whose catalog updates are
+        still held back until their tape tar is written, so are still marked as to do in
+        BACKUP_DIR
+
+        Parameters
+        ----------
+        archive : dict
+            The DES_archive instances, keyed by class
+
+        Returns
+        -------
+        set of the paths of the directories
+    """
+    queued = set()
+    for arch in archive.itervalues():
+        queued.update([upd['dirname'] for upd in arch.pending])
+    return queued
+
 def archive_files(util, args):
     """ Method to archive data files
 
@@ -58,18 +267,19 @@ def archive_files(util, args):
     archive = {}
     maximum_archive_size = bu.calculate_archive_size(args['archive_size'])
     while level <= int(args['max_pri']):
-        if not util.ping():
-            util.reconnect()
         cur = util.cursor()
-        sql = "select PATH,CLASS from BACKUP_DIR where STATUS=0 and RELEASE_DATE <= TO_DATE('%s', 'YYYY-MM-DD HH24:MI:SS') " % (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        sql = "select PATH,CLASS from BACKUP_DIR where STATUS=0 and RELEASE_DATE <= TO_DATE(:1, 'YYYY-MM-DD HH24:MI:SS') "
+        params = [datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')]
         if args['class']:
-            sql += "and class='%s' " % (args['class'])
+            sql += "and class=:2 "
+            params.append(args['class'])
         else:
-            sql += "and PRIORITY=%i" % (level)
+            sql += "and PRIORITY=:2 "
+            params.append(level)
         sql += "order by RELEASE_DATE DESC"
-        cur.execute(sql)
-
-        dirs = cur.fetchall()
+        # leave out the directories already tarred in an earlier pass
+        queued = queued_dirs(archive)
+        dirs = [ddir for ddir in util.query(sql, params) if ddir[0] not in queued]
         count = len(dirs)
         # force the processing if requested
         if count == 0 and args['forcex']:
@@ -93,78 +303,34 @@ def archive_files(util, args):
                         classes[ddir[1]] = []
             for clss, fls in classes.iteritems():
                 restart = False
-                if clss in archive:
-                    del archive[clss]
-                archive[clss] = DES_archive(args, util, clss, level)
+                # in stream mode the tape tar is kept open between passes, rather than being
+                # reopened by a new instance
+                if clss in archive and args['stream']:
+                    archive[clss].priority = level
+                else:
+                    if clss in archive:
+                        del archive[clss]
+                    archive[clss] = DES_archive(args, util, clss, level)
                 if archive[clss].archive_size >= maximum_archive_size:
                     archive[clss].generate()
                     del archive[clss]
                     archive[clss] = DES_archive(args, util, clss, level)
 
-                for path in fls:
+                workers = int(args['workers'])
+                if args['stream']:
+                    workers = 1
+                idx = 0
+                while idx < len(fls):
                     restart = False
-                    dfullpath = os.path.join(util.root, path)
-                    util.log(bu.Util.info, " ==> Processing %s" % (dfullpath))
-                    cur.execute("select t1.filename,t1.filesize,t1.md5sum,t2.compression from desfile t1, file_archive_info t2 where t1.filename = t2.filename and t2.path='%s' and ((t1.compression is null and t2.compression is null) or t1.compression = t2.compression)" % (path))
-                        #cur.execute("select * from opm_artifact inner join file_archive_info on opm_artifact.NAME = file_archive_info.filename where file_archive_info.path='%s'" % (path))
-                    listing = cur.fetchall()
-                    data = {}
-                    for lst in listing:
-                        if lst[3] is not None:
-                            data[lst[0] + lst[3]] = [lst[1], lst[2]]
-                        else:
-                            data[lst[0]] = [lst[1], lst[2]]
-                    if args['verify']:
-                        util.log(bu.Util.info, " ==> Checking md5sums of files")
-                        #print Util.root
-                        for dirpath, dirs, files in os.walk(os.path.join(util.root, path)):
-                            error = False
-                            for fname in files:
-                                fullpath = os.path.join(dirpath, fname)
-                                if fname in data:
-                                    #a = time.time()
-                                    md5 = bu.generate_md5sum(fullpath)
-                                    #b = time.time()
-                                    #total += b - a
-                                    if md5 != data[fname][1]:
-                                        util.log(bu.Util.error, "Incorrect md5sum in database for %s, it is listed as %s but is %s." % (fullpath, md5, data[fname][1]))
-                                        # then we have an issue
-                                        error = True
-                                        break
-                                else:
-                                    size = os.path.getsize(fullpath)
-                                    if size > 10*(1024**2):
-                                        util.log(bu.Util.error, "Unexpected file too large to archive: %s" % (fullpath))
-                                        error = True
-                                        break
-                                    else:
-                                        data[fname] = [size, bu.generate_md5sum(fullpath)]
-                            if error:
-                                break
-                        if error:
-                            break
-                        util.log(bu.Util.info, " ==> Check complete")
-                    archive[clss].make_directory_tar(path, data, util.root)
-                    util.log(bu.Util.info, " ==> Processing complete: %s" % (dfullpath))
-                    if clss != 'RAW':
-                        cur.execute("select pfw_attempt_id from backup_dir where path='%s'" % (path))
-                        res = cur.fetchone()
-                        if not res:
-                            raise Exception("Could not find pfw_attempt_id for path %s" % (path))
-
-                        pfwid = res[0]
-                        cur.execute('select df.id,fai.path from desfile df, file_archive_info fai where df.id=fai.desfile_id and df.pfw_attempt_id=%i' % (pfwid))
-                        afiles = cur.fetchall()
-                        data = []
-                        for fln in afiles:
-                            data.append({'desfile_id': fln[0], 'spinning_archive_path': fln[1], 'tape_path': fln[1]})
-                        try:
-                            cur.prepare('insert into friedel.backup_path (desfile_id, spinning_archive_path, tape_path) values (:desfile_id,:spinning_archive_path,:tape_path)')
-                            cur.executemany(None, data)
-                            cur.execute('commit')
-                        except:
-                            print "Could not add path info to backup_path"
-                            raise
+                    # with more than one worker, gather the directories expected to fill the
+                    # current tape tar so they can be tarred concurrently
+                    jobs = []
+                    expected = archive[clss].archive_size
+                    while idx < len(fls) and (not jobs or (workers > 1 and expected < maximum_archive_size)):
+                        jobs.append(make_job(util, cur, args, fls[idx]))
+                        idx += 1
+                        expected += estimate_tar_size(jobs[-1][1])
+                    tar_jobs(util, cur, archive[clss], jobs, workers)
 
                     if archive[clss].archive_size >= maximum_archive_size:
                         archive[clss].generate()
@@ -172,6 +338,7 @@ def archive_files(util, args):
                         restart = True
                         archive[clss] = DES_archive(args, util, clss, level)
                     if not util.checkfreespace(args['stgdir']):
+                        park_archives(archive)
                         return
                     if restart:
                         break
@@ -191,6 +358,45 @@ def archive_files(util, args):
                 level = 100
         else:
             level += 1
+    park_archives(archive)
+
+def archive_planned(util, args):
+    """ Method to archive data files, with the directories assigned to tape tars in advance by
+        the bin packing planner. Tape tars are generated as soon as their directories are tarred,
+        planned tape tars which are not yet full are left for a later run, unless forcex is set.
+
+        Parameters
+        ----------
+        util : Util class
+        args : dict
+            Command line arguments
+    """
+    target = bu.calculate_archive_size(args['archive_size'])
+    tolerance = float(args['tolerance'])
+    workers = int(args['workers'])
+    if args['stream']:
+        workers = 1
+    cur = util.cursor()
+    candidates = bp.get_candidates(cur, args['max_pri'], args['class'])
+    for clss in sorted(candidates.keys()):
+        tapes = bp.plan_tapes(candidates[clss], target, tolerance, bp.get_staged_size(cur, clss))
+        print bp.format_plan(clss, tapes, target, tolerance)
+        if args['plan']:
+            continue
+        for tape in tapes:
+            if not tape['complete'] and not args['forcex']:
+                util.log(bu.Util.info, "Leaving %i directories of class %s for a later run" % (len(tape['paths']), clss))
+                break
+            archive = DES_archive(args, util, clss, tape['priority'] or 1)
+            jobs = []
+            for path in tape['paths']:
+                jobs.append(make_job(util, cur, args, path))
+            tar_jobs(util, cur, archive, jobs, workers)
+            if archive.archive_size > 0:
+                archive.generate()
+            if not util.checkfreespace(args['stgdir']):
+                archive.park()
+                return
 
 def main():
     """ Main entry
@@ -198,13 +404,19 @@ def main():
     args = parse_options()
     if args['debug']:
         pprint.pprint(args)
-    util = bu.Util(args['des_services'], args['section'], "/local_big/backups/logs/backup.log", "BACKUP", reqfree=bu.calculate_archive_size(args['free']))
+    util = bu.get_util(args['des_services'], args['section'], "/local_big/backups/logs/backup.log", "BACKUP", reqfree=bu.calculate_archive_size(args['free']))
     #util.connect(options.desdm, options.db)
-    if not util.checkfreespace(args['stgdir']):
+    if not args['plan'] and not util.checkfreespace(args['stgdir']):
         sys.exit()
+    if not args['no_checksum_cache']:
+        bu.set_checksum_cache(args['checksum_cache'], args['checksum_cache_size'])
     try:
         util.log(bu.Util.info, "Starting backup processing")
-        archive_files(util, args)
+        if args['binpack'] or args['plan']:
+            archive_planned(util, args)
+        else:
+            archive_files(util, args)
+        util.log(bu.Util.info, "Database statements: %(parses)i parsed, %(executes)i executed" % bu.get_statement_stats())
     except Exception, ex:
         util.log(bu.Util.error, "Exception raised: " + str(ex))
         raise
@@ -36,13 +36,21 @@ def parse_options():
     parser.add_argument('--forcex', default=False, action='store_true',
                         help='Force the transfer of data, even if the minimum size is not met. DEFAULT:%default')
     parser.add_argument('--des_services', action='store',
-                        help='DESDM Database Access File: %default',)
+                        help='DESDM Database Access File, or sqlite:<file> to use a local database: %default',)
     parser.add_argument('--section', action='store',
                         help='Database to use',)
     parser.add_argument('--verify', default=False, action='store_true',
                         help='Verify file md5sums, this can take a while')
+    parser.add_argument('--checksums', default='md5', action='store',
+                        help='Comma separated list of checksums (md5, adler32, sha256, xxhash) to calculate while writing the tar files. DEFAULT: %(default)s')
     parser.add_argument('--verbose', '-v', default=False, action='store_true',
                         help='Turn on verbose mode. Default: %default',)
+    parser.add_argument('--checksum_cache', default='/local_big/backups/checksum_cache.db', action='store',
+                        help='File holding the md5sums of files already checked, so that unchanged files are not md5summed again. DEFAULT: %(default)s')
+    parser.add_argument('--checksum_cache_size', default=10000000, type=int, action='store',
+                        help='Maximum number of md5sums to keep in the checksum cache. DEFAULT: %(default)s')
+    parser.add_argument('--no_checksum_cache', default=False, action='store_true',
+                        help='Do not use the checksum cache, every file is md5summed')
     return vars(parser.parse_args())
 
 
@@ -61,14 +69,14 @@ def archive_files(util, args):
     maximum_archive_size = bu.calculate_archive_size(args['archive_size'])
     cur = util.cursor()
     start = datetime.datetime.now() - datetime.timedelta(days=7)
-    cur.execute("select distinct(PATH),run_date from BACKUP_DB where STATUS=0 and run_date <= TO_DATE('%s', 'YYYY-MM-DD HH24:MI:SS') order by run_date" % (start.strftime('%Y-%m-%d %H:%M:%S')))
+    bu.execute(cur, "select distinct(PATH),run_date from BACKUP_DB where STATUS=0 and run_date <= TO_DATE(:1, 'YYYY-MM-DD HH24:MI:SS') order by run_date", [start.strftime('%Y-%m-%d %H:%M:%S')])
 
     dirs = cur.fetchall()
     count = len(dirs)
     if count > 0:
         for dirn in dirs:
             dirname = dirn[0]
-            cur.execute("select filename,run_date from backup_DB where path='%s' and status=0" % (dirname))
+            bu.execute(cur, "select filename,run_date from backup_DB where path=:1 and status=0", [dirname])
             subname = ""
             if "desoper" in dirname:
                 subname = "-oper"
@@ -83,9 +91,8 @@ def archive_files(util, args):
             fnum = 0
             data = {}
             for i, fname in enumerate(fls):
-                if not util.ping():
-                    util.reconnect()
-                    cur = util.cursor()
+                # a new cursor, the connection is checked if it has been idle while zipping
+                cur = util.cursor()
 
                 rundate = fname[1]
                 util.log(bu.Util.info, "zipping " + fname[0])
@@ -95,16 +102,17 @@ def archive_files(util, args):
                 with open(fpath, 'rb') as f_in, gzip.open(os.path.join(args['stgdir'], zipfile), 'wb', compresslevel=1) as f_out:
                     shutil.copyfileobj(f_in, f_out)
                 size = os.path.getsize(os.path.join(args['stgdir'], zipfile))
-                files.append(fname + '.gz')
+                files.append(zipfile)
                 if args['verify']:
-                    data[fname] = [None, bu.generate_md5sum(fname)]
+                    # keyed by the name of the member written to the tar file
+                    data[zipfile] = [size, bu.generate_md5sum(os.path.join(args['stgdir'], zipfile))]
                 sizes += size
                 if sizes >= maximum_archive_size or i == len(fls) - 1:
                     util.log(bu.Util.info, "Working bin")
                     #archive = DES_archive(options, util, 'DB', 0)
                     flist = []
                     #print type(rundate)
-                    cur.execute("select name from prod.backup_unit where name like '%%DB_BACKUP2_%s%s%%'" % (str(rundate.date()), subname))
+                    bu.execute(cur, "select name from prod.backup_unit where name like :1", ['%%DB_BACKUP2_%s%s%%' % (str(rundate.date()), subname)])
                     results = cur.fetchall()
                     print fnum, len(results), str(rundate.date()), subname
                     if fnum == 0 and len(results) != 0:
@@ -116,24 +124,23 @@ def archive_files(util, args):
 
                     for fln in files:
                         #archive.add_file(os.path.join(options.stgdir, fln + ".gz"))
-                        flist.append((fln.replace('.gz',''),))
+                        flist.append((archive.tarfile, dirname, fln.replace('.gz','')))
                         print fln
                         os.remove(os.path.join(args['stgdir'], fln))
 
                     md5sum = archive.get_md5sum()
                     tsize = archive.get_filesize()
                     util.log(bu.Util.info, "DB work")
-                    print "insert into BACKUP_UNIT (NAME,DEPRECATED,TAR_SIZE,MD5SUM,CREATED_DATE,FILE_TYPE,STATUS) values ('%s',0,%i,'%s',TO\
-_DATE('%s', 'YYYY-MM-DD HH24:MI:SS'),'%s',2)" % (archive.tarfile, tsize, md5sum, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'DB%s' % subname)
-                    cur.execute("insert into BACKUP_UNIT (NAME,DEPRECATED,TAR_SIZE,MD5SUM,CREATED_DATE,FILE_TYPE,STATUS) values ('%s',0,%i,'%s',TO_DATE('%s', 'YYYY-MM-DD HH24:MI:SS'),'%s',2)" % (archive.tarfile, tsize, md5sum, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'DB%s' % subname))
-                    qry = "update BACKUP_DB set UNIT_NAME='%s',STATUS=1 where PATH='%s' and filename=:1" % (archive.tarfile, dirname)
-                    cur.prepare(qry)
-                    cur.executemany(None, flist)
+                    params = [archive.tarfile, tsize, md5sum, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'DB%s' % subname]
+                    print "Adding unit tar %s" % (params)
+                    bu.execute(cur, "insert into BACKUP_UNIT (NAME,DEPRECATED,TAR_SIZE,MD5SUM,CREATED_DATE,FILE_TYPE,STATUS) values (:1,0,:2,:3,TO_DATE(:4, 'YYYY-MM-DD HH24:MI:SS'),:5,2)", params)
+                    bu.executemany(cur, "update BACKUP_DB set UNIT_NAME=:1,STATUS=1 where PATH=:2 and filename=:3", flist)
                     shutil.move(os.path.join(args['stgdir'], archive.tarfile), os.path.join(args['xferdir'], archive.tarfile))
-                    cur.execute("update backup_unit set status=1,tape_tar='%s' where name='%s'" % (archive.tarfile, archive.tarfile))
-                    sql = "insert into BACKUP_TAPE (NAME,TAR_SIZE,CREATED_DATE,MD5SUM,RETRIES,STATUS,PATH,DEPRECATED,PRIORITY,FILE_TYPE) values ('%s',%i,TO_DATE('%s', 'YYYY-MM-DD HH24:MI:SS'),'%s',0,0,'%s',0,%i, '%s')" % (archive.tarfile, tsize, now.strftime('%Y-%m-%d %H:%M:%S'), md5sum, args['xferdir'], 1, 'DB%s' % subname)
-                    print sql
-                    cur.execute(sql)
+                    bu.execute(cur, "update backup_unit set status=1,tape_tar=:1 where name=:2", [archive.tarfile, archive.tarfile])
+                    params = [archive.tarfile, tsize, now.strftime('%Y-%m-%d %H:%M:%S'), md5sum, args['xferdir'], 1, 'DB%s' % subname]
+                    print "Adding tape tar %s" % (params)
+                    bu.execute(cur, "insert into BACKUP_TAPE (NAME,TAR_SIZE,CREATED_DATE,MD5SUM,RETRIES,STATUS,PATH,DEPRECATED,PRIORITY,FILE_TYPE) values (:1,:2,TO_DATE(:3, 'YYYY-MM-DD HH24:MI:SS'),:4,0,0,:5,0,:6,:7)", params)
+                    bu.update_summary(cur, [('UNIT', 'DB%s' % subname, 1, 1, tsize), ('TAPE', 'DB%s' % subname, 0, 1, tsize)])
                     cur.execute('commit')
                     #util.reconnect()
                     #cur = util.conn.cursor()
@@ -146,7 +153,7 @@ def main():
     args = parse_options()
     if args['debug']:
         pprint.pprint(args)
-    util = bu.Util(args['des_services'], args['section'], "/local_big/backups/logs/backup_db.log", "BACKUPDB", reqfree=bu.calculate_archive_size(args['free']))
+    util = bu.get_util(args['des_services'], args['section'], "/local_big/backups/logs/backup_db.log", "BACKUPDB", reqfree=bu.calculate_archive_size(args['free']))
     #util.connect(options.desdm, options.db)
     #freespace = calc_free_space(options.stgdir)
     #reqfree = calculate_archive_size(options.free)
@@ -157,6 +164,8 @@ def main():
     #    sys.exit()
     #else:
     #    Util.log(Util.info,"Free space: %i / %i" % (freespace,reqfree))
+    if not args['no_checksum_cache']:
+        bu.set_checksum_cache(args['checksum_cache'], args['checksum_cache_size'])
     try:
         #print "starting archive"
         archive_files(util, args)
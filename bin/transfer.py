@@ -6,8 +6,12 @@ import os
 import time
 import datetime
 import pprint
+import shutil
 import argparse
-from XRootD import client
+try:
+    from XRootD import client
+except ImportError:
+    client = None
 
 import archivetools.backup_util as bu
 
@@ -34,11 +38,11 @@ def parse_options():
     parser.add_argument('--stgdir', default="/local/Staging",
                         help='DESAR Staging Directory DEFAULT:%default',)
     parser.add_argument('--xfer_method', default="xrootd",
-                        help='Mass Storage Transfer Mechanism: %default',)
+                        help='Mass Storage Transfer Mechanism (xrootd, copy, rsync, srmcp, gridftp, gridftpdebug), copy copies to a local directory given by --mssdir: %(default)s',)
     parser.add_argument('--noftp', default=False, action='store_true',
                         help='Skip transfer to mass storage',)
     parser.add_argument('--des_services',
-                        help='DESDM Database Access File: %default',)
+                        help='DESDM Database Access File, or sqlite:<file> to use a local database: %default',)
     parser.add_argument('--section', action='store',
                         help='Database to use',)
     parser.add_argument('--verbose', '-v', default=False, action='store_true',
@@ -63,6 +67,22 @@ class Transfer(object):
         self.server = args['server']
         self.tries = 0
 
+    def check_adler32(self, name, expected, actual):
+        """ Method to compare the adler32 of a transferred file with that of the original
+
+            Parameters
+            ----------
+            name : str
+                The name of the file
+            expected : str
+                The adler32 of the original
+            actual : str
+                The adler32 of the transferred file
+        """
+        if expected.lower().lstrip('0') != actual.lower().lstrip('0'):
+            self.util.log(bu.Util.error, "Checksum mismatch for %s: %s != %s" % (name, actual, expected))
+            raise Exception("Checksum mismatch for %s: %s != %s" % (name, actual, expected))
+
     def transfer(self):
         """ Method to do the transfer
         """
@@ -70,18 +90,19 @@ class Transfer(object):
         self.tries += 1
         while level <= int(self.args['max_pri']):
             print level, int(self.args['max_pri'])
-            if not self.util.ping():
-                self.util.reconnect()
-
-            cur = self.util.cursor()
-            cur.execute("select NAME,PATH,TAR_SIZE from PROD.BACKUP_TAPE where STATUS=0 and PRIORITY=%i" % (level))
-            files = cur.fetchall()
+            files = self.util.query("select NAME,PATH,TAR_SIZE,ADLER32,FILE_TYPE from PROD.BACKUP_TAPE where STATUS=0 and PRIORITY=:1", [level])
             if len(files) > 0:
                 for fln in files:
                     archive_name = os.path.join(fln[1], fln[0])
                     subdir = bu.get_subdir(fln[0])
+                    adler32 = fln[3]
+                    if not adler32 and self.args['xfer_method'] in ('xrootd', 'copy'):
+                        # older tape tars have no stored adler32
+                        adler32 = bu.hash_file(archive_name, ['adler32'])['adler32']
 
                     if self.args['xfer_method'] == 'xrootd':
+                        if client is None:
+                            raise Exception("The XRootD python module is needed for xrootd transfers")
                         url = os.path.join(self.mss_dir, subdir, fln[0])
                         xrc = client.FileSystem(self.server)
                         self.util.log(bu.Util.info, "=> Transfering via {0}: ".format(self.args['xfer_method']))
@@ -100,7 +121,34 @@ class Transfer(object):
                             self.util.log(bu.Util.error, "Incomplete transfer")
                             print "Incomplete transfer %i" % (info.size)
                             raise SystemExit
-
+                        status, response = xrc.query(client.flags.QueryCode.CHECKSUM, url)
+                        if not status.ok:
+                            raise Exception('Checksum error: ' + status.message)
+                        # the response is of the form 'adler32 <checksum>'
+                        self.check_adler32(fln[0], adler32, response.strip('\x00').split()[-1])
+                        # the index of the tape tar goes alongside it
+                        if os.path.exists(archive_name + '.index'):
+                            status, info = xrc.copy(source=archive_name + '.index', target=self.server + url + '.index')
+                            if not status.ok:
+                                raise Exception('Transfer error: ' + status.message)
+
+                    elif self.args['xfer_method'] == 'copy':
+                        target = os.path.join(self.mss_dir, subdir, fln[0])
+                        self.util.log(bu.Util.info, "=> Transfering via {0}: ".format(self.args['xfer_method']))
+                        self.util.log(bu.Util.info, "=> {0} ".format(target))
+                        if not os.path.isdir(os.path.dirname(target)):
+                            os.makedirs(os.path.dirname(target))
+                        time1 = time.time()
+                        shutil.copyfile(archive_name, target)
+                        if os.path.exists(archive_name + '.index'):
+                            shutil.copyfile(archive_name + '.index', target + '.index')
+                        time2 = time.time()
+                        time_to_transfer = (time2 - time1)/3600
+                        if os.path.getsize(target) < fln[2]:
+                            self.util.log(bu.Util.error, "Incomplete transfer")
+                            print "Incomplete transfer %i" % (os.path.getsize(target))
+                            raise SystemExit
+                        self.check_adler32(fln[0], adler32, bu.hash_file(target, ['adler32'])['adler32'])
                     else:
                         srm_url = os.path.join(self.mss_dir, subdir, fln[0])
 
@@ -140,12 +188,13 @@ class Transfer(object):
 
                     self.util.log(bu.Util.info, "=> Removing: {0}".format(archive_name))
                     os.remove(archive_name)
-                    if not self.util.ping():
-                        self.util.reconnect()
+                    if os.path.exists(archive_name + '.index'):
+                        os.remove(archive_name + '.index')
                     cur = self.util.cursor()
-                    sql = "update PROD.BACKUP_TAPE set STATUS=1,TRANSFER_DATE=TO_DATE('%s', 'YYYY-MM-DD HH24:MI:SS'),TRANSFER_TIME=%f,RETRIES=%i where NAME='%s'" % (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), time_to_transfer, self.tries-1, fln[0])
-                    print sql
-                    cur.execute(sql)
+                    params = [datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), time_to_transfer, self.tries-1, fln[0]]
+                    print "Transferred %s" % (params)
+                    bu.execute(cur, "update PROD.BACKUP_TAPE set STATUS=1,TRANSFER_DATE=TO_DATE(:1, 'YYYY-MM-DD HH24:MI:SS'),TRANSFER_TIME=:2,RETRIES=:3 where NAME=:4", params)
+                    bu.update_summary(cur, [('TAPE', fln[4], 0, -1, -fln[2]), ('TAPE', fln[4], 1, 1, fln[2])])
                     #self.util.commit()
                     cur.execute('commit')
                     level = 1
@@ -167,7 +216,7 @@ def main():
     args = parse_options()
     if args['debug']:
         pprint.pprint(args)
-    util = bu.Util(args['des_services'], args['section'], "/local_big/backups/logs/transfer.log", "TRANSFER")
+    util = bu.get_util(args['des_services'], args['section'], "/local_big/backups/logs/transfer.log", "TRANSFER")
     #util.connect(options.desdm, options.db)
     util.log(bu.Util.info, "Starting transfer at %s" % (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
     xfer = Transfer(util, args)
@@ -176,6 +225,7 @@ def main():
             print 'start'
             xfer.transfer()
             print 'next'
+            util.log(bu.Util.info, "Database statements: %(parses)i parsed, %(executes)i executed" % bu.get_statement_stats())
             util.close()
             return
         except SystemExit:
@@ -2,11 +2,12 @@
 """ Method to find where a specific file is in the tape archive
 """
 
+import sys
 import pprint
 import argparse
 
 #import archivetools.backup_util as bu
-from archivetools.backup_util import Util, locate
+from archivetools.backup_util import Util, locate, locate_files
 
 
 def parse_options():
@@ -28,9 +29,101 @@ def parse_options():
     parser.add_argument('--pfwid', '-p', action='store', help='The pfw_attempt_id to find')
     parser.add_argument('--archive', action='store', default='desar2home', help='Name of the archive')
     parser.add_argument('--path', action='store', help='path to locate')
+    parser.add_argument('--filelist', action='store', help="File containing the names of files to look for, one per line, or - to read them from stdin. The files are looked up together and reported grouped by tape tar.")
     args = parser.parse_args()
     return vars(args)
 
+def read_filelist(filelist):
+    """ Method to read the names of the files to look for
+
+        Parameters
+        ----------
+        filelist : str
+            The file containing the names, one per line, or - for stdin. Blank lines and
+            lines starting with # are ignored.
+
+        Returns
+        -------
+        list of the file names
+    """
+    if filelist == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(filelist, 'r') as flh:
+            lines = flh.readlines()
+    names = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            names.append(line)
+    return names
+
+def format_date(date):
+    """ Method to format a date from the database
+
+        Parameters
+        ----------
+        date : datetime or str
+
+        Returns
+        -------
+        str, the day
+    """
+    if hasattr(date, 'strftime'):
+        return date.strftime("%Y-%m-%d")
+    return str(date)[:10]
+
+def format_report(results):
+    """ Method to generate a report of where many files are, grouped by tape tar and then
+        unit tar
+
+        Parameters
+        ----------
+        results : list
+            The location of each file, from locate_files
+
+        Returns
+        -------
+        str containing the report
+    """
+    tapes = {}
+    units = {}
+    notunit = []
+    notfound = []
+    for res in results:
+        if res['path'] is None:
+            notfound.append(res['filename'])
+        elif res['unit'] is None:
+            notunit.append(res['filename'])
+        else:
+            units.setdefault(res['unit'], (res, []))[1].append(res['filename'])
+            tapes.setdefault(res['tape'], (res, set()))[1].add(res['unit'])
+    lines = []
+    for tape in sorted([t for t in tapes if t is not None]):
+        res = tapes[tape][0]
+        if res['transdate'] is None:
+            lines.append("Tape Tar: %s  created on %s  not transferred yet" % (tape, format_date(res['tapedate'])))
+        else:
+            lines.append("Tape Tar: %s  created on %s  transferred on %s" % (tape, format_date(res['tapedate']), format_date(res['transdate'])))
+        for unit in sorted(tapes[tape][1]):
+            lines.append("  Unit Tar: %s  created on %s" % (unit, format_date(units[unit][0]['unitdate'])))
+            lines.extend(["    %s" % (name) for name in units[unit][1]])
+    if None in tapes:
+        lines.append("Not added to a Tape Tar yet")
+        for unit in sorted(tapes[None][1]):
+            lines.append("  Unit Tar: %s  created on %s" % (unit, format_date(units[unit][0]['unitdate'])))
+            lines.extend(["    %s" % (name) for name in units[unit][1]])
+    if notunit:
+        lines.append("Not added to a Unit Tar yet")
+        lines.extend(["    %s" % (name) for name in notunit])
+    if notfound:
+        lines.append("Not found in DESFILE")
+        lines.extend(["    %s" % (name) for name in notfound])
+    ontape = len([res for res in results if res['tape'] is not None])
+    lines.append("%i files: %i in %i Tape Tars, %i only in a Unit Tar, %i not in a Unit Tar yet, %i not found" % (len(results), ontape, len([t for t in tapes if t is not None]),
+                                                                                                                  len(results) - ontape - len(notunit) - len(notfound), len(notunit), len(notfound)))
+    return "\n".join(lines)
+
 def main():
     """ Main entry
     """
@@ -39,6 +132,9 @@ def main():
         pprint.pprint(args)
     util = Util(args['des_services'], args['section'])
     #util.connect(args['des_services'], args['section'])
+    if args['filelist']:
+        print format_report(locate_files(util, read_filelist(args['filelist'])))
+        return
     try:
         data = locate(util, args['filename'], args['reqnum'], args['unitname'],
                       args['attnum'], args['pfwid'], args['path'], args['archive'])
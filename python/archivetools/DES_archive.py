@@ -4,6 +4,8 @@ the mass storage system.
 
 """
 import os
+import tarfile
+import multiprocessing
 
 import datetime
 from time import strftime
@@ -11,6 +13,90 @@ import archivetools.backup_util as bu
 from archivetools.DES_tarball import DES_tarball
 
 
+# state shared with the worker processes of the parallel unit tar builder, it is set before
+# the pool is created so that it is inherited by the workers rather than pickled
+_POOL_STATE = {}
+# the attributes of a unit tar passed back from the worker processes
+UNIT_ATTRIBUTES = ('checksums', 'index', 'compression', 'contents', 'references')
+
+def estimate_tar_size(data):
+    """ Method to estimate the size of a tarball from the sizes of the files going in to it
+
+        Parameters
+        ----------
+        data : dict
+            Dictionary of file info, the first entry of each item is the file size
+
+        Returns
+        -------
+        int, the estimated size in bytes
+    """
+    size = 10240
+    for item in data.itervalues():
+        size += 1024 + (item[0] or 0)
+    return size
+
+def scan_tar(fileobj, expected):
+    """ Method to find how much of a, possibly incomplete, tar file can be kept. The members
+        are read in order until one is found which is truncated, or which is not expected.
+
+        Parameters
+        ----------
+        fileobj : file object
+            The tar file, opened for reading
+        expected : dict
+            The expected size of each member, keyed by name
+
+        Returns
+        -------
+        Tuple containing the list of TarInfo of the members to keep, and the offset of the end
+        of the last of them
+    """
+    filesize = os.fstat(fileobj.fileno()).st_size
+    kept = []
+    end = 0
+    try:
+        tar = tarfile.open(fileobj=fileobj, mode='r:')
+    except tarfile.ReadError:
+        return kept, end
+    while True:
+        try:
+            tarinfo = tar.next()
+        except tarfile.ReadError:
+            break
+        if tarinfo is None or tarinfo.offset_data + tarinfo.size > filesize:
+            break
+        if expected.get(tarinfo.name) != tarinfo.size:
+            break
+        kept.append(tarinfo)
+        end = tarinfo.offset_data + bu.padded_size(tarinfo.size)
+    return kept, end
+
+def _build_unit_tar(job):
+    """ Method, run in a worker process, to generate a single unit tarball
+
+        Parameters
+        ----------
+        job : tuple
+            The directory name, the dictionary of file info, and the full path to the directory
+
+        Returns
+        -------
+        dict of the attributes of the tarball which are needed to add it to the archive and
+        the database
+    """
+    args = _POOL_STATE['args']
+    dirname, data, path = job
+    mytar = DES_tarball(args, [dirname], data, _POOL_STATE['util'], path,
+                        file_class=_POOL_STATE['file_class'], check_members=args.get('verify', False))
+    result = {'tarfile': mytar.tarfile,
+              'tar_size': mytar.tar_size,
+              'md5sum': mytar.md5sum}
+    for key in UNIT_ATTRIBUTES:
+        result[key] = getattr(mytar, key)
+    return result
+
+
 class DES_archive(object):
     """ Class to create and archive tar ball
 
@@ -27,6 +113,9 @@ class DES_archive(object):
                 The class of data being processed
             priority : int
                 The priority of the data
+            verify : bool
+                If True then verify the md5sums of the unit tars in the tape tar after it is written
+                (Default is False)
         """
         # Store Variables
         self.args = args
@@ -39,8 +128,22 @@ class DES_archive(object):
         self.dir_list = []
         self.util = util
         self.archive_md5 = None
+        # all checksums of the tape tar calculated while it was written, keyed by name
+        self.archive_checksums = {}
         self.tarfile = None
         self.verify = verify
+        # in stream mode the unit tars are written directly into the tape tar, rather than to
+        # the staging directory, only unit tars already on the staging directory are staged
+        self.stream = args.get('stream', False)
+        self.staged = []
+        self.tape_tar = None
+        self.tape_writer = None
+        # the header offset, data offset, and size of each unit tar in the tape tar
+        self.tape_index = {}
+        # the catalog updates of the unit tars which have not been sent to the database yet,
+        # they are sent together with the tape tar, and logged to disk until then
+        self.pending = []
+        self.pending_log = bu.UpdateLog(self.xfer_dir, self.project + "_" + self.file_class + ".pending")
 
         # Calculate timestamp
         self.timestamp = strftime("%Y%m%d_%H%M%S")
@@ -78,15 +181,97 @@ class DES_archive(object):
             -------
             str containing the name of the tar file
         """
+        tape_tar = None
+        if self.stream and size == 0:
+            self.open_tape()
+            tape_tar = self.tape_tar
         mytar = DES_tarball(self.args, [dirname], data, self.util, path, size,
-                            md5sum, self.file_class)
+                            md5sum, self.file_class, check_members=self.args.get('verify', False),
+                            tape_tar=tape_tar)
         self.dir_list.append(mytar)
         self.archive_size += mytar.tar_size
         if size == 0:
-            if not self.util.ping():
-                self.util.reconnect()
+            if tape_tar is not None:
+                self.update_db_unit(mytar, dirname, 3, self.archive_base)
+            else:
+                self.update_db_unit(mytar, dirname)
+
+    def make_directory_tars_parallel(self, jobs, workers):
+        """ Method to generate the tarballs of several directories concurrently, using a pool of
+            worker processes. The number of tarballs being written at once is limited by the
+            number of workers and by the free space in the staging directory. The tarballs are
+            added to the archive, and the database, in the order they were given.
 
-            self.update_db_unit(mytar, dirname)
+            Parameters
+            ----------
+            jobs : list
+                List of tuples containing the directory name, the dictionary of file info, and
+                the full path of each directory to tar
+            workers : int
+                The maximum number of tarballs to generate at once
+
+            Returns
+            -------
+            list of the directory names which were successfully tarred
+        """
+        _POOL_STATE['args'] = self.args
+        _POOL_STATE['util'] = self.util
+        _POOL_STATE['file_class'] = self.file_class
+        pool = multiprocessing.Pool(workers)
+        pending = []
+        inflight = 0
+        done = []
+        try:
+            for job in jobs:
+                est = estimate_tar_size(job[1])
+                # wait for running tars to finish if there are no free workers, or if the staging
+                # area cannot hold this tar on top of those already being written
+                while pending and (len(pending) >= workers or
+                                   self.util.getfreespace(self.stage_dir) - self.util.reqfree - inflight < est):
+                    dirname, pest, result = pending.pop(0)
+                    inflight -= pest
+                    self.collect_unit_tar(dirname, result, done)
+                if self.util.getfreespace(self.stage_dir) - self.util.reqfree < est:
+                    self.util.log(bu.Util.warn, "Not enough free space in %s to tar %s, stopping." % (self.stage_dir, job[0]))
+                    break
+                pending.append((job[0], est, pool.apply_async(_build_unit_tar, (job,))))
+                inflight += est
+            while pending:
+                dirname, _, result = pending.pop(0)
+                self.collect_unit_tar(dirname, result, done)
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.close()
+            pool.join()
+        return done
+
+    def collect_unit_tar(self, dirname, result, done):
+        """ Method to wait for a unit tarball from the parallel builder and add it to the archive
+
+            Parameters
+            ----------
+            dirname : str
+                The name of the directory which was tarred
+            result : AsyncResult
+                The pending result of _build_unit_tar
+            done : list
+                List of the directories successfully tarred, dirname is appended on success
+        """
+        try:
+            attributes = result.get()
+        except bu.ChecksumError, ex:
+            self.util.log(bu.Util.error, str(ex))
+            return
+        mytar = DES_tarball(self.args, [], attributes['tarfile'], self.util, "", attributes['tar_size'],
+                            attributes['md5sum'], self.file_class)
+        for key in UNIT_ATTRIBUTES:
+            setattr(mytar, key, attributes[key])
+        self.dir_list.append(mytar)
+        self.archive_size += mytar.tar_size
+        self.update_db_unit(mytar, dirname)
+        done.append(dirname)
 
     def make_directory_tars(self, dirs):
         """ Method to generate multiple tarballs of directories
@@ -99,63 +284,266 @@ class DES_archive(object):
         for ddir in dirs:
             self.make_directory_tar("", ddir[0], "", ddir[1], ddir[2])
 
+    def open_tape(self):
+        """ Method to open the tape tar for streaming unit tars in to. If the tape tar already
+            exists, from an earlier run, then it is reopened and anything after the last of the
+            unit tars in dir_list is removed.
+
+            Returns
+            -------
+            list of the names of the unit tars kept from the existing tape tar
+        """
+        if self.tape_tar is not None:
+            return [tinfo.name for tinfo in self.tape_tar.members]
+        kept = []
+        algorithms = bu.get_checksum_list(self.args.get('checksums'))
+        if os.path.exists(self.archive_name):
+            expected = {}
+            for idx in self.dir_list:
+                if idx.tarfile not in self.staged:
+                    expected[idx.tarfile] = idx.tar_size
+            flh = open(self.archive_name, 'r+b')
+            kept, end = scan_tar(flh, expected)
+            self.util.log(bu.Util.info, "=> Reopening %s, keeping %i unit tars" % (self.archive_name, len(kept)))
+            self.tape_writer = bu.HashingWriter(flh, algorithms)
+            self.tape_writer.rewind(end)
+        else:
+            self.tape_writer = bu.HashingWriter(open(self.archive_name, 'w+b'), algorithms)
+        self.tape_tar = tarfile.open(fileobj=self.tape_writer, mode="w")
+        self.tape_tar.members = kept
+        return [tinfo.name for tinfo in kept]
+
+    def park(self):
+        """ Method to send any pending catalog updates to the database, and close the tape
+            tar, if it is open, so that it is a complete tar file. It is reopened, and added to,
+            by the next run.
+        """
+        self.flush_db_units()
+        if self.tape_tar is None:
+            return
+        self.util.log(bu.Util.info, "=> Closing %s until the next run" % (self.archive_name))
+        self.tape_tar.close()
+        self.tape_writer.close()
+        self.tape_tar = None
+
+    def close_tape(self):
+        """ Method to finish the tape tar in stream mode, any unit tars on the staging directory
+            are added to it before it is closed
+        """
+        self.open_tape()
+        self.tape_index = {}
+        for tinfo in self.tape_tar.members:
+            self.tape_index[tinfo.name] = (tinfo.offset, tinfo.offset_data, tinfo.size)
+        for name in self.staged:
+            self.util.log(bu.Util.info, "===>  Adding: {0}".format(name))
+            header = self.tape_tar.offset
+            tarinfo = self.tape_tar.gettarinfo(os.path.join(self.stage_dir, name), arcname=name)
+            with open(os.path.join(self.stage_dir, name), 'rb') as flh:
+                bu.add_to_tar(self.tape_tar, tarinfo, flh)
+            self.tape_index[name] = bu.index_entry(header, self.tape_tar.offset, tarinfo.size)
+        self.tape_tar.close()
+        self.tape_writer.close()
+        self.tape_tar = None
+        self.archive_checksums = self.tape_writer.hexdigests()
+        self.archive_md5 = self.archive_checksums['md5']
+        if self.verify:
+            data = {}
+            for idx in self.dir_list:
+                data[idx.tarfile] = [idx.tar_size, idx.get_md5sum()]
+            if not bu.check_files(data, self.stage_dir, self.archive_base, self.util):
+                raise Exception("Verification of %s failed" % (self.archive_name))
+
     def generate(self):
         """ Method to create a tarball and record its md5sum
         """
         self.util.log(bu.Util.info, "=> Generating: {0}".format(self.archive_name))
         self.change_to_staging_dir()
-        data = {}
-        tarfiles = []
-        for idx in self.dir_list:
-            data[idx.tarfile] = [None, idx.get_md5sum()]
-            tarfiles.append(idx.tarfile)
-        cwd = os.getcwd()
-        ubertar = DES_tarball(self.args, tarfiles, data, self.util, self.stage_dir, file_class=None, verify=self.verify, tarname=self.archive_name)
-        os.chdir(cwd)
-        self.archive_md5 = ubertar.get_md5sum()
-        for idx in self.dir_list:
-            self.util.log(bu.Util.info, "===>  Removing: {0}".format(idx.tarfile))
-            os.remove(idx.tarfile)
+        if self.stream:
+            self.close_tape()
+            unittars = self.staged
+        else:
+            data = {}
+            tarfiles = []
+            for idx in self.dir_list:
+                data[idx.tarfile] = [None, idx.get_md5sum()]
+                tarfiles.append(idx.tarfile)
+            cwd = os.getcwd()
+            ubertar = DES_tarball(self.args, tarfiles, data, self.util, self.stage_dir, file_class=None, verify=self.verify,
+                                  tarname=self.archive_name, check_members=self.args.get('verify', False))
+            os.chdir(cwd)
+            self.archive_md5 = ubertar.get_md5sum()
+            self.archive_checksums = ubertar.checksums
+            self.tape_index = ubertar.get_index()
+            unittars = tarfiles
+        for name in unittars:
+            self.util.log(bu.Util.info, "===>  Removing: {0}".format(name))
+            os.remove(name)
             # add up db changes
+        self.write_index()
         self.util.log(bu.Util.info, "Moving %s to %s" % (os.path.join(self.archive_name), os.path.join(self.xfer_dir, self.archive_base)))
         os.rename(os.path.join(self.archive_name), os.path.join(self.xfer_dir, self.archive_base))
         os.system("chmod g+w %s" % os.path.join(self.xfer_dir, self.archive_base))
         self.util.log(bu.Util.info, "=> Tar file generated: %s" % (self.archive_name))
-        if not self.util.ping():
-            self.util.reconnect()
-
         self.update_db_tape()
 
+    def write_index(self):
+        """ Method to write the index of the tape tar, and of the unit tars in it, to a file
+            in the transfer directory alongside the tape tar
+        """
+        index = {}
+        for idx in self.dir_list:
+            members = idx.get_index()
+            if members is None:
+                members = bu.get_member_index(self.util, idx.tarfile)
+            entry = self.tape_index[idx.tarfile]
+            index[idx.tarfile] = {'header_offset': entry[0],
+                                  'data_offset': entry[1],
+                                  'size': entry[2],
+                                  'compression': bu.codec_from_name(idx.tarfile),
+                                  'members': members}
+        bu.write_index(os.path.join(self.xfer_dir, self.archive_base + '.index'), index)
+
     def update_db_tape(self):
         """ Method to update the DB with current status of unit and tape tars"""
         now = datetime.datetime.now()
         urows = []
+        changes = [('TAPE', self.file_class, 0, 1, self.archive_size)]
 
         for ddir in self.dir_list:
-            urows.append((ddir.tarfile, self.archive_base, ddir.tarfile, ddir.tar_size, ddir.md5sum, self.archive_base, self.file_class))
+            header, data, _ = self.tape_index.get(ddir.tarfile, (None, None, None))
+            urows.append((ddir.tarfile, self.archive_base, header, data, ddir.tarfile, ddir.tar_size, ddir.md5sum, now.strftime('%Y-%m-%d %H:%M:%S'), self.archive_base, self.file_class, header, data))
+            # in stream mode only the unit tars left on the staging directory have status 2
+            status = 3 if self.stream and ddir.tarfile not in self.staged else 2
+            changes.extend([('UNIT', self.file_class, status, -1, -ddir.tar_size),
+                            ('UNIT', self.file_class, 1, 1, ddir.tar_size)])
         cur = self.util.cursor()
-
-        cur.prepare("merge into BACKUP_UNIT bu using dual on (bu.name=:1) when matched then update set tape_tar=:2,status=1 when not matched then insert (NAME,DEPRECATED,TAR_SIZE,MD5SUM,CREATED_DATE,TAPE_TAR,FILE_TYPE,STATUS) values (:3,0,:4,:5,TO_DATE('%s', 'YYYY-MM-DD HH24:MI:SS'),:6,:7,1)" % (now.strftime('%Y-%m-%d %H:%M:%S')))
-
-        cur.executemany(None, urows)
-        sql = "insert into BACKUP_TAPE (NAME,TAR_SIZE,CREATED_DATE,MD5SUM,RETRIES,STATUS,PATH,DEPRECATED,PRIORITY,FILE_TYPE) values ('%s',%i,TO_DATE('%s', 'YYYY-MM-DD HH24:MI:SS'),'%s',0,0,'%s',0,%i, '%s')" % (self.archive_base, self.archive_size, now.strftime('%Y-%m-%d %H:%M:%S'), self.archive_md5, self.xfer_dir, self.priority, self.file_class)
-        print sql
-        cur.execute(sql)
+        self.flush_db_units(cur, commit=False)
+
+        bu.executemany(cur, "merge into BACKUP_UNIT bu using dual on (bu.name=:1) when matched then update set tape_tar=:2,status=1,header_offset=:3,data_offset=:4 when not matched then insert (NAME,DEPRECATED,TAR_SIZE,MD5SUM,CREATED_DATE,TAPE_TAR,FILE_TYPE,STATUS,HEADER_OFFSET,DATA_OFFSET) values (:5,0,:6,:7,TO_DATE(:8, 'YYYY-MM-DD HH24:MI:SS'),:9,:10,1,:11,:12)", urows)
+        adler32 = None
+        if self.archive_checksums:
+            adler32 = self.archive_checksums.get('adler32')
+        params = [self.archive_base, self.archive_size, now.strftime('%Y-%m-%d %H:%M:%S'), self.archive_md5, self.xfer_dir, self.priority, self.file_class, adler32]
+        print "Adding tape tar %s" % (params)
+        bu.execute(cur, "insert into BACKUP_TAPE (NAME,TAR_SIZE,CREATED_DATE,MD5SUM,RETRIES,STATUS,PATH,DEPRECATED,PRIORITY,FILE_TYPE,ADLER32) values (:1,:2,TO_DATE(:3, 'YYYY-MM-DD HH24:MI:SS'),:4,0,0,:5,0,:6,:7,:8)", params)
+        bu.update_summary(cur, changes)
         cur.execute('commit')
+        self.clear_pending()
 
-    def update_db_unit(self, mytar, dirname):
-        """ Method to update the backup_unit and backup_dir tables
+    def update_db_unit(self, mytar, dirname, status=2, tape_tar=None):
+        """ Method to record a new unit tar, and its directory, in the backup_unit and
+            backup_dir tables. The updates are held back, and logged to disk, until they are
+            sent to the database by flush_db_units.
 
             Parameters
             ----------
             mytar : DES_tarball object
             dirname : str
                 The name of the directory
+            status : int
+                The status of the unit tar, 2 if it is on the staging directory, 3 if it has been
+                streamed into a tape tar which is not yet complete (Default is 2)
+            tape_tar : str
+                The name of the tape tar the unit tar was streamed into (Default is None)
         """
-        cur = self.util.cursor()
-        cur.execute("insert into BACKUP_UNIT (NAME,DEPRECATED,TAR_SIZE,MD5SUM,CREATED_DATE,FILE_TYPE,STATUS) values ('%s',0,%i,'%s',TO_DATE('%s', 'YYYY-MM-DD HH24:MI:SS'),'%s',2)" % (mytar.tarfile, mytar.tar_size, mytar.md5sum, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), mytar.file_class))
-        cur.execute("update BACKUP_DIR set UNIT_NAME='%s',STATUS=1 where PATH='%s'" % (mytar.tarfile, dirname))
-        cur.execute('commit')
+        update = {'name': mytar.tarfile,
+                  'dirname': dirname,
+                  'size': mytar.tar_size,
+                  'md5sum': mytar.md5sum,
+                  'created': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                  'tape_tar': tape_tar,
+                  'file_class': mytar.file_class,
+                  'status': status,
+                  'compression': mytar.compression,
+                  'index': [],
+                  'contents': [],
+                  'references': []}
+        index = mytar.get_index()
+        if index:
+            for name, entry in index.iteritems():
+                update['index'].append([name] + list(entry))
+        # record the contents of the files, so later copies of them can refer to this unit tar
+        if mytar.contents:
+            for name, size, md5sum in mytar.contents:
+                update['contents'].append([md5sum, size, name])
+        if mytar.references:
+            for name, ref_unit, ref_member in mytar.references:
+                update['references'].append([name, ref_unit, ref_member])
+        self.pending_log.add(update)
+        self.pending.append(update)
+
+    def flush_db_units(self, cur=None, commit=True, replay=False):
+        """ Method to send the pending unit tar updates to the database, each table is updated
+            with a single array bound statement
+
+            Parameters
+            ----------
+            cur : cursor object
+                The cursor to use (Default is None, get a new one)
+            commit : bool
+                If True then commit the updates, otherwise they are committed by the caller,
+                who must then call clear_pending (Default is True)
+            replay : bool
+                If True then the updates are being replayed from the log of an earlier run,
+                which may have committed some of them before it stopped. Only the updates of
+                unit tars which are not in the database are made. (Default is False)
+        """
+        if not self.pending:
+            return
+        if cur is None:
+            cur = self.util.cursor()
+        urows = []
+        drows = []
+        irows = []
+        crows = []
+        rrows = []
+        changes = []
+        for upd in self.pending:
+            # a replayed update is only counted in the summary if it was not committed before
+            if not replay or not bu.execute(cur, "select count(*) from BACKUP_UNIT where NAME=:1", [upd['name']]).fetchall()[0][0]:
+                dclass = bu.summary_class(upd['dirname'], upd['file_class'])
+                changes.extend([('UNIT', upd['file_class'], upd['status'], 1, upd['size']),
+                                ('DIR', dclass, 0, -1, 0),
+                                ('DIR', dclass, 1, 1, 0)])
+            urows.append([upd['name'], upd['size'], upd['md5sum'], upd['created'], upd['tape_tar'], upd['file_class'], upd['status'], upd['compression']])
+            drows.append([upd['name'], upd['dirname']])
+            for row in upd['index']:
+                irows.append([upd['name']] + row)
+            for row in upd['contents']:
+                crows.append(row[:2] + [upd['name'], row[2]])
+            for row in upd['references']:
+                rrows.append([upd['name']] + row)
+
+        def insert(table, columns, values, rows, key):
+            """ Insert the rows, guarded by the unit tar not being in the database if replaying
+            """
+            if not rows:
+                return
+            if replay:
+                nbind = len(rows[0])
+                sql = "insert into %s (%s) select %s from dual where not exists (select NAME from BACKUP_UNIT where NAME=:%i)" % (table, columns, values, nbind + 1)
+                rows = [row + [row[key]] for row in rows]
+            else:
+                sql = "insert into %s (%s) values (%s)" % (table, columns, values)
+            bu.executemany(cur, sql, rows)
+
+        # the unit tars go in last, as they mark the updates of a replay as done
+        insert("BACKUP_UNIT_INDEX", "UNIT_NAME,NAME,HEADER_OFFSET,DATA_OFFSET,FILE_SIZE", ":1,:2,:3,:4,:5", irows, 0)
+        insert("BACKUP_CONTENT", "MD5SUM,FILE_SIZE,UNIT_NAME,MEMBER", ":1,:2,:3,:4", crows, 2)
+        insert("BACKUP_REFERENCE", "UNIT_NAME,MEMBER,REF_UNIT,REF_MEMBER", ":1,:2,:3,:4", rrows, 0)
+        bu.executemany(cur, "update BACKUP_DIR set UNIT_NAME=:1,STATUS=1 where PATH=:2", drows)
+        insert("BACKUP_UNIT", "NAME,DEPRECATED,TAR_SIZE,MD5SUM,CREATED_DATE,TAPE_TAR,FILE_TYPE,STATUS,COMPRESSION",
+               ":1,0,:2,:3,TO_DATE(:4, 'YYYY-MM-DD HH24:MI:SS'),:5,:6,:7,:8", urows, 0)
+        bu.update_summary(cur, changes)
+        if commit:
+            cur.execute('commit')
+            self.clear_pending()
+
+    def clear_pending(self):
+        """ Method to forget the pending unit tar updates, once they are committed
+        """
+        self.pending = []
+        self.pending_log.remove()
 
     def return_key_value(self, key):
         """ Method to get a specific internal variable
@@ -181,10 +569,86 @@ class DES_archive(object):
             print "\t%s = %s" % (key, mydict.get(key))
 
     def restore(self):
-        """ Method to get data of unit files which are not part of a tape tar
+        """ Method to get data of unit files which are not part of a tape tar. Any unit tar
+            updates an earlier run did not commit are sent to the database first.
         """
+        self.pending = self.pending_log.load()
+        if self.pending:
+            self.util.log(bu.Util.info, "Replaying %i unit tar updates from %s" % (len(self.pending), self.pending_log.filename))
+            self.flush_db_units(replay=True)
         cur = self.util.cursor()
-        cur.execute("select NAME,TAR_SIZE,MD5SUM from BACKUP_UNIT where STATUS=2 and FILE_TYPE='%s'" % (self.file_class))
+        bu.execute(cur, "select NAME,TAR_SIZE,MD5SUM from BACKUP_UNIT where STATUS=2 and FILE_TYPE=:1", [self.file_class])
         listing = cur.fetchall()
         #print listing
         self.make_directory_tars(listing)
+        for ddir in listing:
+            self.staged.append(ddir[0])
+        if self.stream:
+            self.resume_tape()
+        else:
+            self.resume_journal()
+
+    def resume_journal(self):
+        """ Method to pick up the tape tar an earlier run was writing when it was interrupted,
+            if it left a checkpoint journal, so that the tape tar is continued rather than
+            started again
+        """
+        prefix = self.project + "_" + self.file_class + "_"
+        journals = []
+        for fname in os.listdir(self.stage_dir):
+            if fname.startswith(prefix) and fname.endswith('.tar.journal') and \
+               os.path.exists(os.path.join(self.stage_dir, fname[:-len('.journal')])):
+                journals.append(fname)
+        if not journals:
+            return
+        self.archive_base = max(journals)[:-len('.journal')]
+        self.archive_name = os.path.join(self.stage_dir, self.archive_base)
+        self.util.log(bu.Util.info, "Resuming interrupted tape tar %s" % (self.archive_name))
+
+    def resume_tape(self):
+        """ Method to pick up the tape tar being streamed into by an earlier run. Any unit tars
+            which did not make it completely into the tape tar are removed from the database, and
+            their directories are marked to be tarred again.
+        """
+        cur = self.util.cursor()
+        bu.execute(cur, "select NAME,TAR_SIZE,MD5SUM,TAPE_TAR from BACKUP_UNIT where STATUS=3 and FILE_TYPE=:1 order by CREATED_DATE", [self.file_class])
+        units = cur.fetchall()
+        if not units:
+            return
+        tapes = []
+        for unit in units:
+            tapes.append(unit[3])
+        self.archive_base = max(tapes)
+        self.archive_name = os.path.join(self.stage_dir, self.archive_base)
+        streamed = []
+        for unit in units:
+            if unit[3] == self.archive_base:
+                streamed.append(unit[:3])
+        self.make_directory_tars(streamed)
+        kept = []
+        if os.path.exists(self.archive_name):
+            kept = self.open_tape()
+        changes = []
+        for unit in units:
+            if unit[0] in kept:
+                continue
+            changes.append(('UNIT', self.file_class, 3, -1, -unit[1]))
+            for ddir in bu.execute(cur, "select PATH from BACKUP_DIR where UNIT_NAME=:1", [unit[0]]).fetchall() or []:
+                dclass = bu.summary_class(ddir[0], self.file_class)
+                changes.extend([('DIR', dclass, 1, -1, 0),
+                                ('DIR', dclass, 0, 1, 0)])
+            self.util.log(bu.Util.warn, "Unit tar %s is not complete in %s, its directory will be tarred again" % (unit[0], unit[3]))
+            bu.execute(cur, "delete from BACKUP_UNIT_INDEX where UNIT_NAME=:1", [unit[0]])
+            bu.execute(cur, "delete from BACKUP_CONTENT where UNIT_NAME=:1", [unit[0]])
+            bu.execute(cur, "delete from BACKUP_REFERENCE where UNIT_NAME=:1", [unit[0]])
+            bu.execute(cur, "delete from BACKUP_UNIT where NAME=:1", [unit[0]])
+            bu.execute(cur, "update BACKUP_DIR set UNIT_NAME=NULL,STATUS=0 where UNIT_NAME=:1", [unit[0]])
+        bu.update_summary(cur, changes)
+        cur.execute('commit')
+        dir_list = []
+        self.archive_size = 0
+        for idx in self.dir_list:
+            if idx.tarfile in self.staged or idx.tarfile in kept:
+                dir_list.append(idx)
+                self.archive_size += idx.tar_size
+        self.dir_list = dir_list
@@ -2,6 +2,7 @@
 
 """
 import os
+import time
 import tarfile
 
 import archivetools.backup_util as bu
@@ -12,7 +13,7 @@ class DES_tarball(object):
     """
 
     def __init__(self, args, items, data, util, path, size=0, md5sum=0, file_class=None, verify=False,
-                 tarname=None):
+                 tarname=None, check_members=False, tape_tar=None):
         """ Parameters
             ----------
             args : dict
@@ -31,22 +32,55 @@ class DES_tarball(object):
                 The md5sum of the tarball (Default is 0)
             file_class : str
                 The class of the data
+            verify : bool
+                If True then verify the md5sums of the files in the tarball after it is written
+                (Default is False)
+            tarname : str
+                The name of the tarball (Default is None, the name is generated from the items)
+            check_members : bool
+                If True then md5sum each file as it is added to the tarball and compare it to
+                the md5sum in data, a bu.ChecksumError is raised if they do not match (Default is False)
+            tape_tar : TarFile instance
+                If given then the tarball is not written to the staging directory, but is streamed
+                directly into tape_tar as a member (Default is None)
         """
         if size != 0:
             self.tarfile = data
             self.tar_size = size
             self.md5sum = md5sum
             self.file_class = file_class
+            self.checksums = {}
+            self.index = None
+            self.compression = None
+            self.contents = []
+            self.references = []
             return
         self.args = args
         self.items = items
+        self.data = data
         self.path = path
         self.util = util
         self.file_class = file_class
         self.tarfile = tarname
         self.tar_size = 0
+        self.checksums = {}
+        # the header offset, data offset, and size of each member, keyed by name
+        self.index = {}
+        # the name, size and md5sum of each file written, and the name, and unit tar and member
+        # refered to, of each file written as a reference to an identical file archived earlier
+        self.contents = []
+        self.references = []
+        self.algorithms = bu.get_checksum_list(self.args.get('checksums'))
+        self.check_members = check_members
+        self.prefetcher = None
+        self.compression, self.level = self.choose_compression()
         self.util.log(bu.Util.info, "=> Archiving: {0}".format(",".join(self.items)))
 
+        if tape_tar is not None and self.compression is None:
+            # a streamed tarball cannot be re-read from the staging directory, the members are
+            # checked as they are written if requested
+            self.stream_tar(tape_tar)
+            return
         while True:
             self.execute_tar()
             if verify:
@@ -55,8 +89,39 @@ class DES_tarball(object):
                 os.remove(os.path.join(self.args['stgdir'], self.tarfile))
             else:
                 break
-        self.util.log(bu.Util.info, " ==> Generating md5sum for %s" % self.tarfile)
-        self.md5sum = bu.generate_md5sum(os.path.join(self.args['stgdir'], self.tarfile))
+        if tape_tar is not None:
+            # the size of a compressed tarball is not known until it is written, so it is
+            # spooled to the staging directory before being added to tape_tar
+            self.spool_to_tape(tape_tar)
+
+    def choose_compression(self):
+        """ Method to choose the compression of the tarball from the compression policy for its
+            class. Tarballs of directories which are mostly already compressed files are not
+            compressed, nor are tarballs with no class (i.e. tape tars).
+
+            Returns
+            -------
+            Tuple containing the codec (None for no compression) and level
+        """
+        if self.file_class is None:
+            return None, None
+        codec, level = bu.get_compression(self.args.get('compression'), self.file_class)
+        if codec is not None and bu.precompressed_fraction(self.data) > 0.5:
+            self.util.log(bu.Util.info, "===> Data is mostly compressed already, not compressing")
+            return None, None
+        return codec, level
+
+    def default_name(self):
+        """ Method to generate the name of the tar file from the first item
+
+            Returns
+            -------
+            str, the name
+        """
+        name = self.items[0].replace("/", ".") + ".tar"
+        if self.compression is not None:
+            name += bu.CODECS[self.compression]
+        return name
 
     def ch_to_stage_dir(self):
         """ Method to change the directory to the staging dir
@@ -69,24 +134,598 @@ class DES_tarball(object):
         return self.tar_size
 
     def execute_tar(self):
-        """ Method to generate the tar file
+        """ Method to generate the tar file, the checksums of the tar file are calculated
+            as it is written
         """
         if not self.tarfile:
-            self.tarfile = self.items[0].replace("/", ".") + ".tar"
+            self.tarfile = self.default_name()
 
         self.util.log(bu.Util.info, "===> Initiating Tar: {0}".format(self.tarfile))
         self.util.log(bu.Util.info, "===> Initiating Tar stgdir: {0}".format(self.args['stgdir']))
         self.ch_to_stage_dir()
-        tar = tarfile.open(os.path.join(self.args['stgdir'], self.tarfile), "w", dereference=True)
+        tarpath = os.path.join(self.args['stgdir'], self.tarfile)
+        self.index = {}
+        self.contents = []
+        self.references = []
+        journal, done = self.open_journal(tarpath)
+        if done:
+            writer = bu.HashingWriter(open(tarpath, 'r+b'), self.algorithms)
+            writer.rewind(journal.last)
+            self.util.log(bu.Util.info, "===> Resuming Tar after {0} members, {1} bytes".format(len(done), journal.last))
+        else:
+            writer = bu.HashingWriter(open(tarpath, 'wb'), self.algorithms)
+        out = writer
+        if self.compression is not None:
+            self.util.log(bu.Util.info, "===> Compressing with {0}".format(self.compression))
+            out = bu.CompressingWriter(writer, self.compression, self.level, int(self.args.get('compress_threads', 0)))
+        tar = tarfile.open(fileobj=out, mode="w", dereference=True)
         cwd = os.getcwd()
         os.chdir(self.path)
-        for item in self.items:
-            tar.add(item)
+        restart = False
+        complete = False
+        try:
+            try:
+                members = self.get_members(tar)
+                if done and not self.resume_members(members, done):
+                    # the directory has changed since the interrupted run, start again
+                    restart = True
+                else:
+                    if self.check_members:
+                        self.util.log(bu.Util.info, "===> Checking md5sums of files as they are tarred")
+                    self.start_prefetch(members, done)
+                    begin = time.time()
+                    for name, tarinfo in members:
+                        if name in done:
+                            continue
+                        header = tar.offset
+                        self.add_member(tar, name, tarinfo)
+                        self.index[name] = bu.index_entry(header, tar.offset, tarinfo.size)
+                        if journal is not None:
+                            journal.add(writer, self.journal_entry(name, tarinfo, tar.offset))
+                    self.log_rate(members, done, time.time() - begin)
+                    complete = True
+            finally:
+                self.stop_prefetch()
+                if not complete:
+                    # the tar file is abandoned, close it without finishing the tar
+                    os.chdir(cwd)
+                    try:
+                        if out is not writer:
+                            out.close()
+                    finally:
+                        writer.close()
+        except bu.ChecksumError:
+            self.discard_tar(tarpath, journal)
+            raise
+        if restart:
+            self.discard_tar(tarpath, journal)
+            self.execute_tar()
+            return
         os.chdir(cwd)
         tar.close()
-        self.tar_size = os.path.getsize(os.path.join(self.args['stgdir'], self.tarfile))
+        if out is not writer:
+            out.close()
+        writer.close()
+        if journal is not None:
+            journal.remove()
+        self.tar_size = writer.size
+        self.checksums = writer.hexdigests()
+        self.md5sum = self.checksums['md5']
+
+        self.util.log(bu.Util.info, "===> Tar complete.  Size: {0}  md5sum: {1}".format(self.tar_size, self.md5sum))
+
+    def discard_tar(self, tarpath, journal):
+        """ Method to remove an abandoned tar file, and its checkpoint journal
+
+            Parameters
+            ----------
+            tarpath : str
+                The full path to the tar file
+            journal : Journal object
+                The journal of the tar file, None if it is not journaled
+        """
+        if os.path.exists(tarpath):
+            os.remove(tarpath)
+        if journal is not None:
+            journal.remove()
+
+    def open_journal(self, tarpath):
+        """ Method to open the checkpoint journal of the tar file, and read it if an earlier
+            run was interrupted while writing the tar file. Compressed tar files are not
+            journaled, as the state of the compressor cannot be recovered.
+
+            Parameters
+            ----------
+            tarpath : str
+                The full path of the tar file
+
+            Returns
+            -------
+            Tuple containing the bu.Journal instance (None if journaling is turned off), and a
+            dict of the members already written, keyed by name
+        """
+        interval = 0
+        if self.args.get('checkpoint'):
+            interval = bu.calculate_archive_size(self.args['checkpoint'])
+        if interval <= 0 or self.compression is not None:
+            return None, {}
+        journal = bu.Journal(tarpath + '.journal', interval)
+        entries = []
+        if os.path.exists(tarpath):
+            entries = journal.load(os.path.getsize(tarpath))
+        if not entries:
+            journal.reset()
+            return journal, {}
+        done = {}
+        for entry in entries:
+            done[entry['name']] = entry
+        return journal, done
+
+    def journal_entry(self, name, tarinfo, end):
+        """ Method to generate the journal entry of a member which has just been written
+
+            Parameters
+            ----------
+            name : str
+                The path of the member
+            tarinfo : TarInfo instance
+                The header information of the member
+            end : int
+                The offset of the end of the member in the tar file
+
+            Returns
+            -------
+            dict describing the member
+        """
+        entry = {'name': name,
+                 'size': tarinfo.size,
+                 'mtime': int(tarinfo.mtime),
+                 'index': self.index[name],
+                 'end': end}
+        if self.contents and self.contents[-1][0] == name:
+            entry['md5'] = self.contents[-1][2]
+        if self.references and self.references[-1][0] == name:
+            entry['ref'] = list(self.references[-1][1:])
+        return entry
+
+    def resume_members(self, members, done):
+        """ Method to restore the index and contents of the members written before the tar file
+            was interrupted, after checking that they have not changed since
+
+            Parameters
+            ----------
+            members : list
+                List of tuples containing the path of each member and its TarInfo
+            done : dict
+                The journal entries of the members already written, keyed by name
+
+            Returns
+            -------
+            bool, True if the tar file can be resumed
+        """
+        found = 0
+        for name, tarinfo in members:
+            entry = done.get(name)
+            if entry is None:
+                continue
+            if entry['size'] != tarinfo.size or entry['mtime'] != int(tarinfo.mtime):
+                self.util.log(bu.Util.warn, "===> %s has changed since it was tarred, restarting tar" % (name))
+                return False
+            found += 1
+        if found != len(done):
+            self.util.log(bu.Util.warn, "===> Files have been removed since they were tarred, restarting tar")
+            return False
+        for name, tarinfo in members:
+            entry = done.get(name)
+            if entry is None:
+                continue
+            self.index[name] = tuple(entry['index'])
+            if 'md5' in entry:
+                self.contents.append((name, entry['size'], entry['md5']))
+                if self.check_members:
+                    self.check_member(name, entry['size'], entry['md5'])
+            if 'ref' in entry:
+                self.references.append((name,) + tuple(entry['ref']))
+        return True
+
+    def stream_tar(self, tape_tar):
+        """ Method to generate the tar file as a member of another tar file, without writing it to
+            the staging directory. The size of the tar file is calculated from the file headers
+            before it is written, so that its header in tape_tar can be written first. The
+            checksums of the tar file are calculated as it is written.
+
+            Parameters
+            ----------
+            tape_tar : TarFile instance
+                The tar file to write the tarball in to, it must have been opened for writing on
+                top of a bu.HashingWriter
+        """
+        if not self.tarfile:
+            self.tarfile = self.default_name()
+
+        self.util.log(bu.Util.info, "===> Initiating Tar: {0}".format(self.tarfile))
+        self.util.log(bu.Util.info, "===> Streaming Tar into: {0}".format(tape_tar.fileobj.name))
+        start = tape_tar.offset
+        writer = bu.HashingWriter(tape_tar.fileobj, self.algorithms)
+        tar = tarfile.open(fileobj=writer, mode="w", dereference=True)
+        cwd = os.getcwd()
+        os.chdir(self.path)
+        try:
+            members = self.get_members(tar)
+            tarinfo = tarfile.TarInfo(self.tarfile)
+            tarinfo.size = self.calculate_size(tar, members)
+            tarinfo.mtime = time.time()
+            tarinfo.mode = 0644
+            buf = tarinfo.tobuf(tape_tar.format, tape_tar.encoding, tape_tar.errors)
+            tape_tar.fileobj.write(buf)
+            tape_tar.offset += len(buf)
+            if self.check_members:
+                self.util.log(bu.Util.info, "===> Checking md5sums of files as they are tarred")
+            self.start_prefetch(members)
+            begin = time.time()
+            for name, mtarinfo in members:
+                header = tar.offset
+                self.add_member(tar, name, mtarinfo)
+                self.index[name] = bu.index_entry(header, tar.offset, mtarinfo.size)
+            self.log_rate(members, {}, time.time() - begin)
+            self.stop_prefetch()
+            tar.close()
+            if writer.size != tarinfo.size:
+                raise bu.ChecksumError("Size of %s changed while it was being written, expected %i bytes but wrote %i" % (self.tarfile, tarinfo.size, writer.size))
+        except:
+            self.stop_prefetch()
+            os.chdir(cwd)
+            # remove the partial tarball from tape_tar
+            tape_tar.fileobj.rewind(start)
+            tape_tar.offset = start
+            raise
+        os.chdir(cwd)
+        tarinfo.offset = start
+        tarinfo.offset_data = start + len(buf)
+        tape_tar.offset += tarinfo.size
+        tape_tar.members.append(tarinfo)
+        self.tar_size = writer.size
+        self.checksums = writer.hexdigests()
+        self.md5sum = self.checksums['md5']
+
+        self.util.log(bu.Util.info, "===> Tar complete.  Size: {0}  md5sum: {1}".format(self.tar_size, self.md5sum))
+
+    def spool_to_tape(self, tape_tar):
+        """ Method to move the tar file from the staging directory into another tar file
+
+            Parameters
+            ----------
+            tape_tar : TarFile instance
+                The tar file to add the tarball to, it must have been opened for writing on
+                top of a bu.HashingWriter
+        """
+        tarpath = os.path.join(self.args['stgdir'], self.tarfile)
+        self.util.log(bu.Util.info, "===> Adding {0} to {1}".format(self.tarfile, tape_tar.fileobj.name))
+        start = tape_tar.offset
+        try:
+            tarinfo = tape_tar.gettarinfo(tarpath, arcname=self.tarfile)
+            with open(tarpath, 'rb') as flh:
+                bu.add_to_tar(tape_tar, tarinfo, flh)
+        except:
+            # remove the partial tarball from tape_tar
+            tape_tar.fileobj.rewind(start)
+            tape_tar.offset = start
+            raise
+        finally:
+            os.remove(tarpath)
+        tarinfo.offset = start
+        tarinfo.offset_data = tape_tar.offset - bu.padded_size(tarinfo.size)
+
+    @staticmethod
+    def calculate_size(tar, members):
+        """ Method to calculate the size a tar file will have once the given members are
+            written to it
+
+            Parameters
+            ----------
+            tar : TarFile instance
+                The tar file the members will be written to
+            members : list
+                List of tuples containing the path of each member and its TarInfo
+
+            Returns
+            -------
+            int, the size in bytes
+        """
+        size = 0
+        for _, tarinfo in members:
+            size += len(tarinfo.tobuf(tar.format, tar.encoding, tar.errors))
+            if tarinfo.isreg():
+                size += bu.padded_size(tarinfo.size)
+        # end of archive marker, then padded out to a whole record
+        size += 2 * tarfile.BLOCKSIZE
+        blocks, remainder = divmod(size, tarfile.RECORDSIZE)
+        if remainder > 0:
+            size += tarfile.RECORDSIZE - remainder
+        return size
+
+    def get_members(self, tar):
+        """ Method to list the members of the tar file, in the order they are to be written.
+            Directories are followed recursively.
+
+            Parameters
+            ----------
+            tar : TarFile instance
+                The tar file being written
+
+            Returns
+            -------
+            list of tuples containing the path of each member and its TarInfo
+        """
+        members = []
+        for item in self.items:
+            self._walk(tar, item, members)
+        return self.order_members(members)
+
+    def order_members(self, members):
+        """ Method to put the members in the order set by the order option, so that the files
+            can be read from disk in as sequential a way as possible. For the inode and extent
+            orders the directories are written first, in name order, followed by everything
+            else sorted by inode number or by the physical location of the start of the file.
+            Files whose location is unknown go last, in inode order.
+
+            Parameters
+            ----------
+            members : list
+                List of tuples containing the path of each member and its TarInfo, in name order
+
+            Returns
+            -------
+            list of the members in the order they are to be written
+        """
+        order = self.args.get('order', 'name')
+        if order == 'name':
+            return members
+        if order not in bu.ORDERS:
+            raise Exception("Unknown member order %s, must be one of %s" % (order, ", ".join(bu.ORDERS)))
+        dirs = []
+        others = []
+        for name, tarinfo in members:
+            if tarinfo.isdir():
+                dirs.append((name, tarinfo))
+                continue
+            inode = os.stat(name).st_ino
+            offset = None
+            if order == 'extent' and tarinfo.isreg():
+                offset = bu.physical_offset(name)
+            if offset is None:
+                key = (1, inode)
+            else:
+                key = (0, offset)
+            others.append((key, name, tarinfo))
+        others.sort(key=lambda o: o[0])
+        return dirs + [(name, tarinfo) for _, name, tarinfo in others]
+
+    def log_rate(self, members, done, seconds):
+        """ Method to log the rate at which the files were read and tarred
+
+            Parameters
+            ----------
+            members : list
+                List of tuples containing the path of each member and its TarInfo
+            done : dict
+                The members which were already in the tar file, and so were not read
+            seconds : float
+                The time taken in seconds
+        """
+        nbytes = 0
+        for name, tarinfo in members:
+            if tarinfo.isreg() and name not in done:
+                nbytes += tarinfo.size
+        mbytes = nbytes / 1024.**2
+        self.util.log(bu.Util.info, "===> Read %.1f MB in %.1f s, %.1f MB/s" % (mbytes, seconds, mbytes / max(seconds, 1e-6)))
+
+    def _walk(self, tar, name, members):
+        """ Method to recursively add a path, and anything under it, to the list of members
+
+            Parameters
+            ----------
+            tar : TarFile instance
+                The tar file being written
+            name : str
+                The path to add
+            members : list
+                The list of members to add to
+        """
+        tarinfo = tar.gettarinfo(name)
+        if tarinfo is None:
+            self.util.log(bu.Util.warn, "===> Unsupported file type, not tarring %s" % (name))
+            return
+        if tarinfo.isreg():
+            ref = self.get_reference(name, tarinfo.size)
+            if ref is not None:
+                # write a reference to the identical file instead of the contents
+                tarinfo.type = tarfile.SYMTYPE
+                tarinfo.linkname = bu.make_reference(*ref)
+                tarinfo.size = 0
+        members.append((name, tarinfo))
+        if tarinfo.isdir():
+            for fname in sorted(os.listdir(name)):
+                self._walk(tar, os.path.join(name, fname), members)
 
-        self.util.log(bu.Util.info, "===> Tar complete.  Size: {0}".format(self.tar_size))
+    def get_reference(self, name, size):
+        """ Method to find whether a file has already been archived, as found by the content
+            index lookup in data. Only used if deduplication is turned on.
+
+            Parameters
+            ----------
+            name : str
+                The path of the file
+            size : int
+                The size of the file in bytes
+
+            Returns
+            -------
+            Tuple containing the unit tar and member name of the identical file, None if there
+            is not one
+        """
+        if not self.args.get('dedup'):
+            return None
+        item = self.data.get(os.path.basename(name))
+        if item is None or len(item) < 3 or not item[2] or item[0] != size:
+            return None
+        return item[2]
+
+    def add_member(self, tar, name, tarinfo):
+        """ Method to add a single member to the tar file, checking its md5sum if requested
+
+            Parameters
+            ----------
+            tar : TarFile instance
+                The tar file being written
+            name : str
+                The path of the member
+            tarinfo : TarInfo instance
+                The header information of the member
+        """
+        fname = os.path.basename(name)
+        ref = bu.parse_reference(tarinfo.linkname)
+        if ref is not None:
+            if self.check_members:
+                # make sure the file really is the same as the one refered to
+                with open(name, 'rb') as flh:
+                    self.check_member(name, os.path.getsize(name), bu.md5sum_fileobj(flh))
+            bu.add_to_tar(tar, tarinfo)
+            self.references.append((name,) + ref)
+            return
+        if not tarinfo.isreg():
+            bu.add_to_tar(tar, tarinfo)
+            return
+        if not self.check_members:
+            with self.open_member(name) as flh:
+                bu.add_to_tar(tar, tarinfo, flh)
+            if fname in self.data and self.data[fname][1]:
+                self.contents.append((name, tarinfo.size, self.data[fname][1]))
+            return
+        if fname not in self.data and tarinfo.size > 10*(1024**2):
+            raise bu.ChecksumError("Unexpected file too large to archive: %s" % (os.path.join(self.path, name)))
+        cache = bu.get_checksum_cache()
+        md5 = None
+        if cache is not None:
+            key = cache.key(name)
+            md5 = cache.get(key)
+        cached = md5 is not None
+        if self.prefetcher is not None:
+            with self.prefetcher.open(name) as flh:
+                bu.add_to_tar(tar, tarinfo, flh)
+                if md5 is None:
+                    md5 = flh.md5sum()
+        elif cached:
+            # the file is unchanged since its md5sum was cached, so it does not need hashing
+            with open(name, 'rb') as flh:
+                bu.add_to_tar(tar, tarinfo, flh)
+        else:
+            with open(name, 'rb') as flh:
+                reader = bu.HashingReader(flh)
+                bu.add_to_tar(tar, tarinfo, reader)
+            md5 = reader.hexdigests()['md5']
+        self.check_member(name, tarinfo.size, md5)
+        if cache is not None and not cached:
+            cache.put(key, md5)
+        self.contents.append((name, tarinfo.size, md5))
+
+    def start_prefetch(self, members, done=None):
+        """ Method to start reading the files to be tarred ahead of when they are written, so
+            that reading them overlaps with writing the tar file
+
+            Parameters
+            ----------
+            members : list
+                List of tuples containing the path of each member and its TarInfo
+            done : dict
+                The members which are already in the tar file, which are not read (default
+                is None)
+        """
+        threads = int(self.args.get('prefetch_threads', 0))
+        if threads <= 0:
+            return
+        files = []
+        for name, tarinfo in members:
+            if tarinfo.isreg() and (not done or name not in done):
+                files.append((name, tarinfo.size))
+        memory = bu.calculate_archive_size(self.args.get('prefetch_memory', '256m'))
+        check = None
+        if self.check_members:
+            # the files are md5summed by the reader threads, in parallel
+            check = self.verify_member
+        self.prefetcher = bu.Prefetcher(files, threads, int(self.args.get('prefetch_depth', 16)), memory, check=check)
+
+    def stop_prefetch(self):
+        """ Method to stop reading ahead
+        """
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+
+    def open_member(self, name):
+        """ Method to open a file to be tarred, from the data read ahead if there is any
+
+            Parameters
+            ----------
+            name : str
+                The path of the file
+
+            Returns
+            -------
+            file object
+        """
+        if self.prefetcher is not None:
+            return self.prefetcher.open(name)
+        return open(name, 'rb')
+
+    def check_member(self, name, size, md5):
+        """ Method to compare the md5sum of a member, calculated as it was tarred, to the
+            md5sum in the database. Files which are not in the database are added to it.
+
+            Parameters
+            ----------
+            name : str
+                The path of the member
+            size : int
+                The size of the member in bytes
+            md5 : str
+                The md5sum calculated when the member was tarred
+        """
+        fname = os.path.basename(name)
+        self.verify_member(name, size, md5)
+        if fname not in self.data:
+            self.data[fname] = [size, md5]
+
+    def verify_member(self, name, size, md5):
+        """ Method to compare the md5sum of a member to the md5sum in the database, without
+            changing anything, so that it can be called from the threads reading ahead
+
+            Parameters
+            ----------
+            name : str
+                The path of the member
+            size : int
+                The size of the member in bytes
+            md5 : str
+                The md5sum of the member
+        """
+        fname = os.path.basename(name)
+        if fname not in self.data:
+            if size > 10*(1024**2):
+                raise bu.ChecksumError("Unexpected file too large to archive: %s" % (os.path.join(self.path, name)))
+            return
+        if md5 != self.data[fname][1]:
+            raise bu.ChecksumError("Incorrect md5sum in database for %s, it is listed as %s but is %s." % (os.path.join(self.path, name), self.data[fname][1], md5))
+
+    def get_index(self):
+        """ Method to return the index of the members of the tar file
+
+            Returns
+            -------
+            dict of tuples containing the header offset, data offset, and size of each member,
+            keyed by name, None if the tar file was not written by this instance
+        """
+        return self.index
 
     def get_md5sum(self):
         """ Method to return the md5sum
@@ -97,6 +736,22 @@ class DES_tarball(object):
         """
         return self.md5sum
 
+    def get_checksum(self, algorithm='md5'):
+        """ Method to return a checksum calculated while the tar file was written
+
+            Parameters
+            ----------
+            algorithm : str
+                The name of the checksum (default is 'md5')
+
+            Returns
+            -------
+            str containing the checksum, None if it was not calculated
+        """
+        if algorithm == 'md5':
+            return self.md5sum
+        return self.checksums.get(algorithm)
+
     def get_tar_name(self):
         """ Method to return the name of the tar file
 
@@ -0,0 +1,149 @@
+""" Module for planning which directories go in to which tape tars, so that each tape tar
+    is close to the requested size
+
+"""
+import datetime
+
+import archivetools.backup_util as bu
+
+# overhead of the tar headers for each file, and of the end of a tar file, in bytes
+FILE_OVERHEAD = 1024
+TAR_OVERHEAD = 10240
+
+
+def get_candidates(cur, max_pri, clss=None):
+    """ Method to get the directories waiting to be archived, with the estimated size of the unit
+        tar of each from the catalog entries of the files in them and their subdirectories.
+        Directories with no catalog entries are estimated as an empty tar.
+
+        Parameters
+        ----------
+        cur : cursor object
+        max_pri : int
+            The maximum priority level to include
+        clss : str
+            Only include directories of this class (default is None, include all classes)
+
+        Returns
+        -------
+        dict of lists of tuples containing the path, estimated size, and priority of each
+        directory, keyed by class
+    """
+    # the like finds the subdirectories using the index on path, the substr makes the match
+    # exact as the path may contain wildcards
+    sql = "select bd.PATH,bd.CLASS,bd.PRIORITY,count(f.filename),sum(f.filesize) from BACKUP_DIR bd left outer join " \
+          "(select fai.path,df.filename,df.filesize from file_archive_info fai, desfile df where df.filename=fai.filename and ((df.compression is null and fai.compression is null) or df.compression = fai.compression)) f " \
+          "on (f.path=bd.PATH or (f.path like bd.PATH || '/%' and substr(f.path, 1, length(bd.PATH) + 1)=bd.PATH || '/')) " \
+          "where bd.STATUS=0 and bd.RELEASE_DATE <= TO_DATE(:1, 'YYYY-MM-DD HH24:MI:SS') "
+    params = [datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')]
+    if clss:
+        sql += "and bd.CLASS=:2 "
+        params.append(clss)
+    else:
+        sql += "and bd.PRIORITY<=:2 "
+        params.append(int(max_pri))
+    sql += "group by bd.PATH,bd.CLASS,bd.PRIORITY"
+    bu.execute(cur, sql, params)
+    candidates = {}
+    for path, dclass, priority, count, size in cur.fetchall() or []:
+        est = TAR_OVERHEAD + FILE_OVERHEAD * count + (size or 0)
+        candidates.setdefault(dclass, []).append((path, est, priority))
+    return candidates
+
+def get_staged_size(cur, clss):
+    """ Method to get the total size of the unit tars of a class which are waiting to be put in a
+        tape tar
+
+        Parameters
+        ----------
+        cur : cursor object
+        clss : str
+            The class
+
+        Returns
+        -------
+        int, the size in bytes
+    """
+    bu.execute(cur, "select sum(TAR_SIZE) from BACKUP_UNIT where STATUS in (2,3) and FILE_TYPE=:1", [clss])
+    res = cur.fetchall()
+    if not res or res[0][0] is None:
+        return 0
+    return int(res[0][0])
+
+def plan_tapes(dirs, target, tolerance=0.05, current=0):
+    """ Method to assign directories to tape tars so that as many tape tars as possible are
+        within the tolerance of the target size. Directories are placed largest first, each
+        in the fullest tape tar it fits in without going over the upper limit.
+
+        Parameters
+        ----------
+        dirs : list
+            List of tuples containing the path, estimated size, and priority of each directory
+        target : int
+            The target size of the tape tars in bytes
+        tolerance : float
+            The allowed fractional difference from the target size (default is 0.05)
+        current : int
+            The size of the unit tars already waiting to be put in a tape tar, these go in
+            the first tape tar (default is 0)
+
+        Returns
+        -------
+        list of dicts, one per tape tar, containing the paths, estimated size, priority, and
+        whether it is complete (within the tolerance of the target size). The first tape tar
+        holds the unit tars already waiting.
+    """
+    upper = target * (1. + tolerance)
+    lower = target * (1. - tolerance)
+    tapes = [{'paths': [], 'size': current, 'staged': current, 'priority': None, 'complete': False}]
+    for path, size, priority in sorted(dirs, key=lambda d: d[1], reverse=True):
+        best = None
+        for tape in tapes:
+            if tape['size'] + size <= upper and (best is None or tape['size'] > best['size']):
+                best = tape
+        if best is None:
+            best = {'paths': [], 'size': 0, 'staged': 0, 'priority': None, 'complete': False}
+            tapes.append(best)
+        best['paths'].append(path)
+        best['size'] += size
+        if best['priority'] is None or priority < best['priority']:
+            best['priority'] = priority
+    for tape in tapes:
+        tape['complete'] = tape['size'] >= lower
+    # the first tape tar is kept first, as it has the waiting unit tars, the rest are complete
+    # ones first, then fullest first
+    tapes[1:] = sorted(tapes[1:], key=lambda t: (not t['complete'], -t['size']))
+    if not tapes[0]['paths'] and not tapes[0]['staged']:
+        del tapes[0]
+    return tapes
+
+def format_plan(clss, tapes, target, tolerance):
+    """ Method to generate a report of the planned tape tars of a class
+
+        Parameters
+        ----------
+        clss : str
+            The class
+        tapes : list
+            The plan, from plan_tapes
+        target : int
+            The target size of the tape tars in bytes
+        tolerance : float
+            The allowed fractional difference from the target size
+
+        Returns
+        -------
+        str containing the report
+    """
+    gbyte = 1024.**3
+    lines = ["Class %s: %i tape tars planned, target %.1f GB +/- %.0f%%" % (clss, len(tapes), target / gbyte, tolerance * 100.)]
+    for i, tape in enumerate(tapes):
+        line = "  tape %i: %8.1f GB  %5i directories" % (i + 1, tape['size'] / gbyte, len(tape['paths']))
+        if tape['staged']:
+            line += "  (includes %.1f GB already tarred)" % (tape['staged'] / gbyte)
+        if tape['complete']:
+            line += "  complete"
+        else:
+            line += "  partial, waiting for more data"
+        lines.append(line)
+    return "\n".join(lines)
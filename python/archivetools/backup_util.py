@@ -3,10 +3,17 @@
 import smtplib
 import os
 import re
+import time
 import hashlib
-import random
+import zlib
+import json
 import tarfile
-import shutil
+import struct
+import fcntl
+import mmap
+import threading
+import collections
+import sqlite3
 import logging
 from logging.handlers import TimedRotatingFileHandler
 from email.mime.text import MIMEText
@@ -15,152 +22,1965 @@ import matplotlib.pyplot as pyplot
 import despymisc.miscutils as miscutils
 import despydmdb.desdmdbi as desdmdbi
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 CLASSES = ['finalcut', 'coadd', 'multiepoch', 'y2reproc', 'firstcut', 'supercal', 'precal', 'sne', 'prebpm', 'photoz', 'raw']
+CHECKSUMS = ['md5', 'adler32', 'sha256', 'xxhash']
+# compression codecs for unit tars, and the extension added to the names of the tar files
+CODECS = {'gzip': '.gz',
+          'zstd': '.zst',
+          'lz4': '.lz4'}
+# files with these extensions are already compressed, and are not worth compressing again
+PRECOMPRESSED = ('.fz', '.gz', '.bz2', '.xz', '.zst', '.lz4', '.zip', '.jpg', '.png')
+# size of the blocks used to copy file data into tar files
+COPY_BLOCKSIZE = 2**22
+# prefix of the link name of tar file members which refer to identical files archived earlier
+DEDUP_PREFIX = 'desref:'
+# ioctl to get the physical extents of a file on linux
+FS_IOC_FIEMAP = 0xC020660B
+# orders the members of a tar file can be written in
+ORDERS = ['name', 'inode', 'extent']
+# number of statements kept parsed on each database connection
+STATEMENT_CACHE_SIZE = 64
+# prefix of the services given to get_util to use a local SQLite database file instead of Oracle
+LOCAL_PREFIX = 'sqlite:'
+# seconds a database connection can be unused before it is checked when next used
+IDLE_TIMEOUT = 300
+# number of directories looked up per query by locate_files, Oracle allows at most 1000 in a list
+LOCATE_CHUNK = 500
+
+# the class the SN manifest nites are counted under in BACKUP_SUMMARY, they are in BACKUP_DIR
+# with the class of the raw nites, but are reported separately
+SNMANIFEST_CLASS = 'SNMANIFEST'
+# the counters kept in BACKUP_SUMMARY of the rows of each table, by class and status, and the
+# queries which count them from scratch
+SUMMARY_ITEMS = {'DIR': "select case when PATH like 'DTS/snmanifest/%%' then '%s' else CLASS end,STATUS,count(*),0,max(RELEASE_DATE) from BACKUP_DIR "
+                        "group by case when PATH like 'DTS/snmanifest/%%' then '%s' else CLASS end,STATUS" % (SNMANIFEST_CLASS, SNMANIFEST_CLASS),
+                 'UNIT': "select FILE_TYPE,STATUS,count(*),sum(TAR_SIZE),max(CREATED_DATE) from BACKUP_UNIT group by FILE_TYPE,STATUS",
+                 'TAPE': "select FILE_TYPE,STATUS,count(*),sum(TAR_SIZE),max(CREATED_DATE) from BACKUP_TAPE group by FILE_TYPE,STATUS"}
+# the class counted in BACKUP_SUMMARY for rows without one, as Oracle treats '' as null
+NO_CLASS = 'NONE'
+
+# the statements in the cache, most recently used last, and the number of statements parsed
+# and executed
+_STATEMENTS = {'cache': collections.OrderedDict(),
+               'parses': 0,
+               'executes': 0}
+# the roots of the archives which have been looked up, by services file, section and archive
+_ARCHIVE_ROOTS = {}
+
+def _use_statement(sql):
+    """ Method to count the use of a statement, as a parse if it is not in the statement cache
+
+        Parameters
+        ----------
+        sql : str
+            The statement
+    """
+    cache = _STATEMENTS['cache']
+    if sql in cache:
+        del cache[sql]
+    else:
+        _STATEMENTS['parses'] += 1
+        while cache and len(cache) >= STATEMENT_CACHE_SIZE:
+            cache.popitem(last=False)
+    cache[sql] = True
+    _STATEMENTS['executes'] += 1
+
+def execute(cur, sql, params=None):
+    """ Method to execute a statement. Values must be passed as bind variables, rather than
+        formatted into the statement, so that each statement is only parsed once and is then
+        reused from the statement cache of the connection.
+
+        Parameters
+        ----------
+        cur : cursor object
+        sql : str
+            The statement, with numbered bind variables (:1, :2, ...)
+        params : list
+            The values of the bind variables (default is None)
+
+        Returns
+        -------
+        The cursor
+    """
+    _use_statement(sql)
+    if params is None:
+        cur.execute(sql)
+    else:
+        cur.execute(sql, params)
+    return cur
+
+def executemany(cur, sql, rows):
+    """ Method to execute a statement for each of a list of sets of bind variables, in one
+        round trip. This counts as a single execution.
+
+        Parameters
+        ----------
+        cur : cursor object
+        sql : str
+            The statement, with numbered bind variables (:1, :2, ...)
+        rows : list
+            The values of the bind variables for each execution
+    """
+    _use_statement(sql)
+    cur.prepare(sql)
+    cur.executemany(None, rows)
+
+def get_statement_stats():
+    """ Method to get the number of statements parsed and executed
+
+        Returns
+        -------
+        dict containing the number of parses, executions, and statements in the cache
+    """
+    return {'parses': _STATEMENTS['parses'],
+            'executes': _STATEMENTS['executes'],
+            'cached': len(_STATEMENTS['cache'])}
+
+def reset_statement_stats():
+    """ Method to empty the statement cache and reset the counts
+    """
+    _STATEMENTS['cache'].clear()
+    _STATEMENTS['parses'] = 0
+    _STATEMENTS['executes'] = 0
+
+def like_escape(text):
+    """ Method to escape the wildcards in a string, so it can be used in a like pattern with
+        escape '\\'
+
+        Parameters
+        ----------
+        text : str
+            The string to escape
+
+        Returns
+        -------
+        str, the escaped string
+    """
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def summary_class(path, clss):
+    """ Method to get the class a directory is counted under in BACKUP_SUMMARY
+
+        Parameters
+        ----------
+        path : str
+            The path of the directory, relative to the archive root
+        clss : str
+            The class of the directory in BACKUP_DIR
+
+        Returns
+        -------
+        str, the class
+    """
+    if path.startswith('DTS/snmanifest/'):
+        return SNMANIFEST_CLASS
+    return clss
+
+def update_summary(cur, changes):
+    """ Method to change the counters in BACKUP_SUMMARY, so that the totals of the backups can be
+        read without aggregating the catalog tables. It is called in the same transaction as
+        the changes being counted, which are committed by the caller.
+
+        Parameters
+        ----------
+        cur : cursor object
+        changes : list
+            Tuples of the item (a key of SUMMARY_ITEMS), class, status, and the change in the
+            number of rows and in their total size
+    """
+    totals = collections.OrderedDict()
+    for item, clss, status, num, size in changes:
+        key = (item, clss or NO_CLASS, status)
+        prev = totals.get(key, (0, 0))
+        totals[key] = (prev[0] + num, prev[1] + (size or 0))
+    rows = [list(key) + list(val) + list(key) + list(val) for key, val in totals.iteritems() if val != (0, 0)]
+    if not rows:
+        return
+    executemany(cur, "merge into BACKUP_SUMMARY bs using dual on (bs.ITEM=:1 and bs.CLASS=:2 and bs.STATUS=:3) "
+                "when matched then update set bs.NUM=bs.NUM+:4,bs.TOTAL_SIZE=bs.TOTAL_SIZE+:5,bs.LAST_DATE=SYSTIMESTAMP "
+                "when not matched then insert (ITEM,CLASS,STATUS,NUM,TOTAL_SIZE,LAST_DATE) values (:6,:7,:8,:9,:10,SYSTIMESTAMP)", rows)
+
+def rebuild_summary(cur):
+    """ Method to recount BACKUP_SUMMARY from the catalog tables, to start it or to correct it.
+        The changes are committed by the caller.
+
+        Parameters
+        ----------
+        cur : cursor object
+    """
+    rows = []
+    for item in sorted(SUMMARY_ITEMS):
+        for clss, status, num, size, last in execute(cur, SUMMARY_ITEMS[item]).fetchall():
+            rows.append([item, clss or NO_CLASS, status, num, size or 0, last])
+    execute(cur, "delete from BACKUP_SUMMARY")
+    executemany(cur, "insert into BACKUP_SUMMARY (ITEM,CLASS,STATUS,NUM,TOTAL_SIZE,LAST_DATE) values (:1,:2,:3,:4,:5,:6)", rows)
+
+def get_summary(cur):
+    """ Method to read BACKUP_SUMMARY
+
+        Parameters
+        ----------
+        cur : cursor object
+
+        Returns
+        -------
+        dict of the counters, keyed by item, class and status, each a dict of the number of
+        rows, their total size in bytes, and when the counter last changed
+    """
+    summary = {}
+    for item, clss, status, num, size, last in execute(cur, "select ITEM,CLASS,STATUS,NUM,TOTAL_SIZE,LAST_DATE from BACKUP_SUMMARY").fetchall():
+        summary[(item, clss, status)] = {'num': num, 'size': size, 'last_date': last}
+    return summary
+
 def locate(util, filename=None, reqnum=None, unitname=None, attnum=None, pfwid=None, rootpath=None, archive=None):
     """ Method to locate the unit and tape_tar files for the given inputs
 
         Parameters
         ----------
         util : Util instance
-        filename : str
-            The name of the file to locate in the backups
-        reqnum : int
-            The reqnum to locate in the backups (must be accompanied by unitname and attnum)
-        unitname : str
-            The unitname to locate in the backups (must be accompanied by reqnum and attnum)
-        attnum : str
-            The attnum to locate in the backups (must be accompanied by reqnum and unitname)
-        pfwid : int
-            The pfw_attempt_id to locate in the backups
-        rootpath : str
-            The path to locate in the backups
-        archive : str
-            The name of the archive to look in
+        filename : str
+            The name of the file to locate in the backups
+        reqnum : int
+            The reqnum to locate in the backups (must be accompanied by unitname and attnum)
+        unitname : str
+            The unitname to locate in the backups (must be accompanied by reqnum and attnum)
+        attnum : str
+            The attnum to locate in the backups (must be accompanied by reqnum and unitname)
+        pfwid : int
+            The pfw_attempt_id to locate in the backups
+        rootpath : str
+            The path to locate in the backups
+        archive : str
+            The name of the archive to look in
+
+        Returns
+        -------
+        Tuple containing the unit name, created date, tape tar name, created date, and
+        transferred date (None, None, None, None, None) if not found. If the file was archived
+        as a reference to an identical file, the location of its contents is in 'reference'.
+    """
+    data = {'unit': None,
+            'unitdate': None,
+            'tape': None,
+            'tapedate': None,
+            'transdate': None,
+            'arch_root': None,
+            'path': None,
+            'reference': None}
+    cur = util.cursor()
+    if archive:
+        execute(cur, "select root from ops_archive where name=:1", [archive])
+        res = cur.fetchall()
+        if res:
+            data['arch_root'] = res[0][0]
+    if filename:
+        (fname, compression) = miscutils.parse_fullname(filename, miscutils.CU_PARSE_FILENAME | miscutils.CU_PARSE_COMPRESSION)
+        if compression:
+            execute(cur, "select fai.path, pfw.archive_path from file_archive_info fai, desfile df, pfw_attempt pfw where df.filename=:1 and df.compression=:2 and df.pfw_attempt_id=pfw.id and fai.desfile_id=df.id", [fname, compression])
+        else:
+            execute(cur, "select fai.path, pfw.archive_path from file_archive_info fai, desfile df, pfw_attempt pfw where df.filename=:1 and df.compression is null and df.pfw_attempt_id=pfw.id and fai.desfile_id=df.id", [filename])
+        res = cur.fetchall()
+        if not res:
+            if compression:
+                execute(cur, "select archive_path from pfw_attempt pfw, desfile df where df.filename=:1 and df.compression=:2 and df.pfw_attempt_id=pfw.id", [fname, compression])
+            else:
+                execute(cur, "select archive_path from pfw_attempt pfw, desfile df where df.filename=:1 and df.pfw_attempt_id=pfw.id", [fname])
+            res = cur.fetchall()
+            #print res
+            if not res:
+                print "File %s not found in DESFILE" % (filename)
+                return data
+            path = res[0][0]
+            print "File found in DESFILE with archive path: %s (full path to file unavailable)" % (path)
+        else:
+            path = res[0][1]
+            print "File found with path %s and an attempt archive path of %s" % (res[0][0], path)
+        data['path'] = path
+    elif reqnum and unitname and attnum:
+        execute(cur, "select archive_path from pfw_attempt where reqnum=:1 and unitname=:2 and attnum=:3", [int(reqnum), unitname, int(attnum)])
+        res = cur.fetchall()
+        if not res:
+            print "Attempt not found in PFW_ATTEMPT"
+            return data
+        path = res[0][0]
+        data['path'] = path
+        print "Found archive path of %s for this attempt" % (path)
+    elif pfwid:
+        execute(cur, "select archive_path from pfw_attempt where id=:1", [int(pfwid)])
+        res = cur.fetchall()
+        if not res:
+            print "Attempt not found in PFW_ATTEMPT"
+            return data
+        path = res[0][0]
+        data['path'] = path
+        print "Found archive path of %s for this attempt" % (path)
+    elif rootpath:
+        if rootpath.startswith('/'):
+            if archive:
+                if not data['arch_root']:
+                    print "Could not locate archive in ops_archive."
+                    return data
+                arch_root = res[0][0]
+                path = rootpath.replace(arch_root + '/', '')
+            else:
+                print "Invalid path given. It must not start with a / unless an archive is also given."
+                return data
+        else:
+            path = rootpath
+        data['path'] = path
+    else:
+        raise ValueError("Invalid entries given")
+
+
+    # the deepest directory containing the path which has been archived, and its unit and
+    # tape tars, are found in one query
+    ancestors = get_ancestors(path)
+    units = get_dir_units(cur, ancestors)
+    found = [anc for anc in ancestors if anc in units]
+    if not found:
+        print "Cannot find path in the archive, or the path is too low in the data structure."
+        return data
+    found = found[0]
+    data.update(units[found])
+    if found != path:
+        print "Found archive path of %s for given path" % (found)
+
+    if data['unit'] is None:
+        print "Item %s has not been added to a backup unit yet." % (found)
+        return data
+    if filename:
+        data['reference'] = find_reference(cur, data['unit'], filename)
+        if data['reference']:
+            print "The contents of %s are stored as %s in unit tar %s" % (filename, data['reference']['member'], data['reference']['unit'])
+    return data
+
+def get_ancestors(path, multiple=8):
+    """ Method to get a path and all of the directories above it, as the bind variables of a
+        query. The list is padded with None to a multiple of the given length, so that queries
+        of paths of similar depth have the same statement.
+
+        Parameters
+        ----------
+        path : str
+            The path, relative to the archive root
+        multiple : int
+            Pad the list to a multiple of this length (default is 8)
+
+        Returns
+        -------
+        list of the path and the directories above it, deepest first
+    """
+    parts = path.strip('/').split('/')
+    ancestors = ['/'.join(parts[:i]) for i in range(len(parts), 0, -1)]
+    return ancestors + [None] * (-len(ancestors) % multiple)
+
+def get_dir_units(cur, paths):
+    """ Method to get the unit and tape tars of archived directories, joining BACKUP_DIR to
+        BACKUP_UNIT and BACKUP_TAPE in one query
+
+        Parameters
+        ----------
+        cur : cursor object
+        paths : list
+            The directory paths to look for, relative to the archive root, padded with None
+            as from get_ancestors
+
+        Returns
+        -------
+        dict of the paths which are in BACKUP_DIR, each a dict of the unit name, created
+        date, tape tar name, created date, and transferred date (None if not yet set)
+    """
+    binds = [":%i" % (i + 1) for i in range(len(paths))]
+    execute(cur, "select bd.PATH,bd.UNIT_NAME,u.CREATED_DATE,u.TAPE_TAR,t.NAME,t.CREATED_DATE,t.TRANSFER_DATE from BACKUP_DIR bd "
+            "left outer join BACKUP_UNIT u on u.NAME=bd.UNIT_NAME left outer join BACKUP_TAPE t on t.NAME=u.TAPE_TAR "
+            "where bd.PATH in (%s)" % (",".join(binds)), paths)
+    units = {}
+    for path, unit, unitdate, tape, tape_name, tapedate, transdate in cur.fetchall() or []:
+        if tape is not None and tape_name is None:
+            # the unit tar has been streamed into a tape tar which is still being written
+            tape = None
+        units[path] = {'unit': unit,
+                       'unitdate': unitdate,
+                       'tape': tape,
+                       'tapedate': tapedate,
+                       'transdate': transdate}
+    return units
+
+def locate_files(util, filenames, chunk=LOCATE_CHUNK):
+    """ Method to locate the unit and tape tars of many files at once. The names are loaded
+        in to the filename GTT with one array insert, their archive paths are found with one
+        join, and the archived directories above them are looked up in chunks.
+
+        Parameters
+        ----------
+        util : Util instance
+        filenames : list
+            The names of the files to locate, including any compression extension
+        chunk : int
+            The number of directories to look up per query (default is LOCATE_CHUNK)
+
+        Returns
+        -------
+        list of dicts, one per file in the order given, containing the file name, its archive
+        path (None if not found in DESFILE), the archived directory containing it, and the
+        unit and tape tars and dates as from locate
+    """
+    files = collections.OrderedDict()
+    for filename in filenames:
+        (fname, compression) = miscutils.parse_fullname(filename, miscutils.CU_PARSE_FILENAME | miscutils.CU_PARSE_COMPRESSION)
+        files[(fname, compression)] = {'filename': filename,
+                                       'compression': compression,
+                                       'path': None,
+                                       'dir': None,
+                                       'unit': None,
+                                       'unitdate': None,
+                                       'tape': None,
+                                       'tapedate': None,
+                                       'transdate': None}
+    if not files:
+        return []
+    gtt = util.load_gtt_filename([{'filename': key[0], 'compression': key[1]} for key in files])
+    cur = util.cursor()
+    # the path of the file if it is in FILE_ARCHIVE_INFO, otherwise the archive path of
+    # its attempt
+    execute(cur, "select gtt.FILENAME,gtt.COMPRESSION,fai.PATH,pfw.ARCHIVE_PATH from %s gtt "
+            "inner join DESFILE df on df.FILENAME=gtt.FILENAME and (df.COMPRESSION=gtt.COMPRESSION or (df.COMPRESSION is null and gtt.COMPRESSION is null)) "
+            "left outer join FILE_ARCHIVE_INFO fai on fai.DESFILE_ID=df.ID "
+            "left outer join PFW_ATTEMPT pfw on pfw.ID=df.PFW_ATTEMPT_ID" % (gtt))
+    for fname, compression, fpath, apath in cur.fetchall() or []:
+        entry = files.get((fname, compression))
+        if entry is not None and entry['path'] is None:
+            entry['path'] = fpath or apath
+
+    ancestors = set()
+    for entry in files.itervalues():
+        if entry['path']:
+            ancestors.update(get_ancestors(entry['path'], 1))
+    ancestors = sorted(ancestors)
+    units = {}
+    for i in range(0, len(ancestors), chunk):
+        paths = ancestors[i:i + chunk]
+        units.update(get_dir_units(cur, paths + [None] * (chunk - len(paths))))
+    for entry in files.itervalues():
+        if not entry['path']:
+            continue
+        for anc in get_ancestors(entry['path'], 1):
+            if anc in units:
+                entry['dir'] = anc
+                entry.update(units[anc])
+                break
+    return files.values()
+
+def find_reference(cur, unit, filename):
+    """ Method to find where the contents of a file are stored, if the file was archived as a
+        reference to an identical file archived earlier
+
+        Parameters
+        ----------
+        cur : cursor object
+        unit : str
+            The name of the unit tar the file is in
+        filename : str
+            The name of the file
+
+        Returns
+        -------
+        dict containing the unit tar, member name, and tape tar holding the contents of the
+        file, None if the file is not a reference
+    """
+    # the name is compared exactly, as '_' in a like pattern matches any character
+    execute(cur, "select REF_UNIT,REF_MEMBER from BACKUP_REFERENCE where UNIT_NAME=:1 and (MEMBER=:2 or substr(MEMBER, -length(:3)-1)='/' || :4)", [unit, filename, filename, filename])
+    res = cur.fetchall()
+    if not res:
+        return None
+    ref = {'unit': res[0][0],
+           'member': res[0][1],
+           'tape': None}
+    execute(cur, "select TAPE_TAR from BACKUP_UNIT where NAME=:1", [ref['unit']])
+    res = cur.fetchall()
+    if res:
+        ref['tape'] = res[0][0]
+    return ref
+
+def make_reference(unit, member):
+    """ Method to generate the link name of a tar file member which refers to the contents of
+        a file archived earlier
+
+        Parameters
+        ----------
+        unit : str
+            The name of the unit tar holding the contents
+        member : str
+            The name of the member in the unit tar holding the contents
+
+        Returns
+        -------
+        str, the link name
+    """
+    return DEDUP_PREFIX + unit + '/' + member
+
+def parse_reference(linkname):
+    """ Method to get the unit tar and member name from the link name of a reference member
+
+        Parameters
+        ----------
+        linkname : str
+            The link name of the member
+
+        Returns
+        -------
+        Tuple containing the unit tar and member name, None if the link name is not a reference
+    """
+    if not linkname or not linkname.startswith(DEDUP_PREFIX):
+        return None
+    return tuple(linkname[len(DEDUP_PREFIX):].split('/', 1))
+
+def generate_md5sum(filename, use_cache=True):
+    """ Method to generate the md5sum of a file. If a checksum cache has been set up then
+        the md5sum is taken from it if the file has not changed since it was cached.
+
+        Parameters
+        ----------
+        filename : str
+            The name of the file to generate the md5sum from
+        use_cache : bool
+            If False then the checksum cache is not used (default is True)
+
+        Returns
+        -------
+        str, containing the md5sum
+    """
+    cache = None
+    if use_cache:
+        cache = get_checksum_cache()
+    if cache is not None:
+        key = cache.key(filename)
+        md5 = cache.get(key)
+        if md5 is not None:
+            return md5
+    md5 = hash_file(filename)['md5']
+    if cache is not None:
+        cache.put(key, md5)
+    return md5
+
+class ChecksumCache(object):
+    """ Class for a persistent cache of the md5sums of files, kept in an SQLite database. Files
+        are identified by their device and inode, and an entry is only used if the size and
+        modification time of the file are unchanged. The least recently used entries are
+        removed once there are more than max_entries.
+
+        Parameters
+        ----------
+        filename : str
+            The name of the database file
+        max_entries : int
+            The maximum number of entries to keep (default is 10000000)
+    """
+    def __init__(self, filename, max_entries=10000000):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.con = None
+        self.pid = None
+        self.added = 0
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        """ Method to connect to the database, a new connection is made in each process
+        """
+        if self.con is not None and self.pid == os.getpid():
+            return
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.con = sqlite3.connect(self.filename, timeout=60, check_same_thread=False)
+        # it is only a cache, so speed matters more than surviving a crash
+        self.con.execute("pragma synchronous=OFF")
+        self.con.execute("create table if not exists CHECKSUM (DEV integer, INODE integer, SIZE integer, MTIME_NS integer, MD5SUM text, USED real, primary key (DEV, INODE))")
+        self.con.execute("create index if not exists CHECKSUM_USED on CHECKSUM (USED)")
+        self.con.commit()
+        self.pid = os.getpid()
+
+    @staticmethod
+    def key(filename):
+        """ Method to get the cache key of a file
+
+            Parameters
+            ----------
+            filename : str
+                The name of the file
+
+            Returns
+            -------
+            Tuple containing the device, inode, size, and modification time in ns of the file
+        """
+        stat = os.stat(filename)
+        return (stat.st_dev, stat.st_ino, stat.st_size, int(round(stat.st_mtime * 10**9)))
+
+    def get(self, key):
+        """ Method to get the md5sum of a file from the cache
+
+            Parameters
+            ----------
+            key : tuple
+                The key of the file, from key
+
+            Returns
+            -------
+            str containing the md5sum, None if the file is not in the cache or has changed
+        """
+        with self.lock:
+            self._connect()
+            res = self.con.execute("select MD5SUM from CHECKSUM where DEV=? and INODE=? and SIZE=? and MTIME_NS=?", key).fetchone()
+            if res is None:
+                return None
+            self.con.execute("update CHECKSUM set USED=? where DEV=? and INODE=?", (time.time(), key[0], key[1]))
+            self.con.commit()
+            return str(res[0])
+
+    def put(self, key, md5):
+        """ Method to add the md5sum of a file to the cache
+
+            Parameters
+            ----------
+            key : tuple
+                The key of the file, from key
+            md5 : str
+                The md5sum of the file
+        """
+        with self.lock:
+            self._connect()
+            self.con.execute("insert or replace into CHECKSUM (DEV,INODE,SIZE,MTIME_NS,MD5SUM,USED) values (?,?,?,?,?,?)", tuple(key) + (md5, time.time()))
+            self.added += 1
+            if self.added % 1000 == 0:
+                self._evict()
+            self.con.commit()
+
+    def _evict(self):
+        """ Method to remove the least recently used entries if there are too many, down to 90%
+            of the maximum, the lock must be held
+        """
+        count = self.con.execute("select count(*) from CHECKSUM").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        self.con.execute("delete from CHECKSUM where rowid in (select rowid from CHECKSUM order by USED limit ?)", (count - int(self.max_entries * 0.9),))
+
+    def close(self):
+        """ Method to close the database
+        """
+        with self.lock:
+            if self.con is not None:
+                self._evict()
+                self.con.commit()
+                self.con.close()
+                self.con = None
+
+_CHECKSUM_CACHE = {'cache': None}
+
+def set_checksum_cache(filename, max_entries=10000000):
+    """ Method to set up the checksum cache used by generate_md5sum, and when files are checked
+        as they are tarred
+
+        Parameters
+        ----------
+        filename : str
+            The name of the database file, None to turn off the cache
+        max_entries : int
+            The maximum number of entries to keep (default is 10000000)
+    """
+    if _CHECKSUM_CACHE['cache'] is not None:
+        _CHECKSUM_CACHE['cache'].close()
+    _CHECKSUM_CACHE['cache'] = None
+    if filename is not None:
+        _CHECKSUM_CACHE['cache'] = ChecksumCache(filename, max_entries)
+
+def get_checksum_cache():
+    """ Method to get the checksum cache
+
+        Returns
+        -------
+        ChecksumCache instance, None if there is no cache
+    """
+    return _CHECKSUM_CACHE['cache']
+
+def md5sum_fileobj(flh):
+    """ Method to generate the md5sum of the contents of an open file object, reading it
+        sequentially to the end
+
+        Parameters
+        ----------
+        flh : file object
+            The file object to read
+
+        Returns
+        -------
+        str, containing the md5sum
+    """
+    return hash_fileobj(flh)['md5']
+
+def hash_fileobj(flh, algorithms=('md5',), blksize=COPY_BLOCKSIZE):
+    """ Method to calculate any combination of checksums of the contents of an open file
+        object in a single pass, reading it sequentially to the end. Files are read in to one
+        reused buffer.
+
+        Parameters
+        ----------
+        flh : file object
+            The file object to read
+        algorithms : list
+            The names of the checksums to calculate, from CHECKSUMS (default is ['md5'])
+        blksize : int
+            The size of the blocks to read in bytes (default is COPY_BLOCKSIZE)
+
+        Returns
+        -------
+        dict of the checksums, keyed by name
+    """
+    checksum = Checksum(algorithms)
+    if hasattr(flh, 'readinto'):
+        buf = bytearray(blksize)
+        while True:
+            nbytes = flh.readinto(buf)
+            if not nbytes:
+                break
+            checksum.update(buffer(buf, 0, nbytes))
+    else:
+        for chunk in iter(lambda: flh.read(blksize), ''):
+            checksum.update(chunk)
+    return checksum.hexdigests()
+
+def hash_file(filename, algorithms=('md5',), blksize=COPY_BLOCKSIZE, use_mmap=False):
+    """ Method to calculate any combination of checksums of a file in a single pass
+
+        Parameters
+        ----------
+        filename : str
+            The name of the file
+        algorithms : list
+            The names of the checksums to calculate, from CHECKSUMS (default is ['md5'])
+        blksize : int
+            The size of the blocks to read, or hash from the memory map, in bytes (default
+            is COPY_BLOCKSIZE)
+        use_mmap : bool
+            If True then the file is memory mapped rather than read (default is False)
+
+        Returns
+        -------
+        dict of the checksums, keyed by name
+    """
+    with open(filename, 'rb') as flh:
+        if not use_mmap:
+            return hash_fileobj(flh, algorithms, blksize)
+        checksum = Checksum(algorithms)
+        size = os.fstat(flh.fileno()).st_size
+        if size > 0:
+            mapped = mmap.mmap(flh.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset in xrange(0, size, blksize):
+                    checksum.update(buffer(mapped, offset, blksize))
+            finally:
+                mapped.close()
+        return checksum.hexdigests()
+
+def get_checksum_list(checksums=None):
+    """ Method to turn a comma separated list of checksum names into a list, md5 is always included
+
+        Parameters
+        ----------
+        checksums : str
+            Comma separated list of checksums (i.e. 'adler32,sha256'), (default is None)
+
+        Returns
+        -------
+        List of the checksum names
+    """
+    algorithms = ['md5']
+    if checksums:
+        for alg in checksums.split(','):
+            alg = alg.strip().lower()
+            if alg and alg not in algorithms:
+                algorithms.append(alg)
+    return algorithms
+
+class Checksum(object):
+    """ Class to calculate one or more checksums of a stream of data in a single pass
+
+        Parameters
+        ----------
+        algorithms : list
+            The names of the checksums to calculate, from CHECKSUMS (default is ['md5'])
+    """
+    def __init__(self, algorithms=('md5',)):
+        self.algorithms = list(algorithms)
+        self.hashes = {}
+        self.adler = None
+        for alg in self.algorithms:
+            if alg not in CHECKSUMS:
+                raise ValueError("Unknown checksum type %s" % (alg))
+            if alg == 'adler32':
+                self.adler = 1
+            elif alg == 'xxhash':
+                if xxhash is None:
+                    raise ValueError("The xxhash module is needed for xxhash checksums")
+                self.hashes[alg] = xxhash.xxh64()
+            else:
+                self.hashes[alg] = hashlib.new(alg)
+
+    def update(self, data):
+        """ Method to add data to the checksums
+
+            Parameters
+            ----------
+            data : str
+                The data to add
+        """
+        for hsh in self.hashes.itervalues():
+            hsh.update(data)
+        if self.adler is not None:
+            self.adler = zlib.adler32(data, self.adler)
+
+    def hexdigest(self, algorithm='md5'):
+        """ Method to get the current value of a checksum
+
+            Parameters
+            ----------
+            algorithm : str
+                The name of the checksum (default is 'md5')
+
+            Returns
+            -------
+            str containing the checksum
+        """
+        if algorithm == 'adler32':
+            return '%08x' % (self.adler & 0xffffffff)
+        return self.hashes[algorithm].hexdigest()
+
+    def hexdigests(self):
+        """ Method to get the current value of all checksums
+
+            Returns
+            -------
+            dict of the checksums, keyed by name
+        """
+        return dict((alg, self.hexdigest(alg)) for alg in self.algorithms)
+
+class HashingWriter(object):
+    """ Class which wraps a file object, calculating the checksums of the data as it is written,
+        so that the file does not need to be read back in to get its checksum
+
+        Parameters
+        ----------
+        fileobj : file object
+            The file to write to
+        algorithms : list
+            The names of the checksums to calculate (default is ['md5'])
+    """
+    def __init__(self, fileobj, algorithms=('md5',)):
+        self.fileobj = fileobj
+        self.name = getattr(fileobj, 'name', None)
+        self.checksum = Checksum(algorithms)
+        self.size = 0
+
+    def write(self, data):
+        """ Method to write data to the file
+
+            Parameters
+            ----------
+            data : str
+                The data to write
+        """
+        self.fileobj.write(data)
+        self.checksum.update(data)
+        self.size += len(data)
+
+    def tell(self):
+        """ Method to get the number of bytes written
+
+            Returns
+            -------
+            int, the number of bytes written
+        """
+        return self.size
+
+    def flush(self):
+        """ Method to flush the underlying file
+        """
+        self.fileobj.flush()
+
+    def close(self):
+        """ Method to close the underlying file
+        """
+        self.fileobj.close()
+
+    def sync(self):
+        """ Method to make sure everything written so far is on disk
+        """
+        self.fileobj.flush()
+        os.fsync(self.fileobj.fileno())
+
+    def rewind(self, size):
+        """ Method to truncate the file to the given size and recalculate the checksums from
+            what remains, the file is left positioned at its end. The file must have been
+            opened for both reading and writing.
+
+            Parameters
+            ----------
+            size : int
+                The size to truncate the file to in bytes
+        """
+        blksize = 2**20
+        self.fileobj.flush()
+        self.fileobj.truncate(size)
+        self.fileobj.seek(0)
+        self.checksum = Checksum(self.checksum.algorithms)
+        self.size = 0
+        while self.size < size:
+            chunk = self.fileobj.read(min(blksize, size - self.size))
+            if not chunk:
+                raise IOError("File %s is shorter than %i bytes" % (self.name, size))
+            self.checksum.update(chunk)
+            self.size += len(chunk)
+        self.fileobj.seek(size)
+
+    def hexdigests(self):
+        """ Method to get the checksums of all data written
+
+            Returns
+            -------
+            dict of the checksums, keyed by name
+        """
+        return self.checksum.hexdigests()
+
+class HashingReader(object):
+    """ Class which wraps a file object, calculating the checksums of the data as it is read
+
+        Parameters
+        ----------
+        fileobj : file object
+            The file to read from
+        algorithms : list
+            The names of the checksums to calculate (default is ['md5'])
+    """
+    def __init__(self, fileobj, algorithms=('md5',)):
+        self.fileobj = fileobj
+        self.checksum = Checksum(algorithms)
+        self.size = 0
+
+    def read(self, size=-1):
+        """ Method to read data from the file
+
+            Parameters
+            ----------
+            size : int
+                The maximum number of bytes to read (default is -1, read to the end)
+
+            Returns
+            -------
+            str of the data read
+        """
+        data = self.fileobj.read(size)
+        self.checksum.update(data)
+        self.size += len(data)
+        return data
+
+    def hexdigests(self):
+        """ Method to get the checksums of all data read
+
+            Returns
+            -------
+            dict of the checksums, keyed by name
+        """
+        return self.checksum.hexdigests()
+
+class ChecksumError(Exception):
+    """ Exception raised when the checksum of a file does not match what is expected
+    """
+    pass
+
+def padded_size(size):
+    """ Method to get the space taken in a tar file by the data of a member of the given size
+
+        Parameters
+        ----------
+        size : int
+            The size of the member in bytes
+
+        Returns
+        -------
+        int, the size rounded up to a whole number of tar blocks
+    """
+    blocks, remainder = divmod(size, tarfile.BLOCKSIZE)
+    if remainder > 0:
+        blocks += 1
+    return blocks * tarfile.BLOCKSIZE
+
+def copy_data(src, dst, size, blksize=COPY_BLOCKSIZE):
+    """ Method to copy data from one file object to another in large blocks
+
+        Parameters
+        ----------
+        src : file object
+            The file to read from
+        dst : file object
+            The file to write to
+        size : int
+            The number of bytes to copy
+        blksize : int
+            The size of the blocks to copy in bytes (default is COPY_BLOCKSIZE)
+    """
+    remaining = size
+    while remaining > 0:
+        data = src.read(min(blksize, remaining))
+        if not data:
+            raise IOError("end of file reached")
+        dst.write(data)
+        remaining -= len(data)
+
+def add_to_tar(tar, tarinfo, fileobj=None):
+    """ Method to add a member to a tar file, the output is the same as from TarFile.addfile,
+        but the data are copied in large blocks rather than 16 KB ones
+
+        Parameters
+        ----------
+        tar : TarFile instance
+            The tar file, opened for writing
+        tarinfo : TarInfo instance
+            The header information of the member
+        fileobj : file object
+            The file to read the data of the member from (default is None, the member has no data)
+    """
+    buf = tarinfo.tobuf(tar.format, tar.encoding, tar.errors)
+    tar.fileobj.write(buf)
+    tar.offset += len(buf)
+    if fileobj is not None:
+        copy_data(fileobj, tar.fileobj, tarinfo.size)
+        padded = padded_size(tarinfo.size)
+        if padded > tarinfo.size:
+            tar.fileobj.write(tarfile.NUL * (padded - tarinfo.size))
+        tar.offset += padded
+    tar.members.append(tarinfo)
+
+class _PrefetchBuffer(object):
+    """ Class holding the data read ahead from one file
+    """
+    def __init__(self):
+        self.chunks = collections.deque()
+        self.done = False
+        self.closed = False
+        self.error = None
+        self.md5 = None
+
+
+class Prefetcher(object):
+    """ Class which reads files ahead of when they are needed, in a pool of threads, so that
+        the time spent opening and reading them overlaps with writing the files before them.
+        The files must be opened, with open, in the order they are given. The amount of data
+        held in memory is limited, except for the file currently being read by the caller.
+        If a check function is given then each file is md5summed by the thread reading it,
+        and checked as soon as it has been read, the first failed check is raised when the
+        caller next opens or reads a file.
+
+        Parameters
+        ----------
+        files : list
+            List of tuples containing the path and size of each file, in the order they will
+            be read
+        threads : int
+            The number of reader threads (default is 4)
+        depth : int
+            The maximum number of files to read ahead (default is 16)
+        memory : int
+            The maximum number of bytes to hold in memory (default is 256 MB)
+        blksize : int
+            The size of the blocks to read in bytes (default is COPY_BLOCKSIZE)
+        check : function
+            Function called with the path, size, and md5sum of each file once it has been
+            read, it raises ChecksumError if the file is bad (default is None, the files are
+            not md5summed)
+    """
+    def __init__(self, files, threads=4, depth=16, memory=2**28, blksize=COPY_BLOCKSIZE, check=None):
+        self.files = list(files)
+        self.position = {}
+        for i, (name, _) in enumerate(self.files):
+            self.position[name] = i
+        self.buffers = [_PrefetchBuffer() for _ in self.files]
+        self.depth = max(depth, 1)
+        self.memory = memory
+        self.blksize = blksize
+        self.check = check
+        self.failure = None
+        self.lock = threading.Condition()
+        self.next = 0
+        self.current = 0
+        self.buffered = 0
+        self.closed = False
+        self.threads = []
+        for _ in range(max(threads, 1)):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _run(self):
+        """ Method run by each reader thread, taking the next file to be read until there are
+            none left
+        """
+        while True:
+            with self.lock:
+                while not self.closed and self.next < len(self.files) and self.next >= self.current + self.depth:
+                    self.lock.wait()
+                if self.closed or self.next >= len(self.files):
+                    return
+                index = self.next
+                self.next += 1
+            buf = self.buffers[index]
+            try:
+                self._fill(index, buf)
+            except (IOError, OSError), ex:
+                buf.error = ex
+            except ChecksumError, ex:
+                with self.lock:
+                    if self.failure is None:
+                        self.failure = ex
+                    # stop reading ahead, as the caller will give up
+                    self.closed = True
+            with self.lock:
+                buf.done = True
+                self.lock.notify_all()
+
+    def _fill(self, index, buf):
+        """ Method to read a file in to its buffer
+
+            Parameters
+            ----------
+            index : int
+                The position of the file in the list of files
+            buf : _PrefetchBuffer instance
+                The buffer to read in to
+        """
+        name, size = self.files[index]
+        if index < self.current:
+            return
+        md5 = None
+        if self.check is not None:
+            md5 = hashlib.md5()
+        with open(name, 'rb') as flh:
+            remaining = size
+            while remaining > 0:
+                chunk = flh.read(min(self.blksize, remaining))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                if md5 is not None:
+                    # large updates release the GIL, so the threads hash in parallel
+                    md5.update(chunk)
+                with self.lock:
+                    while not self.closed and index > self.current and self.buffered + len(chunk) > self.memory:
+                        self.lock.wait()
+                    if self.closed or index < self.current or buf.closed:
+                        return
+                    buf.chunks.append(chunk)
+                    self.buffered += len(chunk)
+                    self.lock.notify_all()
+        if md5 is not None:
+            buf.md5 = md5.hexdigest()
+            self.check(name, size, buf.md5)
+
+    def open(self, name):
+        """ Method to open one of the files, any files before it which have not been opened
+            are skipped
+
+            Parameters
+            ----------
+            name : str
+                The path of the file
+
+            Returns
+            -------
+            file like object to read the file from
+        """
+        index = self.position[name]
+        with self.lock:
+            if self.failure is not None:
+                raise self.failure
+            while self.current < index:
+                self._discard(self.current)
+                self.current += 1
+            self.lock.notify_all()
+        return PrefetchedFile(self, index)
+
+    def get(self, index):
+        """ Method to get the next block of data read from a file
+
+            Parameters
+            ----------
+            index : int
+                The position of the file in the list of files
+
+            Returns
+            -------
+            str of the data, empty at the end of the file
+        """
+        buf = self.buffers[index]
+        with self.lock:
+            while not buf.chunks and not buf.done and self.failure is None:
+                # a timeout lets the main thread be interrupted
+                self.lock.wait(1.0)
+            if self.failure is not None:
+                raise self.failure
+            if buf.chunks:
+                chunk = buf.chunks.popleft()
+                self.buffered -= len(chunk)
+                self.lock.notify_all()
+                return chunk
+        if buf.error is not None:
+            raise buf.error
+        return ''
+
+    def _discard(self, index):
+        """ Method to throw away any data read from a file, the lock must be held
+
+            Parameters
+            ----------
+            index : int
+                The position of the file in the list of files
+        """
+        buf = self.buffers[index]
+        buf.closed = True
+        while buf.chunks:
+            self.buffered -= len(buf.chunks.popleft())
+
+    def close(self):
+        """ Method to stop the reader threads and throw away any data read
+        """
+        with self.lock:
+            self.closed = True
+            for index in range(self.current, len(self.files)):
+                self._discard(index)
+            self.lock.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+
+class PrefetchedFile(object):
+    """ Class for reading a file which has been read ahead by a Prefetcher
+
+        Parameters
+        ----------
+        prefetcher : Prefetcher instance
+            The Prefetcher reading the file
+        index : int
+            The position of the file in the list of files of the Prefetcher
+    """
+    def __init__(self, prefetcher, index):
+        self.prefetcher = prefetcher
+        self.index = index
+        self.data = ''
+
+    def read(self, size=-1):
+        """ Method to read data from the file
+
+            Parameters
+            ----------
+            size : int
+                The maximum number of bytes to read (default is -1, read to the end)
+
+            Returns
+            -------
+            str of the data read
+        """
+        pieces = [self.data]
+        length = len(self.data)
+        while size < 0 or length < size:
+            chunk = self.prefetcher.get(self.index)
+            if not chunk:
+                break
+            pieces.append(chunk)
+            length += len(chunk)
+        data = ''.join(pieces)
+        if size < 0:
+            size = len(data)
+        self.data = data[size:]
+        return data[:size]
+
+    def md5sum(self):
+        """ Method to get the md5sum of the file, calculated by the thread which read it
+
+            Returns
+            -------
+            str containing the md5sum, None if the Prefetcher is not md5summing files
+        """
+        buf = self.prefetcher.buffers[self.index]
+        with self.prefetcher.lock:
+            while not buf.done and self.prefetcher.failure is None:
+                self.prefetcher.lock.wait(1.0)
+            if self.prefetcher.failure is not None:
+                raise self.prefetcher.failure
+        return buf.md5
+
+    def close(self):
+        """ Method to close the file, any data not read is thrown away
+        """
+        self.data = ''
+        with self.prefetcher.lock:
+            self.prefetcher._discard(self.index)
+            self.prefetcher.lock.notify_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def physical_offset(filename):
+    """ Method to get the physical location on disk of the start of a file, from the FIEMAP
+        ioctl
+
+        Parameters
+        ----------
+        filename : str
+            The name of the file
+
+        Returns
+        -------
+        int, the physical offset of the first extent of the file in bytes, None if it is not
+        known (the file is empty, or the file system does not support FIEMAP)
+    """
+    # struct fiemap asking for one extent, followed by space for the struct fiemap_extent
+    request = struct.pack('=QQLLLL', 0, 2**64 - 1, 0, 0, 1, 0) + '\0' * 56
+    try:
+        with open(filename, 'rb') as flh:
+            result = fcntl.ioctl(flh.fileno(), FS_IOC_FIEMAP, request)
+    except (IOError, OSError):
+        return None
+    if struct.unpack_from('=L', result, 20)[0] == 0:
+        return None
+    return struct.unpack_from('=Q', result, 40)[0]
+
+def index_entry(header, end, size):
+    """ Method to generate the index entry of a tar file member from the offsets of the start of
+        its header and the end of its data
+
+        Parameters
+        ----------
+        header : int
+            The offset of the header of the member in bytes
+        end : int
+            The offset of the end of the (padded) data of the member in bytes
+        size : int
+            The size of the member in bytes
+
+        Returns
+        -------
+        Tuple containing the header offset, data offset, and size of the member
+    """
+    return (header, end - padded_size(size), size)
+
+def write_index(filename, index):
+    """ Method to write the index of a tape tar to a file alongside it
+
+        Parameters
+        ----------
+        filename : str
+            The name of the index file
+        index : dict
+            The index of each unit tar, keyed by name, containing the offsets and size of the unit
+            tar in the tape tar, and the offsets and sizes of its members
+    """
+    with open(filename, 'w') as flh:
+        json.dump(index, flh)
+
+def read_index(filename):
+    """ Method to read the index of a tape tar written by write_index
+
+        Parameters
+        ----------
+        filename : str
+            The name of the index file
+
+        Returns
+        -------
+        dict of the index
+    """
+    with open(filename, 'r') as flh:
+        return json.load(flh)
+
+class Journal(object):
+    """ Class for the checkpoint journal of a tar file which is being written, so that an
+        interrupted run can pick up where it left off. Each line of the journal describes one
+        member which is completely written, and its end offset in the tar file. Members are
+        only added to the journal once the tar file has been synced up to their end, so the tar
+        file can always be truncated back to the last member in the journal.
+
+        Parameters
+        ----------
+        filename : str
+            The name of the journal file
+        interval : int
+            The number of bytes to write to the tar file between checkpoints
+    """
+    def __init__(self, filename, interval):
+        self.filename = filename
+        self.interval = interval
+        self.pending = []
+        self.last = 0
+
+    def load(self, size):
+        """ Method to read the members recorded in the journal
+
+            Parameters
+            ----------
+            size : int
+                The size of the tar file in bytes, members which end past this are ignored
+
+            Returns
+            -------
+            list of dicts, one per member, in the order they were written
+        """
+        entries = []
+        if not os.path.exists(self.filename):
+            return entries
+        with open(self.filename, 'r') as flh:
+            for line in flh:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # partially written line from the interruption
+                    break
+                if entry['end'] > size:
+                    break
+                entries.append(entry)
+        if entries:
+            self.last = entries[-1]['end']
+        return entries
+
+    def reset(self):
+        """ Method to start a new, empty, journal
+        """
+        open(self.filename, 'w').close()
+        self.pending = []
+        self.last = 0
+
+    def add(self, writer, entry):
+        """ Method to record a member which has been written, the tar file is checkpointed
+            if enough has been written since the last checkpoint
+
+            Parameters
+            ----------
+            writer : HashingWriter instance
+                The tar file being written
+            entry : dict
+                The description of the member, including its end offset in the tar file
+        """
+        self.pending.append(entry)
+        if entry['end'] - self.last >= self.interval:
+            self.checkpoint(writer)
+
+    def checkpoint(self, writer):
+        """ Method to sync the tar file to disk, and then record the members written since
+            the last checkpoint
+
+            Parameters
+            ----------
+            writer : HashingWriter instance
+                The tar file being written
+        """
+        if not self.pending:
+            return
+        writer.sync()
+        with open(self.filename, 'a') as flh:
+            for entry in self.pending:
+                flh.write(json.dumps(entry) + "\n")
+            flh.flush()
+            os.fsync(flh.fileno())
+        self.last = self.pending[-1]['end']
+        self.pending = []
+
+    def remove(self):
+        """ Method to remove the journal once the tar file is complete
+        """
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+class UpdateLog(object):
+    """ Class for the log of database updates which are being held back so they can be sent
+        together, so that they can be replayed if the process stops before they are
+        committed. Each line of the log is one update.
+
+        Parameters
+        ----------
+        directory : str
+            The directory to keep the log in
+        name : str
+            The name of the log file
+    """
+    def __init__(self, directory, name):
+        self.filename = os.path.join(directory, name)
+
+    def load(self):
+        """ Method to read the updates in the log
+
+            Returns
+            -------
+            list of dicts, one per update, in the order they were added
+        """
+        updates = []
+        if not os.path.exists(self.filename):
+            return updates
+        with open(self.filename, 'r') as flh:
+            for line in flh:
+                try:
+                    updates.append(json.loads(line))
+                except ValueError:
+                    # partially written line from the interruption
+                    break
+        return updates
+
+    def add(self, update):
+        """ Method to add an update to the log, it is synced to disk before returning
+
+            Parameters
+            ----------
+            update : dict
+                The update
+        """
+        with open(self.filename, 'a') as flh:
+            flh.write(json.dumps(update) + "\n")
+            flh.flush()
+            os.fsync(flh.fileno())
+
+    def remove(self):
+        """ Method to remove the log once its updates are committed
+        """
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+def get_unit_index(util, unit):
+    """ Method to get the index of a unit tar from the database
+
+        Parameters
+        ----------
+        util : Util instance
+        unit : str
+            The name of the unit tar
+
+        Returns
+        -------
+        dict containing the offsets and size of the unit tar in its tape tar, its compression,
+        and the offsets and sizes of its members, None if the unit tar has not been indexed
+    """
+    cur = util.cursor()
+    execute(cur, "select HEADER_OFFSET,DATA_OFFSET,TAR_SIZE,COMPRESSION from BACKUP_UNIT where NAME=:1", [unit])
+    res = cur.fetchall()
+    if not res or res[0][1] is None:
+        return None
+    index = {'header_offset': res[0][0],
+             'data_offset': res[0][1],
+             'size': res[0][2],
+             'compression': res[0][3]}
+    index['members'] = get_member_index(util, unit)
+    if not index['members']:
+        return None
+    return index
+
+def get_member_index(util, unit):
+    """ Method to get the offsets and sizes of the members of a unit tar from the database
+
+        Parameters
+        ----------
+        util : Util instance
+        unit : str
+            The name of the unit tar
 
         Returns
         -------
-        Tuple containing the unit name, created date, tape tar name, created date, and
-        transferred date (None, None, None, None, None) if not found
+        dict of tuples containing the header offset, data offset, and size of each member,
+        keyed by name
     """
-    data = {'unit': None,
-            'unitdate': None,
-            'tape': None,
-            'tapedate': None,
-            'transdate': None,
-            'arch_root': None,
-            'path': None}
     cur = util.cursor()
-    if archive:
-        cur.execute("select root from ops_archive where name='%s'" % (archive))
-        res = cur.fetchall()
-        if res:
-            data['arch_root'] = res[0][0]
-    if filename:
-        (fname, compression) = miscutils.parse_fullname(filename, miscutils.CU_PARSE_FILENAME | miscutils.CU_PARSE_COMPRESSION)
-        if compression:
-            cur.execute("select fai.path, pfw.archive_path from file_archive_info fai, desfile df, pfw_attempt pfw where df.filename='%s' and df.compression='%s' and df.pfw_attempt_id=pfw.id and fai.desfile_id=df.id" % (fname, compression))
-        else:
-            cur.execute("select fai.path, pfw.archive_path from file_archive_info fai, desfile df, pfw_attempt pfw where df.filename='%s' and df.compression is null and df.pfw_attempt_id=pfw.id and fai.desfile_id=df.id" % (filename))
-        res = cur.fetchall()
-        if not res:
-            if compression:
-                cur.execute("select archive_path from pfw_attempt pfw, desfile df where df.filename='%s' and df.compression='%s' and df.pfw_attempt_id=pfw.id" % (fname, compression))
-            else:
-                cur.execute("select archive_path from pfw_attempt pfw, desfile df where df.filename='%s' and df.pfw_attempt_id=pfw.id" % (fname))
-            res = cur.fetchall()
-            #print res
-            if not res:
-                print "File %s not found in DESFILE" % (filename)
-                return data
-            path = res[0][0]
-            print "File found in DESFILE with archive path: %s (full path to file unavailable)" % (path)
-        else:
-            path = res[0][1]
-            print "File found with path %s and an attempt archive path of %s" % (res[0][0], path)
-        data['path'] = path
-    elif reqnum and unitname and attnum:
-        cur.execute("select archive_path from pfw_attempt where reqnum=%s and unitname='%s' and attnum=%s" % (reqnum, unitname, attnum))
-        res = cur.fetchall()
-        if not res:
-            print "Attempt not found in PFW_ATTEMPT"
-            return data
-        path = res[0][0]
-        data['path'] = path
-        print "Found archive path of %s for this attempt" % (path)
-    elif pfwid:
-        cur.execute("select archive_path from pfw_attempt where id=%s" % (pfwid))
-        res = cur.fetchall()
-        if not res:
-            print "Attempt not found in PFW_ATTEMPT"
-            return data
-        path = res[0][0]
-        data['path'] = path
-        print "Found archive path of %s for this attempt" % (path)
-    elif rootpath:
-        if rootpath.startswith('/'):
-            if archive:
-                if not data['arch_root']:
-                    print "Could not locate archive in ops_archive."
-                    return data
-                arch_root = res[0][0]
-                path = rootpath.replace(arch_root + '/', '')
-            else:
-                print "Invalid path given. It must not start with a / unless an archive is also given."
-                return data
-        else:
-            path = rootpath
-        data['path'] = path
-    else:
-        raise ValueError("Invalid entries given")
+    execute(cur, "select NAME,HEADER_OFFSET,DATA_OFFSET,FILE_SIZE from BACKUP_UNIT_INDEX where UNIT_NAME=:1", [unit])
+    res = cur.fetchall()
+    members = {}
+    if res:
+        for row in res:
+            members[row[0]] = (row[1], row[2], row[3])
+    return members
 
+def read_member(tar, header):
+    """ Method to read the header of a single member of a tar file, from its offset in the index,
+        without reading any of the other headers
 
-    results = ()
-    # add on an extra / at the end so the loop is easier to implement
-    path += '/'
-    modified = 0
-    while not results:
-        if path.count('/') < 1:
-            print "Cannot find path in the archive, or the path is too low in the data structure."
-            return data
-        # remove the last directory of the path
-        path = path[:path.rfind('/')]
-        modified += 1
-        cur.execute("select unit_name from backup_dir where path='%s'" % (path))
-        results = cur.fetchall()
-    if modified > 1:
-        print "Found archive path of %s for given path" % (path)
-    data['unit'] = results[0][0]
+        Parameters
+        ----------
+        tar : TarFile instance
+            The tar file, opened for reading
+        header : int
+            The offset of the header of the member in bytes
 
-    if data['unit'] is None:
-        print "Item %s has not been added to a backup unit yet." % (path)
-        return data
-    cur.execute("select CREATED_DATE,TAPE_TAR from BACKUP_UNIT where NAME='%s'" % (data['unit']))
-    res = cur.fetchall()
-    data['unitdate'], data['tape'] = res[0]
-    if data['tape'] is None:
+        Returns
+        -------
+        TarInfo of the member
+    """
+    tar.fileobj.seek(header)
+    tar.offset = header
+    return tarfile.TarInfo.fromtarfile(tar)
+
+class FileSection(object):
+    """ Class which presents a section of a file as a file object, so that a tar file
+        stored inside another can be read without reading the rest of the outer file
+
+        Parameters
+        ----------
+        fileobj : file object
+            The file to read from
+        offset : int
+            The offset of the start of the section in bytes
+        size : int
+            The size of the section in bytes
+    """
+    def __init__(self, fileobj, offset, size):
+        self.fileobj = fileobj
+        self.offset = offset
+        self.size = size
+        self.position = 0
+
+    def read(self, size=-1):
+        """ Method to read data from the section
+
+            Parameters
+            ----------
+            size : int
+                The maximum number of bytes to read (default is -1, read to the end of the section)
+
+            Returns
+            -------
+            str of the data read
+        """
+        if size < 0 or size > self.size - self.position:
+            size = self.size - self.position
+        if size <= 0:
+            return ''
+        self.fileobj.seek(self.offset + self.position)
+        data = self.fileobj.read(size)
+        self.position += len(data)
         return data
-    cur.execute("select CREATED_DATE,TRANSFER_DATE from BACKUP_TAPE where NAME='%s'" % (data['tape']))
-    data['tapedate'], data['transdate'] = cur.fetchall()[0]
-    return data
 
-def generate_md5sum(filename):
-    """ Method to generate the md5sum of a file
+    def seek(self, position, whence=os.SEEK_SET):
+        """ Method to move to a position in the section
+
+            Parameters
+            ----------
+            position : int
+                The position in bytes
+            whence : int
+                Whether position is relative to the start, current position or end of the section
+        """
+        if whence == os.SEEK_CUR:
+            position += self.position
+        elif whence == os.SEEK_END:
+            position += self.size
+        self.position = max(0, min(position, self.size))
+
+    def tell(self):
+        """ Method to get the current position in the section
+
+            Returns
+            -------
+            int, the position in bytes
+        """
+        return self.position
+
+def parse_compression(compression):
+    """ Method to parse the compression policy for unit tars
 
         Parameters
         ----------
-        filename : str
-            The name of the file to generate the md5sum from
+        compression : str
+            Either a single codec, optionally followed by :level, to use for all classes, or
+            a comma separated list of class=codec[:level] entries (i.e. 'photoz=zstd:9,sne=gzip').
+            An entry without a class sets the default for all other classes.
 
         Returns
         -------
-        str, containing the md5sum
+        dict of tuples containing the codec and level (None for the default level), keyed by
+        class, the default is keyed by None
     """
-    blksize = 2**15
-    md5 = hashlib.md5()
-    with open(filename, 'rb') as flh:
-        for chunk in iter(lambda: flh.read(blksize), ''):
-            md5.update(chunk)
-    return md5.hexdigest()
+    policy = {}
+    if not compression:
+        return policy
+    for entry in compression.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        clss = None
+        if '=' in entry:
+            clss, entry = entry.split('=', 1)
+        level = None
+        if ':' in entry:
+            entry, level = entry.split(':', 1)
+            level = int(level)
+        codec = entry.strip().lower()
+        if codec == 'none':
+            codec = None
+        elif codec not in CODECS:
+            raise ValueError("Unknown compression codec %s" % (codec))
+        policy[clss] = (codec, level)
+    return policy
+
+def get_compression(compression, file_class):
+    """ Method to get the codec and level to use for a class of data
+
+        Parameters
+        ----------
+        compression : str
+            The compression policy, see parse_compression
+        file_class : str
+            The class of the data
+
+        Returns
+        -------
+        Tuple containing the codec (None for no compression) and level
+    """
+    policy = parse_compression(compression)
+    if file_class in policy:
+        return policy[file_class]
+    return policy.get(None, (None, None))
+
+def precompressed_fraction(data):
+    """ Method to find what fraction of the data, by size, is in files which are already compressed
+
+        Parameters
+        ----------
+        data : dict
+            Dictionary of file info, keyed by file name, the first entry of each item is the file size
+
+        Returns
+        -------
+        float, the fraction
+    """
+    total = 0
+    compressed = 0
+    for name, item in data.iteritems():
+        size = item[0] or 0
+        total += size
+        if name.lower().endswith(PRECOMPRESSED):
+            compressed += size
+    if total == 0:
+        return 0.
+    return float(compressed) / total
+
+def codec_from_name(name):
+    """ Method to find the compression codec of a unit tar from its name
+
+        Parameters
+        ----------
+        name : str
+            The name of the unit tar
+
+        Returns
+        -------
+        str, the codec, None if the tar file is not compressed
+    """
+    for codec, ext in CODECS.iteritems():
+        if name.endswith('.tar' + ext):
+            return codec
+    return None
+
+class _Lz4Compressor(object):
+    """ Class which gives the lz4 frame compressor the same interface as zlib compression objects
+    """
+    def __init__(self, level):
+        self.compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self.started = False
+
+    def compress(self, data):
+        """ Method to compress some data
+
+            Parameters
+            ----------
+            data : str
+                The data to compress
+
+            Returns
+            -------
+            str of the compressed data available so far
+        """
+        out = ''
+        if not self.started:
+            out = self.compressor.begin()
+            self.started = True
+        return out + self.compressor.compress(data)
+
+    def flush(self):
+        """ Method to finish the compressed stream
+
+            Returns
+            -------
+            str of the remaining compressed data
+        """
+        out = ''
+        if not self.started:
+            out = self.compressor.begin()
+            self.started = True
+        return out + self.compressor.flush()
+
+def get_compressor(codec, level=None, threads=0):
+    """ Method to get a compression object, with compress and flush methods, for a codec
+
+        Parameters
+        ----------
+        codec : str
+            The name of the codec, from CODECS
+        level : int
+            The compression level (default is None, use the default level of the codec)
+        threads : int
+            The number of threads to compress with, only used by zstd (default is 0, compress
+            in the calling thread)
+
+        Returns
+        -------
+        The compression object
+    """
+    if codec == 'gzip':
+        if level is None:
+            level = 6
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        if level is None:
+            level = 3
+        return zstandard.ZstdCompressor(level=level, threads=threads).compressobj()
+    if codec == 'lz4':
+        if lz4 is None:
+            raise ValueError("lz4 compression requires the lz4 package")
+        if level is None:
+            level = 0
+        return _Lz4Compressor(level)
+    raise ValueError("Unknown compression codec %s" % (codec))
+
+def get_decompressor(codec):
+    """ Method to get a decompression object, with a decompress method, for a codec
+
+        Parameters
+        ----------
+        codec : str
+            The name of the codec, from CODECS
+
+        Returns
+        -------
+        The decompression object
+    """
+    if codec == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd decompression requires the zstandard package")
+        return zstandard.ZstdDecompressor().decompressobj()
+    if codec == 'lz4':
+        if lz4 is None:
+            raise ValueError("lz4 decompression requires the lz4 package")
+        return lz4.frame.LZ4FrameDecompressor()
+    raise ValueError("Unknown compression codec %s" % (codec))
+
+class CompressingWriter(object):
+    """ Class which wraps a file object, compressing the data written to it
+
+        Parameters
+        ----------
+        fileobj : file object
+            The file to write the compressed data to
+        codec : str
+            The name of the codec, from CODECS
+        level : int
+            The compression level (default is None, use the default level of the codec)
+        threads : int
+            The number of threads to compress with, only used by zstd (default is 0)
+    """
+    def __init__(self, fileobj, codec, level=None, threads=0):
+        self.fileobj = fileobj
+        self.compressor = get_compressor(codec, level, threads)
+        self.size = 0
+
+    def write(self, data):
+        """ Method to compress and write data
+
+            Parameters
+            ----------
+            data : str
+                The data to write
+        """
+        self.size += len(data)
+        out = self.compressor.compress(data)
+        if out:
+            self.fileobj.write(out)
+
+    def tell(self):
+        """ Method to get the number of bytes written, before compression
+
+            Returns
+            -------
+            int, the number of bytes written
+        """
+        return self.size
+
+    def close(self):
+        """ Method to finish the compressed data, the underlying file is not closed
+        """
+        self.fileobj.write(self.compressor.flush())
+
+class DecompressingReader(object):
+    """ Class which wraps a file object, decompressing the data read from it
+
+        Parameters
+        ----------
+        fileobj : file object
+            The file to read the compressed data from
+        codec : str
+            The name of the codec, from CODECS
+    """
+    def __init__(self, fileobj, codec):
+        self.fileobj = fileobj
+        self.decompressor = get_decompressor(codec)
+        self.buffer = ''
+        self.eof = False
+
+    def read(self, size=-1):
+        """ Method to read decompressed data
+
+            Parameters
+            ----------
+            size : int
+                The maximum number of bytes to read (default is -1, read to the end)
+
+            Returns
+            -------
+            str of the data read
+        """
+        blksize = 2**16
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            chunk = self.fileobj.read(blksize)
+            if not chunk:
+                self.eof = True
+                break
+            self.buffer += self.decompressor.decompress(chunk)
+        if size < 0:
+            size = len(self.buffer)
+        data = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return data
 
 def calculate_archive_size(sizestr):
     """ Method to calculate the size of an item when given the size as a string
@@ -250,35 +2070,46 @@ def srmls(server, mss_dir, subdir, fname, expected_size, util=None):
         return siz
 
 def check_files(data, stagedir, archtar, util):
-    """ Method to check the md5sum of the files in the tarball
+    """ Method to check the md5sum of the files in the tarball. The tarball is read
+        sequentially as a stream and each file is checked as it is read, nothing is
+        extracted to disk.
 
         Parameters
         ----------
         data : dict
             Dictionary containing the data of the files in the tarball
+        stagedir : str
+            The directory containing the tarball
+        archtar : str
+            The name of the tarball
+        util : Util instance
 
         Returns
         -------
         Boolean, True if they match, False otherwise
+
+        Raises
+        ------
+        Exception if the tarball contains a file which is not in data, as checking it again
+        would not help
     """
     util.log(Util.info, " ==> Checking md5sums from %s" % (archtar))
-    tdir = os.sep + "tmp" + os.sep + str(random.randint(0, 100000))
-    os.mkdir(tdir)
-    os.chdir(tdir)
-    tar = tarfile.open(os.path.join(stagedir, archtar), 'r')
-    tar.extractall(tdir + os.sep)
-    tar.close()
-    for dirpath, _, files in os.walk(tdir):
-        for fname in files:
-            md5 = generate_md5sum(os.path.join(tdir, dirpath, fname))
+    tar = tarfile.open(os.path.join(stagedir, archtar), 'r|')
+    try:
+        for member in tar:
+            if not member.isfile():
+                continue
+            fname = os.path.basename(member.name)
+            if fname not in data:
+                util.log(Util.error, " ===> No md5sum known for %s in %s." % (member.name, archtar))
+                raise Exception("Unexpected file %s in %s" % (member.name, archtar))
+            md5 = md5sum_fileobj(tar.extractfile(member))
             if md5 != data[fname][1]:
-                os.chdir(stagedir)
-                shutil.rmtree(tdir)
-                util.log(Util.error, " ===> Bad md5sum from %s, found %s, but should be %s." % (os.path.join(tdir, dirpath, fname), md5, data[fname][1]))
+                util.log(Util.error, " ===> Bad md5sum from %s in %s, found %s, but should be %s." % (member.name, archtar, md5, data[fname][1]))
                 return False
+    finally:
+        tar.close()
     util.log(Util.info, " ===> Check complete: %s" % (archtar))
-    os.chdir(stagedir)
-    shutil.rmtree(tdir)
     return True
 
 
@@ -313,9 +2144,13 @@ class Util(desdmdbi.DesDmDbi):
         self.services = services
         self.section = section
         desdmdbi.DesDmDbi.__init__(self, services, section)
-        cur = self.cursor()
-        cur.execute("select ROOT from OPS_ARCHIVE where name='%s'" % (archive))
-        self.root = cur.fetchall()[0][0]
+        self.con.stmtcachesize = STATEMENT_CACHE_SIZE
+        # the statement cache belongs to the connection, so a new connection starts empty
+        _STATEMENTS['cache'].clear()
+        self.last_used = time.time()
+        self.root = self.get_root(archive)
+        if self.root is None:
+            raise Exception("Archive %s not found in OPS_ARCHIVE" % (archive))
 
         self.reqfree = reqfree
 
@@ -329,6 +2164,68 @@ class Util(desdmdbi.DesDmDbi):
     def reconnect(self):
         print "Reconnecting to DB."
         desdmdbi.DesDmDbi.__init__(self, self.services, self.section)
+        self.con.stmtcachesize = STATEMENT_CACHE_SIZE
+        # the statement cache belongs to the connection, so a new connection starts empty
+        _STATEMENTS['cache'].clear()
+        self.last_used = time.time()
+
+    def cursor(self):
+        """ Method to get a cursor. The connection is only checked, and remade if it has been
+            lost, when it has not been used for IDLE_TIMEOUT seconds, rather than before
+            every use.
+
+            Returns
+            -------
+            cursor object
+        """
+        if time.time() - self.last_used > IDLE_TIMEOUT and not self.ping():
+            self.reconnect()
+        self.last_used = time.time()
+        return super(Util, self).cursor()
+
+    def query(self, sql, params=None):
+        """ Method to run a select on a new cursor. As selects can safely be repeated, if the
+            select fails because the connection has been lost then the connection is remade
+            and the select is run again.
+
+            Parameters
+            ----------
+            sql : str
+                The select statement
+            params : list
+                The bind values (default is None)
+
+            Returns
+            -------
+            list of the rows selected
+        """
+        try:
+            return execute(self.cursor(), sql, params).fetchall()
+        except Exception:
+            if self.ping():
+                raise
+            self.reconnect()
+            return execute(self.cursor(), sql, params).fetchall()
+
+    def get_root(self, archive):
+        """ Method to get the root of an archive, it is only looked up once per process
+
+            Parameters
+            ----------
+            archive : str
+                The name of the archive
+
+            Returns
+            -------
+            str, the root of the archive, None if the archive is not in OPS_ARCHIVE
+        """
+        key = (self.services, self.section, archive)
+        if key not in _ARCHIVE_ROOTS:
+            res = self.query("select ROOT from OPS_ARCHIVE where name=:1", [archive])
+            if not res:
+                return None
+            _ARCHIVE_ROOTS[key] = res[0][0]
+        return _ARCHIVE_ROOTS[key]
 
     def init_logger(self, logfile, ltype, llevel):
         """ Method to initialize the logger
@@ -405,8 +2302,7 @@ class Util(desdmdbi.DesDmDbi):
             -------
             Boolean, True if there is enough free space, False otherwise
         """
-        stat = os.statvfs(dirn)
-        freespace = stat.f_bavail * stat.f_frsize
+        freespace = self.getfreespace(dirn)
 
         if freespace < self.reqfree:
             #print freespace,options.stgdir,reqfree
@@ -414,6 +2310,53 @@ class Util(desdmdbi.DesDmDbi):
             return False
         return True
 
+    def getfreespace(self, dirn):
+        """ Method to get the free space on disk
+
+            Parameters
+            ----------
+            dirn : str
+                The directory whose file system is to be checked
+
+            Returns
+            -------
+            int, the free space in bytes
+        """
+        stat = os.statvfs(dirn)
+        return stat.f_bavail * stat.f_frsize
+
+def get_util(services, section, logfile=None, ltype=None, llevel=logging.INFO, reqfree=0, archive='desar2home'):
+    """ Method to get the Util for a database. If the services start with LOCAL_PREFIX the rest
+        is the name of a local SQLite database file (see archivetools.localdb), so the scripts
+        can be run offline, otherwise they are the services file of an Oracle database.
+
+        Parameters
+        ----------
+        services : str
+            The services file, or LOCAL_PREFIX and the name of the database file
+        section : str
+            The section of the services file to use, not used for a local database
+        logfile : str
+            The name of the log file to use (default is None)
+        ltype : str
+            The type of log (default is None)
+        llevel : int
+            Log at or above this logging level (default is logging.INFO)
+        reqfree : int
+            The minimum amount of free space to have on disk (default is 0)
+        archive : str
+            The name of the archive whose root to use (default is 'desar2home')
+
+        Returns
+        -------
+        Util instance
+    """
+    if services and services.startswith(LOCAL_PREFIX):
+        # imported here as localdb is built on this module
+        from archivetools.localdb import LocalUtil
+        return LocalUtil(services[len(LOCAL_PREFIX):], logfile, ltype or 'LOCAL', llevel, reqfree, archive)
+    return Util(services, section, logfile, ltype, llevel, reqfree, archive)
+
 class Plot(object):
     """ Class for making matplotlib.pyplot plots
 
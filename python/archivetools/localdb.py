@@ -0,0 +1,391 @@
+""" Module for a local SQLite stand-in for the archive database, so that the archiving pipeline
+    can be run and timed without the production database
+
+"""
+import os
+import re
+import calendar
+import datetime
+import logging
+import sqlite3
+
+import archivetools.backup_util as bu
+
+# the tables used by the archiving scripts, and the one row DUAL table for statements which
+# select from it. Dates are declared as datetime so they are returned as datetime objects, as
+# they are from Oracle.
+SCHEMA = ["create table DUAL (DUMMY text)",
+          "insert into DUAL values ('X')",
+          "create table OPS_ARCHIVE (NAME text, ROOT text)",
+          "create table BACKUP_DIR (PATH text primary key, CLASS text, STATUS integer, RELEASE_DATE datetime, PRIORITY integer, UNIT_NAME text, PFW_ATTEMPT_ID integer)",
+          "create table BACKUP_UNIT (NAME text, DEPRECATED integer, TAR_SIZE integer, MD5SUM text, CREATED_DATE datetime, TAPE_TAR text, FILE_TYPE text, STATUS integer, COMPRESSION text, HEADER_OFFSET integer, DATA_OFFSET integer)",
+          "create table BACKUP_TAPE (NAME text, TAR_SIZE integer, CREATED_DATE datetime, MD5SUM text, RETRIES integer, STATUS integer, PATH text, DEPRECATED integer, PRIORITY integer, FILE_TYPE text, TRANSFER_DATE datetime, TRANSFER_TIME real, ADLER32 text)",
+          "create table BACKUP_DB (PATH text, FILENAME text, RUN_DATE datetime, UNIT_NAME text, STATUS integer default 0)",
+          "create table BACKUP_SUMMARY (ITEM text, CLASS text, STATUS integer, NUM integer, TOTAL_SIZE integer, LAST_DATE datetime, primary key (ITEM, CLASS, STATUS))",
+          "create table BACKUP_WATERMARK (NAME text primary key, VALUE text, LAST_DATE datetime)",
+          "create table BACKUP_MONITOR (NUMBER_TRANSFERRED integer, NUMBER_NOT_TRANSFERRED integer, SIZE_TRANSFERRED integer, SIZE_TO_BE_TRANSFERRED integer, NUMBER_DEPRECATED integer, SIZE_DEPRECATED integer, PIPE_PROCESSED integer, PIPE_TO_BE_PROCESSED integer, RAW_PROCESSED integer, RAW_TO_BE_PROCESSED integer, RUN_TIME datetime)",
+          "create table BACKUP_UNIT_INDEX (UNIT_NAME text, NAME text, HEADER_OFFSET integer, DATA_OFFSET integer, FILE_SIZE integer)",
+          "create table BACKUP_CONTENT (MD5SUM text, FILE_SIZE integer, UNIT_NAME text, MEMBER text)",
+          "create table BACKUP_REFERENCE (UNIT_NAME text, MEMBER text, REF_UNIT text, REF_MEMBER text)",
+          "create table BACKUP_PATH (DESFILE_ID integer, SPINNING_ARCHIVE_PATH text, TAPE_PATH text)",
+          "create table DESFILE (ID integer primary key, FILENAME text, FILESIZE integer, MD5SUM text, COMPRESSION text, PFW_ATTEMPT_ID integer)",
+          "create table FILE_ARCHIVE_INFO (FILENAME text, ARCHIVE_NAME text, PATH text, COMPRESSION text, DESFILE_ID integer)",
+          "create table PFW_REQUEST (REQNUM integer primary key, PIPELINE text, CAMPAIGN text)",
+          "create table PFW_ATTEMPT (ID integer primary key, REQNUM integer, UNITNAME text, ATTNUM integer, TASK_ID integer, ARCHIVE_PATH text, DATA_STATE text)",
+          "create table TASK (ID integer primary key, NAME text, LABEL text, EXEC_HOST text, STATUS integer, START_TIME datetime, END_TIME datetime, PARENT_TASK_ID integer, ROOT_TASK_ID integer)",
+          "create table EXPOSURE (FILENAME text, NITE text)",
+          "create table MANIFEST_EXPOSURE (FILENAME text, NITE text)",
+          "create index BACKUP_UNIT_NAME on BACKUP_UNIT (NAME)",
+          "create index BACKUP_CONTENT_MD5 on BACKUP_CONTENT (MD5SUM)",
+          "create index DESFILE_FILENAME on DESFILE (FILENAME)",
+          "create index DESFILE_ATTEMPT on DESFILE (PFW_ATTEMPT_ID)",
+          "create index FAI_PATH on FILE_ARCHIVE_INFO (PATH)",
+          "create index FAI_FILENAME on FILE_ARCHIVE_INFO (FILENAME)",
+          "create index FAI_DESFILE on FILE_ARCHIVE_INFO (DESFILE_ID)",
+          "create index BACKUP_DB_PATH on BACKUP_DB (PATH)",
+          "create index PFW_ATTEMPT_PATH on PFW_ATTEMPT (ARCHIVE_PATH)"]
+
+# the global temporary tables, which are private to each connection
+TEMP_SCHEMA = ["create temp table GTT_ID (ID integer)",
+               "create temp table GTT_FILENAME (FILENAME text, COMPRESSION text)"]
+
+# Oracle date format elements, and their strftime equivalents, in the order to replace them
+DATE_FORMATS = [('YYYY', '%Y'), ('MM', '%m'), ('DD', '%d'), ('HH24', '%H'), ('MI', '%M'), ('SS', '%S')]
+# dates are stored as text in this format, so they sort and compare correctly
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# the current date and time in DATE_FORMAT, for SYSDATE and SYSTIMESTAMP
+NOW = "datetime('now', 'localtime')"
+
+# string literals, numbered binds, the current time, and schema names, the schemas all map to
+# the one database
+_TOKENS = re.compile(r"('(?:[^']|'')*')|:(\d+)\b|\b(SYSTIMESTAMP|SYSDATE)\b|\b(?:prod|friedel)\.", re.I)
+_MERGE = re.compile(r"^\s*merge\s+into\s+(\S+)\s+(\w+)\s+using\s+dual\s+on\s+\((.+?)\)\s+when\s+matched\s+then\s+update\s+set\s+(.+?)\s+when\s+not\s+matched\s+then\s+insert\s+(\(.+?\))\s+values\s+(\(.+\))\s*$", re.I | re.S)
+
+
+def to_date(value, fmt):
+    """ Method implementing the Oracle TO_DATE function
+
+        Parameters
+        ----------
+        value : str
+            The date
+        fmt : str
+            The Oracle format of the date
+
+        Returns
+        -------
+        str, the date in DATE_FORMAT
+    """
+    if value is None:
+        return None
+    for oracle, python in DATE_FORMATS:
+        fmt = fmt.replace(oracle, python)
+    return datetime.datetime.strptime(str(value), fmt).strftime(DATE_FORMAT)
+
+def add_months(value, months):
+    """ Method implementing the Oracle ADD_MONTHS function
+
+        Parameters
+        ----------
+        value : str
+            The date, in DATE_FORMAT
+        months : int
+            The number of months to add, may be negative
+
+        Returns
+        -------
+        str, the date in DATE_FORMAT
+    """
+    if value is None or months is None:
+        return None
+    date = datetime.datetime.strptime(str(value)[:19], DATE_FORMAT)
+    month = date.month - 1 + int(months)
+    year = date.year + month // 12
+    month = month % 12 + 1
+    return date.replace(year=year, month=month, day=min(date.day, calendar.monthrange(year, month)[1])).strftime(DATE_FORMAT)
+
+def convert_date(value):
+    """ Method to convert a stored date to a datetime, dates without a time are at midnight
+
+        Parameters
+        ----------
+        value : str
+            The date, in DATE_FORMAT
+
+        Returns
+        -------
+        datetime
+    """
+    value = value[:19]
+    if len(value) == 10:
+        return datetime.datetime.strptime(value, '%Y-%m-%d')
+    return datetime.datetime.strptime(value.replace('T', ' '), DATE_FORMAT)
+
+sqlite3.register_converter('DATETIME', convert_date)
+
+def translate(sql):
+    """ Method to translate an Oracle statement to SQLite. Numbered binds (:1) are made
+        explicit (?1), as SQLite numbers named binds in the order they appear, SYSDATE and
+        SYSTIMESTAMP are replaced by the local time, and schema names are removed.
+
+        Parameters
+        ----------
+        sql : str
+            The Oracle statement
+
+        Returns
+        -------
+        Tuple containing the SQLite statement, and the highest numbered bind in it (0 if there
+        are none)
+    """
+    binds = [0]
+    def replace(match):
+        if match.group(1) is not None:
+            return match.group(1)
+        if match.group(2) is not None:
+            binds[0] = max(binds[0], int(match.group(2)))
+            return '?' + match.group(2)
+        if match.group(3) is not None:
+            return NOW
+        return ''
+    return _TOKENS.sub(replace, sql), binds[0]
+
+def translate_merge(sql):
+    """ Method to split an Oracle merge from dual into an update, and an insert to do when the
+        update changes nothing
+
+        Parameters
+        ----------
+        sql : str
+            The Oracle merge statement
+
+        Returns
+        -------
+        Tuple containing the update and insert statements, as returned by translate, None if
+        the statement is not a merge
+    """
+    match = _MERGE.match(sql)
+    if match is None:
+        return None
+    table, alias, cond, update, cols, values = match.groups()
+    cond = re.sub(r'\b%s\.' % (alias), '', cond)
+    update = re.sub(r'\b%s\.' % (alias), '', update)
+    return (translate("update %s set %s where %s" % (table, update, cond)),
+            translate("insert into %s %s values %s" % (table, cols, values)))
+
+
+class LocalCursor(object):
+    """ Class which behaves like a cx_Oracle cursor on top of SQLite
+
+        Parameters
+        ----------
+        con : sqlite3 connection
+    """
+    def __init__(self, con):
+        self.con = con
+        self.cur = con.cursor()
+        self.statement = None
+
+    def _run(self, translated, params):
+        """ Method to execute a translated statement
+
+            Parameters
+            ----------
+            translated : tuple
+                The statement and highest numbered bind, from translate
+            params : list or dict
+                The bind values
+        """
+        sql, binds = translated
+        if params is None:
+            params = ()
+        elif not isinstance(params, dict):
+            params = tuple(params)[:binds] if binds else tuple(params)
+        self.cur.execute(sql, params)
+
+    def execute(self, sql, params=None):
+        """ Method to execute a statement
+
+            Parameters
+            ----------
+            sql : str
+                The Oracle statement, None to use the prepared statement
+            params : list or dict
+                The bind values (default is None)
+        """
+        if sql is None:
+            sql = self.statement
+        if sql.strip().lower() == 'commit':
+            self.con.commit()
+            return
+        if sql.strip().lower() == 'rollback':
+            self.con.rollback()
+            return
+        merge = translate_merge(sql)
+        if merge is None:
+            self._run(translate(sql), params)
+            return
+        self._run(merge[0], params)
+        if self.cur.rowcount == 0:
+            self._run(merge[1], params)
+
+    def prepare(self, sql):
+        """ Method to prepare a statement for executemany
+
+            Parameters
+            ----------
+            sql : str
+                The Oracle statement
+        """
+        self.statement = sql
+
+    def executemany(self, sql, rows):
+        """ Method to execute a statement for each set of bind values
+
+            Parameters
+            ----------
+            sql : str
+                The Oracle statement, None to use the prepared statement
+            rows : list
+                The bind values for each execution
+        """
+        if sql is None:
+            sql = self.statement
+        if translate_merge(sql) is not None:
+            for row in rows:
+                self.execute(sql, row)
+            return
+        translated, binds = translate(sql)
+        if binds:
+            rows = [tuple(row)[:binds] if not isinstance(row, dict) else row for row in rows]
+        self.cur.executemany(translated, rows)
+
+    def fetchall(self):
+        return self.cur.fetchall()
+
+    def fetchone(self):
+        return self.cur.fetchone()
+
+    def fetchmany(self, size):
+        return self.cur.fetchmany(size)
+
+    def close(self):
+        self.cur.close()
+
+    @property
+    def rowcount(self):
+        return self.cur.rowcount
+
+    @property
+    def description(self):
+        return self.cur.description
+
+
+class LocalUtil(bu.Util):
+    """ Class providing the Util interface on top of a local SQLite database. Messages are
+        only logged, no emails are sent.
+
+        Parameters
+        ----------
+        filename : str
+            The name of the database file, it is created with the schema if it does not exist
+        logfile : str
+            The name of the log file to use (default is None, log to the console only). If
+            its directory does not exist, as when running a production script offline, the
+            log goes to the console.
+        ltype : str
+            The type of log (default is 'LOCAL')
+        llevel : int
+            Log at or above this logging level (default is logging.INFO)
+        reqfree : int
+            The minimum amount of free space to have on disk (default is 0)
+        archive : str
+            The name of the archive whose root to use (default is 'desar2home')
+    """
+    def __init__(self, filename, logfile=None, ltype='LOCAL', llevel=logging.INFO, reqfree=0, archive='desar2home'):
+        if logfile is not None and os.path.isdir(os.path.dirname(os.path.abspath(logfile))):
+            self.init_logger(logfile, ltype, llevel)
+        else:
+            logging.basicConfig(level=llevel)
+            self.logger = logging.getLogger(ltype)
+        self.filename = filename
+        self.services = filename
+        self.section = None
+        self.con = sqlite3.connect(filename, detect_types=sqlite3.PARSE_DECLTYPES)
+        self.con.create_function('TO_DATE', 2, to_date)
+        self.con.create_function('ADD_MONTHS', 2, add_months)
+        cur = self.con.cursor()
+        cur.execute("select count(*) from sqlite_master where type='table' and name='BACKUP_DIR'")
+        if cur.fetchone()[0] == 0:
+            self.create_schema()
+        for sql in TEMP_SCHEMA:
+            self.con.execute(sql)
+        cur.execute("select ROOT from OPS_ARCHIVE where NAME=?", (archive,))
+        res = cur.fetchone()
+        self.root = res[0] if res else None
+        self.reqfree = reqfree
+
+    def create_schema(self):
+        """ Method to create the tables
+        """
+        for sql in SCHEMA:
+            self.con.execute(sql)
+        self.con.commit()
+
+    def cursor(self):
+        return LocalCursor(self.con)
+
+    def commit(self):
+        self.con.commit()
+
+    def rollback(self):
+        self.con.rollback()
+
+    def close(self):
+        self.con.close()
+
+    def ping(self):
+        return True
+
+    def reconnect(self):
+        pass
+
+    def notify(self, level, msg, email=False):
+        self.logger.log(level, msg)
+
+    def get_positional_bind_string(self, pos=1):
+        return ":%i" % (pos)
+
+    def load_id_gtt(self, ids):
+        """ Method to load ids in to the id GTT, replacing what was there
+
+            Parameters
+            ----------
+            ids : list
+                The ids
+
+            Returns
+            -------
+            str, the name of the table
+        """
+        self.con.execute("delete from GTT_ID")
+        self.con.executemany("insert into GTT_ID (ID) values (?)", [(fid,) for fid in ids])
+        return 'GTT_ID'
+
+    def load_gtt_filename(self, rows):
+        """ Method to load file names in to the file name GTT, replacing what was there
+
+            Parameters
+            ----------
+            rows : list
+                dicts of the filename and compression of each file
+
+            Returns
+            -------
+            str, the name of the table
+        """
+        self.con.execute("delete from GTT_FILENAME")
+        self.con.executemany("insert into GTT_FILENAME (FILENAME,COMPRESSION) values (?,?)",
+                             [(row['filename'], row.get('compression')) for row in rows])
+        return 'GTT_FILENAME'
@@ -0,0 +1,245 @@
+""" Module for generating a synthetic DES archive tree, and its catalog entries, for
+    benchmarking the archiving pipeline
+
+"""
+import os
+import random
+import hashlib
+import datetime
+
+from archivetools.localdb import DATE_FORMAT
+from archivetools.backup_util import update_summary, summary_class
+
+# the layout of the directories of each class: the format of the directory path, and for each
+# kind of file the subdirectory, name format, number of files, median size in bytes, spread
+# of the (log normal) size distribution, and whether the contents are compressible. As in the
+# archive, the files of pipeline attempts are mostly in subdirectories.
+PROFILES = {'finalcut': {'path': 'OPS/finalcut/Y6A1/r%05i/D%08i/p01',
+                         'files': [('red/immask', 'D%08i_%02i_immasked.fits.fz', 60, 20 * 1024**2, 0.3, False),
+                                   ('cat', 'D%08i_%02i_red-fullcat.fits', 60, 5 * 1024**2, 0.5, True),
+                                   ('log', 'D%08i_%02i.log', 120, 30 * 1024, 1.0, True),
+                                   ('qa', 'D%08i_%02i_qa.png', 60, 200 * 1024, 0.5, False)]},
+            'coadd': {'path': 'OPS/multiepoch/Y6A1/r%05i/DES%08i/p01',
+                      'files': [('coadd', 'DES%08i_r%02i_det.fits.fz', 6, 400 * 1024**2, 0.2, False),
+                                ('cat', 'DES%08i_%02i_cat.fits', 10, 50 * 1024**2, 0.5, True),
+                                ('log', 'DES%08i_%02i.log', 40, 50 * 1024, 1.0, True)]},
+            'raw': {'path': 'DTS/src/%08i/%08i',
+                    'files': [('', 'DECam_%08i_%02i.fits.fz', 100, 35 * 1024**2, 0.05, False)]}}
+
+# the pipeline and campaign of the attempts of each class made by make_catalog
+PIPELINES = {'finalcut': ('finalcut', 'Y6A1'),
+             'coadd': ('multiepoch', 'Y6A1')}
+
+# the line repeated to make compressible files
+TEXT = "2019-01-01 00:00:00 processing exposure, nothing to report, all values nominal\n"
+
+
+def file_size(rng, median, sigma, scale):
+    """ Method to draw a file size from a log normal distribution
+
+        Parameters
+        ----------
+        rng : random.Random instance
+        median : int
+            The median size in bytes
+        sigma : float
+            The spread of the distribution
+        scale : float
+            The factor to scale the size by
+
+        Returns
+        -------
+        int, the size in bytes
+    """
+    return max(1, int(rng.lognormvariate(0., sigma) * median * scale))
+
+def write_file(filename, size, compressible, blksize=2**20):
+    """ Method to write a synthetic file
+
+        Parameters
+        ----------
+        filename : str
+            The name of the file
+        size : int
+            The size of the file in bytes
+        compressible : bool
+            If True then the file is repeated text, otherwise it is random bytes
+        blksize : int
+            The size of the blocks to write in bytes (default is 1 MB)
+
+        Returns
+        -------
+        str, the md5sum of the file
+    """
+    md5 = hashlib.md5()
+    if compressible:
+        block = (TEXT * (blksize / len(TEXT) + 1))[:blksize]
+    with open(filename, 'wb') as flh:
+        remaining = size
+        while remaining > 0:
+            if compressible:
+                data = block[:remaining]
+            else:
+                data = os.urandom(min(blksize, remaining))
+            flh.write(data)
+            md5.update(data)
+            remaining -= len(data)
+    return md5.hexdigest()
+
+def make_tree(root, clss, ndirs, scale=1., seed=0, start=1):
+    """ Method to generate the directories of one class in a synthetic archive
+
+        Parameters
+        ----------
+        root : str
+            The root of the archive
+        clss : str
+            The class of data, one of the keys of PROFILES
+        ndirs : int
+            The number of directories to generate
+        scale : float
+            The factor to scale the file sizes by, so that smaller trees can be generated
+            (default is 1.)
+        seed : int
+            The seed for the file sizes, so trees can be regenerated (default is 0)
+        start : int
+            The number of the first directory, which is used as its attempt id (default is 1)
+
+        Returns
+        -------
+        list of dicts, one per directory, containing its path relative to the root, class,
+        attempt id, and the list of its files as tuples of the path relative to the root,
+        file name, size, md5sum, and compression
+    """
+    profile = PROFILES[clss]
+    rng = random.Random("%s%i" % (clss, seed))
+    dirs = []
+    for num in range(start, start + ndirs):
+        path = profile['path'] % (num, num * 7)
+        files = []
+        for subdir, fmt, count, median, sigma, compressible in profile['files']:
+            fpath = os.path.join(path, subdir) if subdir else path
+            if not os.path.isdir(os.path.join(root, fpath)):
+                os.makedirs(os.path.join(root, fpath))
+            for i in range(count):
+                fname = fmt % (num, i)
+                size = file_size(rng, median, sigma, scale)
+                md5 = write_file(os.path.join(root, fpath, fname), size, compressible)
+                compression = None
+                if fname.endswith('.fz'):
+                    fname = fname[:-3]
+                    compression = '.fz'
+                files.append((fpath, fname, size, md5, compression))
+        dirs.append({'path': path, 'class': clss, 'pfw_attempt_id': num, 'files': files})
+    return dirs
+
+def load_catalog(util, root, dirs, priority=1):
+    """ Method to load the catalog entries of a synthetic archive in to a database
+
+        Parameters
+        ----------
+        util : Util instance
+        root : str
+            The root of the archive
+        dirs : list
+            The directories, from make_tree
+        priority : int
+            The priority of the directories (default is 1)
+    """
+    cur = util.cursor()
+    cur.execute("select count(*) from OPS_ARCHIVE where NAME='desar2home'")
+    if cur.fetchall()[0][0] == 0:
+        cur.execute("insert into OPS_ARCHIVE (NAME,ROOT) values ('desar2home','%s')" % (root))
+    util.root = root
+    cur.execute("select max(ID) from DESFILE")
+    fid = cur.fetchall()[0][0] or 0
+    release = (datetime.datetime.now() - datetime.timedelta(days=1)).strftime(DATE_FORMAT)
+    brows = []
+    drows = []
+    frows = []
+    for ddir in dirs:
+        brows.append((ddir['path'], ddir['class'], release, priority, ddir['pfw_attempt_id']))
+        for fpath, fname, size, md5, compression in ddir['files']:
+            fid += 1
+            drows.append((fid, fname, size, md5, compression, ddir['pfw_attempt_id']))
+            frows.append((fname, 'desar2home', fpath, compression, fid))
+    cur.prepare("insert into BACKUP_DIR (PATH,STATUS,CLASS,RELEASE_DATE,PRIORITY,PFW_ATTEMPT_ID) values (:1,0,:2,TO_DATE(:3, 'YYYY-MM-DD HH24:MI:SS'),:4,:5)")
+    cur.executemany(None, brows)
+    update_summary(cur, [('DIR', summary_class(ddir['path'], ddir['class']), 0, 1, 0) for ddir in dirs])
+    cur.prepare("insert into PFW_ATTEMPT (ID,ARCHIVE_PATH,DATA_STATE) values (:1,:2,'ACTIVE')")
+    cur.executemany(None, [(ddir['pfw_attempt_id'], ddir['path']) for ddir in dirs if ddir['class'] in PIPELINES])
+    cur.prepare("insert into DESFILE (ID,FILENAME,FILESIZE,MD5SUM,COMPRESSION,PFW_ATTEMPT_ID) values (:1,:2,:3,:4,:5,:6)")
+    cur.executemany(None, drows)
+    cur.prepare("insert into FILE_ARCHIVE_INFO (FILENAME,ARCHIVE_NAME,PATH,COMPRESSION,DESFILE_ID) values (:1,:2,:3,:4,:5)")
+    cur.executemany(None, frows)
+    cur.execute('commit')
+
+def make_catalog(util, nattempts, nfiles=100, seed=0, batch=100000):
+    """ Method to load the catalog entries of pipeline attempts, without any files on disk, so
+        that queries can be timed against a catalog of production size. The attempts are
+        numbered after any already in the database, so it is run after load_catalog. They
+        are finished and not in BACKUP_DIR, so they are found by archive_setup.
+
+        Parameters
+        ----------
+        util : Util instance
+        nattempts : int
+            The number of attempts to make, alternating between the classes in PIPELINES
+        nfiles : int
+            The number of files in each attempt (default is 100)
+        seed : int
+            The seed for the file sizes and dates (default is 0)
+        batch : int
+            The number of files to insert per executemany (default is 100000)
+
+        Returns
+        -------
+        int, the number of files made
+    """
+    rng = random.Random("catalog%i" % (seed))
+    now = datetime.datetime.now()
+    cur = util.cursor()
+    cur.execute("select max(ID) from PFW_ATTEMPT")
+    first = cur.fetchall()[0][0] or 0
+    cur.execute("select max(PFW_ATTEMPT_ID) from DESFILE")
+    first = max(first, cur.fetchall()[0][0] or 0) + 1
+    cur.execute("select max(ID) from DESFILE")
+    fid = cur.fetchall()[0][0] or 0
+    statements = [("insert into PFW_REQUEST (REQNUM,PIPELINE,CAMPAIGN) values (:1,:2,:3)", []),
+                  ("insert into TASK (ID,NAME,STATUS,START_TIME,END_TIME,ROOT_TASK_ID) values (:1,'attempt',0,TO_DATE(:2, 'YYYY-MM-DD HH24:MI:SS'),TO_DATE(:3, 'YYYY-MM-DD HH24:MI:SS'),:4)", []),
+                  ("insert into PFW_ATTEMPT (ID,REQNUM,UNITNAME,ATTNUM,TASK_ID,ARCHIVE_PATH,DATA_STATE) values (:1,:2,:3,1,:4,:5,'ACTIVE')", []),
+                  ("insert into DESFILE (ID,FILENAME,FILESIZE,MD5SUM,COMPRESSION,PFW_ATTEMPT_ID) values (:1,:2,:3,:4,:5,:6)", []),
+                  ("insert into FILE_ARCHIVE_INFO (FILENAME,ARCHIVE_NAME,PATH,COMPRESSION,DESFILE_ID) values (:1,:2,:3,:4,:5)", [])]
+
+    def flush():
+        for sql, rows in statements:
+            if rows:
+                cur.prepare(sql)
+                cur.executemany(None, rows)
+                del rows[:]
+        cur.execute('commit')
+
+    classes = sorted(PIPELINES.keys())
+    for num in range(first, first + nattempts):
+        clss = classes[num % len(classes)]
+        profile = PROFILES[clss]
+        path = profile['path'] % (num, num * 7)
+        end = now - datetime.timedelta(days=rng.uniform(8., 1000.))
+        statements[0][1].append((num, PIPELINES[clss][0], PIPELINES[clss][1]))
+        statements[1][1].append((num, (end - datetime.timedelta(hours=1)).strftime(DATE_FORMAT), end.strftime(DATE_FORMAT), num))
+        statements[2][1].append((num, num, 'D%08i' % (num * 7), num, path))
+        kinds = profile['files']
+        for i in range(nfiles):
+            subdir, fmt, _, median, sigma, _ = kinds[i % len(kinds)]
+            fname = fmt % (num, i)
+            compression = None
+            if fname.endswith('.fz'):
+                fname = fname[:-3]
+                compression = '.fz'
+            fid += 1
+            statements[3][1].append((fid, fname, file_size(rng, median, sigma, 1.), '%032x' % (rng.getrandbits(128)), compression, num))
+            statements[4][1].append((fname, 'desar2home', os.path.join(path, subdir) if subdir else path, compression, fid))
+        if len(statements[3][1]) >= batch:
+            flush()
+    flush()
+    return nattempts * nfiles
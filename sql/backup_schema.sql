@@ -0,0 +1,58 @@
+-- Changes to the backup tables in the production Oracle database, in the order they are
+-- needed. Each section has to be run before the code which uses it is deployed.
+
+-- Member offsets of unit tars, and of unit tars in their tape tar, so restores can seek
+create table BACKUP_UNIT_INDEX (
+    UNIT_NAME      varchar2(200) not null,
+    NAME           varchar2(1024) not null,
+    HEADER_OFFSET  number(19),
+    DATA_OFFSET    number(19),
+    FILE_SIZE      number(19)
+);
+create index BACKUP_UNIT_INDEX_UNIT on BACKUP_UNIT_INDEX (UNIT_NAME);
+
+alter table BACKUP_UNIT add (HEADER_OFFSET number(19), DATA_OFFSET number(19));
+
+-- The codec of compressed unit tars, null if not compressed
+alter table BACKUP_UNIT add (COMPRESSION varchar2(10));
+
+-- The contents of each unit tar, to find files already on tape, and the members archived as
+-- references to them
+create table BACKUP_CONTENT (
+    MD5SUM         varchar2(32) not null,
+    FILE_SIZE      number(19) not null,
+    UNIT_NAME      varchar2(200) not null,
+    MEMBER         varchar2(1024) not null
+);
+create index BACKUP_CONTENT_MD5 on BACKUP_CONTENT (MD5SUM, FILE_SIZE);
+create index BACKUP_CONTENT_UNIT on BACKUP_CONTENT (UNIT_NAME);
+
+create table BACKUP_REFERENCE (
+    UNIT_NAME      varchar2(200) not null,
+    MEMBER         varchar2(1024) not null,
+    REF_UNIT       varchar2(200) not null,
+    REF_MEMBER     varchar2(1024) not null
+);
+create index BACKUP_REFERENCE_UNIT on BACKUP_REFERENCE (UNIT_NAME);
+
+-- The adler32 of each tape tar, compared with the checksum of the copy after a transfer
+alter table BACKUP_TAPE add (ADLER32 varchar2(8));
+
+-- Running counts and sizes of the BACKUP_DIR, BACKUP_UNIT and BACKUP_TAPE rows by class and
+-- status, read by monitor.py. Fill it with "monitor.py --rebuild_summary" once created.
+create table BACKUP_SUMMARY (
+    ITEM           varchar2(10) not null,
+    CLASS          varchar2(100) not null,
+    STATUS         number(2) not null,
+    NUM            number not null,
+    TOTAL_SIZE     number not null,
+    LAST_DATE      date,
+    primary key (ITEM, CLASS, STATUS)
+);
+
+-- The high water marks of the archive_setup scans
+create table BACKUP_WATERMARK (
+    NAME           varchar2(20) primary key,
+    VALUE          varchar2(30),
+    LAST_DATE      date
+);
@@ -9,17 +9,26 @@ import os
 import copy
 import datetime
 import time
+import tempfile
+import tarfile
+import hashlib
+import zlib
+import shutil
 
 matplotlib.use('PS')
 
 from archivetools import backup_util as bu
 from archivetools import DES_tarball as dt
 from archivetools import DES_archive as da
+from archivetools import backup_plan as bp
+from archivetools import localdb as ldb
+from archivetools import synthetic as syn
 
 sys.path.append('bin')
 sys.path.append('tests')
 import where_is as wis
 import archive_setup as aset
+import run_backup as rb
 import hungjobs
 
 MD5TESTSUM = '23d899a47f09b776213ae'
@@ -285,18 +294,16 @@ class TestBackupUtil(unittest.TestCase):
         # no unit file
         myMock.setReturn([archive_root_rtn,
                           filePath,
-                          ((None,),)])
+                          ((archive_path, None, None, None, None, None, None),)])
         results = bu.locate(myMock, filename='myfile', archive='myarch')
         self.assertEqual(results['arch_root'], archive_root)
         self.assertEqual(results['path'], archive_path)
         self.assertIsNone(results['unit'])
 
-        # have unit file on second iteration
+        # have unit file for a directory above the path
         myMock.setReturn([archive_root_rtn,
                           filePath,
-                          None,
-                          ((unit_name,),),
-                          ((created_date, None),)])
+                          (('the/path/you', unit_name, created_date, None, None, None, None),)])
         results = bu.locate(myMock, filename='myfile', archive='myarch')
         self.assertEqual(results['arch_root'], archive_root)
         self.assertEqual(results['path'], archive_path)
@@ -306,8 +313,7 @@ class TestBackupUtil(unittest.TestCase):
         # have unit file
         myMock.setReturn([archive_root_rtn,
                           filePath,
-                          ((unit_name,),),
-                          ((created_date, None),)])
+                          ((archive_path, unit_name, created_date, None, None, None, None),)])
         results = bu.locate(myMock, filename='myfile', archive='myarch')
         self.assertEqual(results['arch_root'], archive_root)
         self.assertEqual(results['path'], archive_path)
@@ -318,8 +324,7 @@ class TestBackupUtil(unittest.TestCase):
         # have unit file, with compression in filename
         myMock.setReturn([archive_root_rtn,
                           filePath,
-                          ((unit_name,),),
-                          ((created_date, None),)])
+                          ((archive_path, unit_name, created_date, None, None, None, None),)])
         results = bu.locate(myMock, filename='myfile.fits.fz', archive='myarch')
         self.assertEqual(results['arch_root'], archive_root)
         self.assertEqual(results['path'], archive_path)
@@ -331,8 +336,7 @@ class TestBackupUtil(unittest.TestCase):
         myMock.setReturn([archive_root_rtn,
                           None,
                           fileNoPath,
-                          ((unit_name,),),
-                          ((created_date, None),)])
+                          ((archive_path, unit_name, created_date, None, None, None, None),)])
         results = bu.locate(myMock, filename='myfile', archive='myarch')
         self.assertEqual(results['arch_root'], archive_root)
         self.assertEqual(results['path'], archive_path)
@@ -344,8 +348,7 @@ class TestBackupUtil(unittest.TestCase):
         myMock.setReturn([archive_root_rtn,
                           None,
                           fileNoPath,
-                          ((unit_name,),),
-                          ((created_date, None),)])
+                          ((archive_path, unit_name, created_date, None, None, None, None),)])
         results = bu.locate(myMock, filename='myfile.fits.fz', archive='myarch')
         self.assertEqual(results['arch_root'], archive_root)
         self.assertEqual(results['path'], archive_path)
@@ -365,9 +368,7 @@ class TestBackupUtil(unittest.TestCase):
         # have unit and tape tar, but no date
         myMock.setReturn([archive_root_rtn,
                           filePath,
-                          ((unit_name,),),
-                          ((created_date, tape_tar),),
-                          ((None, None),)])
+                          ((archive_path, unit_name, created_date, tape_tar, tape_tar, None, None),)])
         results = bu.locate(myMock, filename='myfile', archive='myarch')
         self.assertEqual(results['arch_root'], archive_root)
         self.assertEqual(results['path'], archive_path)
@@ -379,9 +380,7 @@ class TestBackupUtil(unittest.TestCase):
         # have tape tar and dates
         myMock.setReturn([archive_root_rtn,
                           filePath,
-                          ((unit_name,),),
-                          ((created_date, tape_tar),),
-                          ((tape_date, transfer_date),)])
+                          ((archive_path, unit_name, created_date, tape_tar, tape_tar, tape_date, transfer_date),)])
         results = bu.locate(myMock, filename='myfile', archive='myarch')
         self.assertEqual(results['arch_root'], archive_root)
         self.assertEqual(results['path'], archive_path)
@@ -391,6 +390,33 @@ class TestBackupUtil(unittest.TestCase):
         self.assertEqual(results['tapedate'], tape_date)
         self.assertEqual(results['transdate'], transfer_date)
 
+        # unit tar streamed into a tape tar which is still being written
+        myMock.setReturn([archive_root_rtn,
+                          filePath,
+                          ((archive_path, unit_name, created_date, tape_tar, None, None, None),)])
+        results = bu.locate(myMock, filename='myfile', archive='myarch')
+        self.assertEqual(results['unit'], unit_name)
+        self.assertIsNone(results['tape'])
+
+        # path not in the archive
+        myMock.setReturn([archive_root_rtn,
+                          filePath,
+                          None])
+        results = bu.locate(myMock, filename='myfile', archive='myarch')
+        self.assertEqual(results['path'], archive_path)
+        self.assertIsNone(results['unit'])
+
+        # file archived as a reference to an identical file
+        myMock.setReturn([archive_root_rtn,
+                          filePath,
+                          ((archive_path, unit_name, created_date, tape_tar, tape_tar, tape_date, transfer_date),),
+                          (('oldUnit', 'old/path/myfile'),),
+                          (('oldTape.tar',),)])
+        results = bu.locate(myMock, filename='myfile', archive='myarch')
+        self.assertEqual(results['unit'], unit_name)
+        self.assertEqual(results['tape'], tape_tar)
+        self.assertEqual(results['reference'], {'unit': 'oldUnit', 'member': 'old/path/myfile', 'tape': 'oldTape.tar'})
+
         # get just file info with root path
         myMock.setReturn([archive_root_rtn])
         results = bu.locate(myMock, rootpath=rootpath, archive='myarch')
@@ -424,6 +450,292 @@ class TestBackupUtil(unittest.TestCase):
         # test on a pre-generated file
         self.assertEqual(bu.generate_md5sum('tests/test.file'), '9a6944ab3ae1ab7843629a8e4d167bfb')
 
+    def test_get_checksum_list(self):
+        self.assertEqual(bu.get_checksum_list(), ['md5'])
+        self.assertEqual(bu.get_checksum_list('adler32, SHA256,md5'), ['md5', 'adler32', 'sha256'])
+
+    def test_compression(self):
+        self.assertEqual(bu.parse_compression('none'), {None: (None, None)})
+        self.assertEqual(bu.parse_compression('photoz=zstd:9, lz4'), {'photoz': ('zstd', 9), None: ('lz4', None)})
+        with self.assertRaises(ValueError):
+            bu.parse_compression('bzip2')
+        self.assertEqual(bu.get_compression('photoz=gzip', 'coadd'), (None, None))
+        self.assertEqual(bu.get_compression('photoz=gzip', 'photoz'), ('gzip', None))
+        self.assertEqual(bu.precompressed_fraction({'a.fits.fz': [300, ''], 'b.log': [100, '']}), 0.75)
+        self.assertEqual(bu.codec_from_name('unit.tar.zst'), 'zstd')
+        self.assertIsNone(bu.codec_from_name('unit.tar'))
+        text = ''.join([str(i) for i in range(100000)])
+        codecs = ['gzip']
+        if bu.zstandard is not None:
+            codecs.append('zstd')
+        if bu.lz4 is not None:
+            codecs.append('lz4')
+        for codec in codecs:
+            out = StringIO()
+            writer = bu.CompressingWriter(out, codec)
+            for i in range(0, len(text), 1000):
+                writer.write(text[i:i + 1000])
+            writer.close()
+            self.assertEqual(writer.tell(), len(text))
+            self.assertTrue(len(out.getvalue()) < len(text))
+            out.seek(0)
+            reader = bu.DecompressingReader(out, codec)
+            self.assertEqual(reader.read(10) + reader.read(), text)
+
+    def test_add_to_tar(self):
+        src = tempfile.mkdtemp()
+        try:
+            names = []
+            for i, size in enumerate([0, 1, 511, 512, 513, 100000]):
+                names.append(os.path.join(src, 'file%i' % i))
+                with open(names[-1], 'w') as flh:
+                    flh.write('x' * size)
+            outputs = []
+            for add in (False, True):
+                out = StringIO()
+                tar = tarfile.open(fileobj=out, mode='w')
+                for name in [src] + names:
+                    tarinfo = tar.gettarinfo(name)
+                    if add:
+                        if tarinfo.isreg():
+                            with open(name, 'rb') as flh:
+                                bu.add_to_tar(tar, tarinfo, flh)
+                        else:
+                            bu.add_to_tar(tar, tarinfo)
+                    elif tarinfo.isreg():
+                        with open(name, 'rb') as flh:
+                            tar.addfile(tarinfo, flh)
+                    else:
+                        tar.addfile(tarinfo)
+                tar.close()
+                outputs.append(out.getvalue())
+            self.assertEqual(outputs[0], outputs[1])
+        finally:
+            shutil.rmtree(src)
+
+    def test_get_ancestors(self):
+        self.assertEqual(bu.get_ancestors('a/b/c'), ['a/b/c', 'a/b', 'a'] + [None] * 5)
+        self.assertEqual(bu.get_ancestors('a/b/c/', 3), ['a/b/c', 'a/b', 'a'])
+        self.assertEqual(len(bu.get_ancestors('/'.join('abcdefghij'))), 16)
+
+    def test_locate_files(self):
+        unitdate = datetime.datetime(2018, 3, 15, 15, 47, 20)
+        tapedate = datetime.datetime(2018, 3, 16, 0, 22, 8)
+        files = [('a.fits', '.fz', 'OPS/x/p01/red', 'OPS/x/p01'),
+                 ('b.fits', None, None, 'OPS/y/p01'),
+                 ('c.fits', None, 'OPS/z/p01', None)]
+        dirs = [('OPS/x/p01', 'unitA', unitdate, 'tapeA', 'tapeA', tapedate, None),
+                ('OPS/y/p01', 'unitB', unitdate, 'tapeB', None, None, None),
+                ('OPS/z/p01', None, None, None, None, None, None)]
+        myMock = MockUtil(data=[files, dirs])
+        myMock.load_gtt_filename = MagicMock(return_value='GTT_FILENAME')
+        self.assertEqual(bu.locate_files(myMock, []), [])
+        res = bu.locate_files(myMock, ['a.fits.fz', 'b.fits', 'c.fits', 'd.fits'])
+        self.assertEqual([r['filename'] for r in res], ['a.fits.fz', 'b.fits', 'c.fits', 'd.fits'])
+        self.assertEqual(res[0]['compression'], '.fz')
+        self.assertEqual(res[0]['dir'], 'OPS/x/p01')
+        self.assertEqual(res[0]['unit'], 'unitA')
+        self.assertEqual(res[0]['tape'], 'tapeA')
+        self.assertEqual(res[0]['tapedate'], tapedate)
+        # streamed into a tape tar which is still open
+        self.assertEqual(res[1]['unit'], 'unitB')
+        self.assertIsNone(res[1]['tape'])
+        self.assertEqual(res[2]['path'], 'OPS/z/p01')
+        self.assertIsNone(res[2]['unit'])
+        self.assertIsNone(res[3]['path'])
+        # one array insert, one query for the files and one for the directories
+        self.assertEqual(len(myMock.load_gtt_filename.call_args[0][0]), 4)
+        self.assertEqual(myMock.getCount('execute'), 2)
+
+    def test_ChecksumCache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, 'file')
+            with open(fname, 'w') as flh:
+                flh.write('original contents')
+            bu.set_checksum_cache(os.path.join(tmpdir, 'cache', 'checksums.db'), max_entries=5)
+            self.assertEqual(bu.generate_md5sum(fname), hashlib.md5('original contents').hexdigest())
+            with patch('archivetools.backup_util.hash_file') as md5Mock:
+                # unchanged files come from the cache, unless it is bypassed
+                self.assertEqual(bu.generate_md5sum(fname), hashlib.md5('original contents').hexdigest())
+                self.assertEqual(md5Mock.call_count, 0)
+                md5Mock.return_value = {'md5': 'abc'}
+                self.assertEqual(bu.generate_md5sum(fname, use_cache=False), 'abc')
+                # changed files are md5summed again
+                with open(fname, 'w') as flh:
+                    flh.write('new contents')
+                os.utime(fname, (0, 1234567))
+                self.assertEqual(bu.generate_md5sum(fname), 'abc')
+                self.assertEqual(md5Mock.call_count, 2)
+
+            # the least recently used entries are removed
+            cache = bu.get_checksum_cache()
+            for i in range(20):
+                cache.put((0, i, 10, 0), 'md5%i' % i)
+            cache._evict()
+            self.assertEqual(cache.get((0, 0, 10, 0)), None)
+            self.assertEqual(cache.get((0, 19, 10, 0)), 'md519')
+            self.assertTrue(cache.con.execute("select count(*) from CHECKSUM").fetchone()[0] <= 5)
+        finally:
+            bu.set_checksum_cache(None)
+            shutil.rmtree(tmpdir)
+
+    def test_execute(self):
+        bu.reset_statement_stats()
+        util = ldb.LocalUtil(':memory:', ltype='TEST')
+        cur = util.cursor()
+        for i in range(5):
+            bu.execute(cur, "insert into BACKUP_DIR (PATH,STATUS,PRIORITY) values (:1,0,:2)", ['path%i' % i, i])
+        bu.executemany(cur, "update BACKUP_DIR set STATUS=:1 where PATH=:2", [(1, 'path1'), (1, 'path2')])
+        bu.execute(cur, "select PATH from BACKUP_DIR where STATUS=:1 order by PATH", [1])
+        self.assertEqual(cur.fetchall(), [('path1',), ('path2',)])
+        # each statement is only parsed once
+        self.assertEqual(bu.get_statement_stats(), {'parses': 3, 'executes': 7, 'cached': 3})
+        # the least recently used statements are dropped from the cache
+        with patch('archivetools.backup_util.STATEMENT_CACHE_SIZE', 2):
+            bu.execute(cur, "select count(*) from BACKUP_DIR")
+            bu.execute(cur, "select PATH from BACKUP_DIR where STATUS=:1 order by PATH", [0])
+        self.assertEqual(bu.get_statement_stats(), {'parses': 4, 'executes': 9, 'cached': 2})
+        bu.reset_statement_stats()
+        self.assertEqual(bu.get_statement_stats(), {'parses': 0, 'executes': 0, 'cached': 0})
+        util.close()
+
+    def test_summary(self):
+        util = ldb.LocalUtil(':memory:', ltype='TEST')
+        cur = util.cursor()
+        dirs = [('DTS/raw/20190101', 'RAW'), ('DTS/snmanifest/20190101', 'RAW'), ('OPS/a/p01', 'finalcut')]
+        for path, clss in dirs:
+            bu.execute(cur, "insert into BACKUP_DIR (PATH,CLASS,STATUS) values (:1,:2,0)", [path, clss])
+        bu.update_summary(cur, [('DIR', bu.summary_class(path, clss), 0, 1, 0) for path, clss in dirs])
+        bu.update_summary(cur, [('DIR', 'finalcut', 0, 1, 0), ('DIR', 'finalcut', 0, -1, 0)])
+        summary = bu.get_summary(cur)
+        # the SN manifest nites are counted apart from the raw nites
+        self.assertEqual(dict([(key, val['num']) for key, val in summary.iteritems()]),
+                         {('DIR', 'RAW', 0): 1, ('DIR', bu.SNMANIFEST_CLASS, 0): 1, ('DIR', 'finalcut', 0): 1})
+        # and are counted the same way from scratch
+        bu.rebuild_summary(cur)
+        self.assertEqual(dict([(key, val['num']) for key, val in bu.get_summary(cur).iteritems()]),
+                         dict([(key, val['num']) for key, val in summary.iteritems()]))
+        util.close()
+
+    def test_find_reference(self):
+        util = ldb.LocalUtil(':memory:', ltype='TEST')
+        cur = util.cursor()
+        cur.execute("insert into BACKUP_REFERENCE (UNIT_NAME,MEMBER,REF_UNIT,REF_MEMBER) values ('unit2','OPS/a/p01/D001_r1.fits','unit1','OPS/b/p01/D001_r1.fits')")
+        cur.execute("insert into BACKUP_UNIT (NAME,TAPE_TAR) values ('unit1','tape1')")
+        self.assertEqual(bu.find_reference(cur, 'unit2', 'D001_r1.fits'), {'unit': 'unit1', 'member': 'OPS/b/p01/D001_r1.fits', 'tape': 'tape1'})
+        self.assertEqual(bu.find_reference(cur, 'unit2', 'OPS/a/p01/D001_r1.fits')['unit'], 'unit1')
+        # names which only differ where there is an '_' are not matched
+        cur.execute("insert into BACKUP_REFERENCE (UNIT_NAME,MEMBER,REF_UNIT,REF_MEMBER) values ('unit3','OPS/a/p01/D001xr1.fits','unit1','OPS/b/p01/D001xr1.fits')")
+        self.assertIsNone(bu.find_reference(cur, 'unit3', 'D001_r1.fits'))
+        self.assertIsNone(bu.find_reference(cur, 'unit2', '001_r1.fits'))
+        util.close()
+
+    def test_hash_file(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, 'file')
+            data = os.urandom(100000)
+            with open(fname, 'wb') as flh:
+                flh.write(data)
+            expected = {'md5': hashlib.md5(data).hexdigest(),
+                        'adler32': '%08x' % (zlib.adler32(data) & 0xffffffff),
+                        'sha256': hashlib.sha256(data).hexdigest()}
+            algorithms = ['md5', 'adler32', 'sha256']
+            # the same checksums whatever the block size, and whether the file is mapped
+            for blksize in (1000, 2**16, 2**20):
+                self.assertEqual(bu.hash_file(fname, algorithms, blksize), expected)
+                self.assertEqual(bu.hash_file(fname, algorithms, blksize, use_mmap=True), expected)
+            self.assertEqual(bu.hash_fileobj(StringIO(data), algorithms, 4096), expected)
+            self.assertEqual(bu.hash_file(fname), {'md5': expected['md5']})
+            with open(fname, 'rb') as flh:
+                self.assertEqual(bu.md5sum_fileobj(flh), expected['md5'])
+            # empty files can not be mapped
+            open(fname, 'w').close()
+            self.assertEqual(bu.hash_file(fname, use_mmap=True), {'md5': hashlib.md5('').hexdigest()})
+            if bu.xxhash is not None:
+                self.assertEqual(bu.hash_file(fname, ['xxhash'])['xxhash'], bu.xxhash.xxh64('').hexdigest())
+            self.assertRaises(ValueError, bu.hash_file, fname, ['crc'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_Prefetcher(self):
+        src = tempfile.mkdtemp()
+        try:
+            files = []
+            for i, size in enumerate([0, 10, 1000, 5000, 3, 2500]):
+                files.append((os.path.join(src, 'file%i' % i), size))
+                with open(files[-1][0], 'w') as flh:
+                    flh.write(chr(ord('a') + i) * size)
+            # a small memory limit and block size, so readers have to wait
+            pre = bu.Prefetcher(files, threads=3, depth=2, memory=1500, blksize=256)
+            for name, size in files:
+                if name.endswith('file3'):
+                    # skipped files are thrown away
+                    continue
+                with pre.open(name) as flh:
+                    data = flh.read(100)
+                    data += flh.read()
+                with open(name, 'rb') as flh:
+                    self.assertEqual(data, flh.read())
+            pre.close()
+            self.assertEqual(pre.buffered, 0)
+
+            # errors reading are raised when the file is read
+            pre = bu.Prefetcher([(os.path.join(src, 'missing'), 10)] + files)
+            with self.assertRaises(IOError):
+                pre.open(os.path.join(src, 'missing')).read()
+            self.assertEqual(pre.open(files[3][0]).read(), 'd' * 5000)
+            pre.close()
+
+            # files are md5summed as they are read, the first bad one stops the reading
+            checked = {}
+            def check(name, size, md5):
+                checked[name] = md5
+                if name == files[4][0]:
+                    raise bu.ChecksumError("bad file")
+            pre = bu.Prefetcher(files, threads=2, check=check)
+            with self.assertRaises(bu.ChecksumError):
+                for name, size in files:
+                    with pre.open(name) as flh:
+                        flh.read()
+                        self.assertEqual(flh.md5sum(), hashlib.md5(chr(ord('a') + files.index((name, size))) * size).hexdigest())
+            pre.close()
+            self.assertTrue(files[4][0] in checked)
+
+            # the tar file should be the same when read ahead
+            stg = tempfile.mkdtemp()
+            cwd = os.getcwd()
+            try:
+                plain = dt.DES_tarball({'stgdir': stg}, [os.path.basename(src)], {}, MockUtil(), os.path.dirname(src), tarname='plain.tar')
+                ahead = dt.DES_tarball({'stgdir': stg, 'prefetch_threads': 2, 'prefetch_memory': '2k'}, [os.path.basename(src)], {},
+                                       MockUtil(), os.path.dirname(src), tarname='ahead.tar')
+                self.assertEqual(plain.get_md5sum(), ahead.get_md5sum())
+            finally:
+                os.chdir(cwd)
+                shutil.rmtree(stg)
+        finally:
+            shutil.rmtree(src)
+
+    def test_HashingWriter(self):
+        # checksums should match those of the data written
+        out = StringIO()
+        # xxhash is optional
+        algorithms = ['md5', 'adler32', 'sha256']
+        if bu.xxhash is not None:
+            algorithms.append('xxhash')
+        writer = bu.HashingWriter(out, algorithms)
+        with open('tests/test.file', 'rb') as flh:
+            for chunk in iter(lambda: flh.read(1000), ''):
+                writer.write(chunk)
+        self.assertEqual(writer.tell(), len(out.getvalue()))
+        digests = writer.hexdigests()
+        self.assertEqual(digests['md5'], '9a6944ab3ae1ab7843629a8e4d167bfb')
+        self.assertEqual(len(digests['adler32']), 8)
+        self.assertEqual(len(digests['sha256']), 64)
+        with self.assertRaises(ValueError):
+            bu.Checksum(['crc'])
+
     def test_calculate_archive_size(self):
         b = 5
         kb = 3
@@ -504,35 +816,35 @@ class TestBackupUtil(unittest.TestCase):
                     self.assertTrue('12346' in output)
                     self.assertTrue('Incomplete transfer' in output)
 
-    @patch('archivetools.backup_util.Util')
-    @patch('archivetools.backup_util.os')
-    @patch('archivetools.backup_util.shutil')
-    def test_check_files(self, utilPatch, ospatch, shpatch):
-        md5s = ['005ad754bf7840202c382989472ed560',
-                '56b6f70fe8f57c4e912caea7fe43de20',
-                'bb53b347b33632d2e8f6c8389ae003a7']
-        badmd5 = ['005ad754bf7840202c382989472ed560',
-                  '56b6f70fe8f57c4e962caea7fe43de20',
-                  'bb53b347b33632d2e8f6c8389ae003a7']
-        filenames = ['testfile.dat',
-                     'anotherfile.dat',
-                     'lasfile.d']
-        data = {filenames[0]: [None, md5s[0]],
-                filenames[1]: [None, md5s[1]],
-                filenames[2]: [None, md5s[2]]}
-        walkvals = [['d1', '', [filenames[0]]],
-                    ['d3', '', [filenames[1]]],
-                    ['dd', '', [filenames[2]]]]
-        with patch('archivetools.backup_util.tarfile.open') as tarpatch:
-            with patch('archivetools.backup_util.os.walk', return_value=walkvals) as m:
-                with patch('archivetools.backup_util.generate_md5sum', side_effect=md5s) as md:
-                    self.assertTrue(bu.check_files(data, 'tt', 'ac.tar', utilPatch))
-
-        # now test a failure
-        with patch('archivetools.backup_util.tarfile.open') as tarpatch:
-            with patch('archivetools.backup_util.os.walk', return_value=walkvals) as m:
-                with patch('archivetools.backup_util.generate_md5sum', side_effect=badmd5) as md:
-                    self.assertFalse(bu.check_files(data, 'tt', 'ac.tar', utilPatch))
+    def test_check_files(self):
+        utilPatch = MagicMock()
+        contents = {'testfile.dat': 'some test data',
+                    'anotherfile.dat': 'some more test data',
+                    'lasfile.d': 'the last of the data'}
+        data = {}
+        tdir = tempfile.mkdtemp()
+        try:
+            tar = tarfile.open(os.path.join(tdir, 'ac.tar'), 'w')
+            for fname, text in contents.iteritems():
+                info = tarfile.TarInfo(os.path.join('d1', fname))
+                info.size = len(text)
+                tar.addfile(info, StringIO(text))
+                data[fname] = [len(text), hashlib.md5(text).hexdigest()]
+            tar.close()
+            self.assertTrue(bu.check_files(data, tdir, 'ac.tar', utilPatch))
+
+            # now test a failure
+            data['anotherfile.dat'][1] = '56b6f70fe8f57c4e962caea7fe43de20'
+            self.assertFalse(bu.check_files(data, tdir, 'ac.tar', utilPatch))
+
+            # and a file which is not known, which is not worth checking again
+            del data['anotherfile.dat']
+            with self.assertRaises(Exception):
+                bu.check_files(data, tdir, 'ac.tar', utilPatch)
+            # nothing should have been extracted
+            self.assertEqual(os.listdir(tdir), ['ac.tar'])
+        finally:
+            shutil.rmtree(tdir)
 
     @patch('archivetools.backup_util.desdmdbi.DesDmDbi', MockDbi)
     def test_Util_init(self):
@@ -552,7 +864,57 @@ class TestBackupUtil(unittest.TestCase):
     def test_Util_reconnect(self):
         bu.Util.__bases__ = (MockDbi,)
         util = bu.Util(None, None)
+        bu.reset_statement_stats()
+        bu.execute(util.cursor(), "select 1 from dual")
         util.reconnect()
+        # the statements have to be parsed again on the new connection, the counts are kept
+        self.assertEqual(bu.get_statement_stats(), {'parses': 1, 'executes': 1, 'cached': 0})
+        bu.execute(util.cursor(), "select 1 from dual")
+        self.assertEqual(bu.get_statement_stats(), {'parses': 2, 'executes': 2, 'cached': 1})
+
+    @patch('archivetools.backup_util.desdmdbi.DesDmDbi', MockDbi)
+    def test_Util_get_root(self):
+        bu.Util.__bases__ = (MockDbi,)
+        bu._ARCHIVE_ROOTS.clear()
+        util = bu.Util(None, None, archive='other')
+        self.assertEqual(util.getCount('cursor'), 1)
+        # the root is not looked up again
+        util = bu.Util(None, None, archive='other')
+        self.assertEqual(util.root, 'the_root')
+        self.assertEqual(util.getCount('cursor'), 0)
+
+    @patch('archivetools.backup_util.desdmdbi.DesDmDbi', MockDbi)
+    def test_Util_cursor(self):
+        bu.Util.__bases__ = (MockDbi,)
+        util = bu.Util(None, None)
+        util.setThrow(True)
+        with patch.object(bu.Util, 'reconnect') as mockReconnect:
+            # the connection is not checked while it is in use
+            util.cursor()
+            self.assertEqual(util.con.getCount('ping'), 0)
+            util.last_used -= bu.IDLE_TIMEOUT + 1
+            util.cursor()
+            self.assertEqual(util.con.getCount('ping'), 1)
+            self.assertTrue(mockReconnect.called)
+
+    @patch('archivetools.backup_util.desdmdbi.DesDmDbi', MockDbi)
+    def test_Util_query(self):
+        bu.Util.__bases__ = (MockDbi,)
+        util = bu.Util(None, None)
+        rows = [('a',)]
+        cur = MagicMock()
+        cur.fetchall.return_value = rows
+        # the select is repeated after the lost connection is remade
+        util.setThrow(True)
+        with patch('archivetools.backup_util.execute', side_effect=[Exception(), cur]):
+            with patch.object(bu.Util, 'reconnect') as mockReconnect:
+                self.assertEqual(util.query('select 1 from dual'), rows)
+                self.assertTrue(mockReconnect.called)
+        # other errors are raised
+        util.setThrow(False)
+        with patch('archivetools.backup_util.execute', side_effect=Exception()):
+            with self.assertRaises(Exception):
+                util.query('select 1 from dual')
 
     @patch('archivetools.backup_util.desdmdbi.DesDmDbi', MockDbi)
     def test_Util_init_logger(self):
@@ -656,6 +1018,7 @@ class TestDES_tarball(unittest.TestCase):
         theItems = ['file.1', 'file.2']
         myMock = MockUtil()
         checks = [False, True]
+        osMock.open.return_value.gettarinfo.return_value.size = 0
         # basic init
         with patch('archivetools.DES_tarball.os.path.getsize', return_value=theSize) as g:
             with patch('archivetools.DES_tarball.os.getcwd', return_value='.') as gw:
@@ -665,22 +1028,225 @@ class TestDES_tarball(unittest.TestCase):
                 self.assertEqual(test.get_md5sum(), MD5TESTSUM)
 
         # init with generating tarfile
-        with patch('archivetools.DES_tarball.os.path.getsize', return_value=theSize) as g:
+        with patch('archivetools.DES_tarball.open', mock_open(), create=True) as mo:
             with patch('archivetools.DES_tarball.os.getcwd', return_value='.') as gw:
-                with patch('archivetools.DES_tarball.bu.generate_md5sum', return_value=MD5TESTSUM) as gm:
+                with patch('archivetools.DES_tarball.bu.HashingWriter') as hw:
+                    hw.return_value.size = theSize
+                    hw.return_value.hexdigests.return_value = {'md5': MD5TESTSUM, 'adler32': '0a0b0c0d'}
                     test = dt.DES_tarball(theArgs, theItems, {}, myMock, thePath, file_class=bu.CLASSES[0])
                     self.assertEqual(test.get_md5sum(), MD5TESTSUM)
+                    self.assertEqual(test.get_checksum('adler32'), '0a0b0c0d')
+                    self.assertEqual(test.get_filesize(), theSize)
                     self.assertNotEqual(test.get_tar_name(), tarFile)
 
         # verify file size
         # init with generating tarfile
-        with patch('archivetools.DES_tarball.os.path.getsize', return_value=theSize) as g:
+        with patch('archivetools.DES_tarball.open', mock_open(), create=True) as mo:
             with patch('archivetools.DES_tarball.os.getcwd', return_value='.') as gw:
-                with patch('archivetools.DES_tarball.bu.generate_md5sum', return_value=MD5TESTSUM) as gm:
+                with patch('archivetools.DES_tarball.bu.HashingWriter') as hw:
+                    hw.return_value.size = theSize
+                    hw.return_value.hexdigests.return_value = {'md5': MD5TESTSUM}
                     with patch('archivetools.DES_tarball.bu.check_files', side_effect=checks) as cf:
                         test = dt.DES_tarball(theArgs, theItems, {}, myMock, thePath, file_class=bu.CLASSES[0], verify=True, tarname=tarFile)
                         self.assertEqual(test.get_md5sum(), MD5TESTSUM)
                         self.assertEqual(test.get_tar_name(), tarFile)
+                        self.assertIsNone(test.get_checksum('sha256'))
+
+    def test_DES_tarball_check_members(self):
+        myMock = MockUtil()
+        cwd = os.getcwd()
+        src = tempfile.mkdtemp()
+        stg = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(src, 'unit'))
+            data = {}
+            for fname, text in {'file.1': 'the first file', 'file.2': 'the second file'}.iteritems():
+                with open(os.path.join(src, 'unit', fname), 'w') as flh:
+                    flh.write(text)
+                data[fname] = [len(text), hashlib.md5(text).hexdigest()]
+            del data['file.2']
+            test = dt.DES_tarball({'stgdir': stg}, ['unit'], data, myMock, src, check_members=True)
+            self.assertEqual(test.get_md5sum(), bu.generate_md5sum(os.path.join(stg, test.get_tar_name())))
+            # files not in the database get added
+            self.assertTrue('file.2' in data)
+
+            # the files can be md5summed by the threads reading ahead
+            ahead = dt.DES_tarball({'stgdir': stg, 'prefetch_threads': 2}, ['unit'], copy.deepcopy(data), myMock, src, check_members=True)
+            self.assertEqual(ahead.get_md5sum(), test.get_md5sum())
+            self.assertEqual(sorted(ahead.contents), sorted(test.contents))
+
+            # a bad md5sum should stop the tar and remove it
+            data['file.1'][1] = MD5TESTSUM
+            for threads in (0, 2):
+                with self.assertRaises(bu.ChecksumError):
+                    dt.DES_tarball({'stgdir': stg, 'prefetch_threads': threads}, ['unit'], data, myMock, src, check_members=True)
+                self.assertEqual(os.listdir(stg), [])
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(src)
+            shutil.rmtree(stg)
+
+    def test_DES_tarball_resume(self):
+        myMock = MockUtil()
+        cwd = os.getcwd()
+        src = tempfile.mkdtemp()
+        stg = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(src, 'unit'))
+            data = {}
+            for i in range(5):
+                text = 'contents of file %i\n' % (i) * (i + 1) * 100
+                with open(os.path.join(src, 'unit', 'file.%i' % (i)), 'w') as flh:
+                    flh.write(text)
+                data['file.%i' % (i)] = [len(text), hashlib.md5(text).hexdigest()]
+            theArgs = {'stgdir': stg, 'checkpoint': '1b'}
+            full = dt.DES_tarball(theArgs, ['unit'], data, myMock, src, check_members=True)
+            os.remove(os.path.join(stg, full.get_tar_name()))
+            self.assertFalse(os.path.exists(os.path.join(stg, 'unit.tar.journal')))
+
+            # interrupt the tar part way through
+            add_member = dt.DES_tarball.add_member
+            calls = []
+            limit = [3]
+            def interrupt(tarball, tar, name, tarinfo):
+                calls.append(name)
+                if len(calls) > limit[0]:
+                    raise RuntimeError("interrupted")
+                add_member(tarball, tar, name, tarinfo)
+            with patch.object(dt.DES_tarball, 'add_member', interrupt):
+                with self.assertRaises(RuntimeError):
+                    dt.DES_tarball(theArgs, ['unit'], data, myMock, src, check_members=True)
+            self.assertTrue(os.path.exists(os.path.join(stg, 'unit.tar.journal')))
+
+            # only the remaining members are written when resumed
+            del calls[:]
+            limit[0] = 10
+            with patch.object(dt.DES_tarball, 'add_member', interrupt):
+                test = dt.DES_tarball(theArgs, ['unit'], data, myMock, src, check_members=True)
+            self.assertEqual(calls, ['unit/file.2', 'unit/file.3', 'unit/file.4'])
+            self.assertEqual(test.get_md5sum(), full.get_md5sum())
+            self.assertEqual(test.get_md5sum(), bu.generate_md5sum(os.path.join(stg, test.get_tar_name())))
+            self.assertEqual(test.get_index(), full.get_index())
+            self.assertEqual(sorted(test.contents), sorted(full.contents))
+            self.assertEqual(os.listdir(stg), ['unit.tar'])
+
+            # a directory which has changed is tarred again from the start, a bad file found
+            # then is reported, and nothing is left behind
+            del calls[:]
+            limit[0] = 3
+            with patch.object(dt.DES_tarball, 'add_member', interrupt):
+                with self.assertRaises(RuntimeError):
+                    dt.DES_tarball(theArgs, ['unit'], data, myMock, src, check_members=True)
+            with open(os.path.join(src, 'unit', 'file.0'), 'w') as flh:
+                flh.write('changed')
+            with self.assertRaises(bu.ChecksumError):
+                dt.DES_tarball(theArgs, ['unit'], data, myMock, src, check_members=True)
+            self.assertEqual(os.listdir(stg), [])
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(src)
+            shutil.rmtree(stg)
+
+    def test_DES_tarball_order(self):
+        myMock = MockUtil()
+        cwd = os.getcwd()
+        src = tempfile.mkdtemp()
+        stg = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(src, 'unit', 'sub'))
+            for fname in ['unit/b', 'unit/sub/a', 'unit/a', 'unit/c']:
+                with open(os.path.join(src, fname), 'w') as flh:
+                    flh.write(fname * 100)
+            test = dt.DES_tarball({'stgdir': stg, 'order': 'inode'}, ['unit'], {}, myMock, src)
+            os.chdir(src)
+            members = test.get_members(tarfile.open(fileobj=StringIO(), mode='w'))
+            names = [m[0] for m in members]
+            self.assertEqual(names[:2], ['unit', 'unit/sub'])
+            self.assertEqual(names[2:], sorted(names[2:], key=lambda n: os.stat(n).st_ino))
+            # the paths are unchanged in the tar file
+            with tarfile.open(os.path.join(stg, test.get_tar_name())) as tar:
+                self.assertEqual(tar.getnames(), names)
+
+            test.args['order'] = 'extent'
+            members = test.get_members(tarfile.open(fileobj=StringIO(), mode='w'))
+            self.assertEqual(sorted(m[0] for m in members), sorted(names))
+            test.args['order'] = 'size'
+            with self.assertRaises(Exception):
+                test.get_members(tarfile.open(fileobj=StringIO(), mode='w'))
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(src)
+            shutil.rmtree(stg)
+
+    def test_DES_tarball_compression(self):
+        myMock = MockUtil()
+        cwd = os.getcwd()
+        src = tempfile.mkdtemp()
+        stg = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(src, 'unit'))
+            text = 'a very compressible line of text\n' * 1000
+            with open(os.path.join(src, 'unit', 'file.log'), 'w') as flh:
+                flh.write(text)
+            data = {'file.log': [len(text), hashlib.md5(text).hexdigest()]}
+            theArgs = {'stgdir': stg, 'compression': 'coadd=none,gzip:9'}
+            test = dt.DES_tarball(theArgs, ['unit'], data, myMock, src, file_class='photoz', check_members=True)
+            self.assertEqual(test.get_tar_name(), 'unit.tar.gz')
+            self.assertEqual(test.compression, 'gzip')
+            tarpath = os.path.join(stg, test.get_tar_name())
+            self.assertEqual(test.get_filesize(), os.path.getsize(tarpath))
+            self.assertTrue(test.get_filesize() < len(text))
+            self.assertEqual(test.get_md5sum(), bu.generate_md5sum(tarpath))
+            with open(tarpath, 'rb') as flh:
+                tar = tarfile.open(fileobj=bu.DecompressingReader(flh, 'gzip'), mode='r|')
+                self.assertEqual([m.name for m in tar], ['unit', 'unit/file.log'])
+
+            # no compression for the excluded class, or for already compressed data
+            test = dt.DES_tarball(theArgs, ['unit'], data, myMock, src, file_class='coadd')
+            self.assertEqual(test.get_tar_name(), 'unit.tar')
+            test = dt.DES_tarball(theArgs, ['unit'], {'file.fits.fz': [100, MD5TESTSUM]}, myMock, src, file_class='photoz')
+            self.assertIsNone(test.compression)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(src)
+            shutil.rmtree(stg)
+
+    def test_DES_tarball_dedup(self):
+        myMock = MockUtil()
+        cwd = os.getcwd()
+        src = tempfile.mkdtemp()
+        stg = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(src, 'unit'))
+            data = {}
+            for fname, text in {'file.1': 'the first file', 'file.2': 'the second file'}.iteritems():
+                with open(os.path.join(src, 'unit', fname), 'w') as flh:
+                    flh.write(text)
+                data[fname] = [len(text), hashlib.md5(text).hexdigest()]
+            data['file.2'].append(('old.tar', 'old/file.2'))
+            test = dt.DES_tarball({'stgdir': stg, 'dedup': True}, ['unit'], data, myMock, src, check_members=True)
+            self.assertEqual(test.contents, [('unit/file.1', 14, data['file.1'][1])])
+            self.assertEqual(test.references, [('unit/file.2', 'old.tar', 'old/file.2')])
+            tar = tarfile.open(os.path.join(stg, test.get_tar_name()))
+            member = tar.getmember('unit/file.2')
+            self.assertTrue(member.issym())
+            self.assertEqual(bu.parse_reference(member.linkname), ('old.tar', 'old/file.2'))
+            self.assertEqual(tar.extractfile('unit/file.1').read(), 'the first file')
+            tar.close()
+
+            # a file which does not match the one it refers to is an error
+            data['file.2'][1] = MD5TESTSUM
+            with self.assertRaises(bu.ChecksumError):
+                dt.DES_tarball({'stgdir': stg, 'dedup': True}, ['unit'], data, myMock, src, check_members=True)
+
+            # without dedup the file is archived
+            test = dt.DES_tarball({'stgdir': stg}, ['unit'], data, myMock, src)
+            self.assertEqual(test.references, [])
+            self.assertEqual(len(test.contents), 2)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(src)
+            shutil.rmtree(stg)
 
 class TestDES_archive(unittest.TestCase):
 
@@ -688,13 +1254,22 @@ class TestDES_archive(unittest.TestCase):
     @patch('archivetools.DES_archive.DES_tarball')
     def test_DES_archive_init(self, osMock, tarMock):
         myMock = MockUtil()
+        xfer = tempfile.mkdtemp()
         theArgs = {'stgdir': '.',
-                   'xferdir': '.'}
+                   'xferdir': xfer}
 
         myMock.setReturn([(('tar1.tar', 0, MD5TESTSUM),
                            ('tar1.tar', 0, MD5TESTSUM + 'a'))])
-        with patch('archivetools.DES_archive.DES_tarball.tar_size', return_value=101010) as ts:
-            test = da.DES_archive(theArgs, myMock, bu.CLASSES[3], 2)
+        # the DES_tarball mock
+        osMock.return_value.configure_mock(tarfile='tar1.tar', tar_size=101010, md5sum=MD5TESTSUM, file_class=bu.CLASSES[3],
+                                           compression=None, contents=[], references=[])
+        osMock.return_value.get_index.return_value = {}
+        try:
+            with patch('archivetools.DES_archive.DES_tarball.tar_size', return_value=101010) as ts:
+                test = da.DES_archive(theArgs, myMock, bu.CLASSES[3], 2)
+                self.assertEqual(len(test.pending), 2)
+        finally:
+            shutil.rmtree(xfer)
 
     @patch('archivetools.DES_archive.os')
     @patch('archivetools.DES_archive.DES_tarball')
@@ -707,8 +1282,11 @@ class TestDES_archive(unittest.TestCase):
                            ('tar1.tar', 456789, MD5TESTSUM + 'a'))])
         with patch('archivetools.DES_archive.DES_tarball.tar_size', return_value=101010) as ts:
             test = da.DES_archive(theArgs, myMock, bu.CLASSES[3], 2)
-            test.generate()
-            test.generate()
+            osMock.return_value.get_index.return_value = {}
+            with patch.object(da.DES_archive, 'write_index') as wi:
+                test.generate()
+                test.generate()
+                self.assertEqual(wi.call_count, 2)
 
 
     @patch('archivetools.DES_archive.os')
@@ -728,20 +1306,188 @@ class TestDES_archive(unittest.TestCase):
     @patch('archivetools.DES_archive.DES_tarball')
     def test_DES_archive_update_db_unit(self, osMock, tarMock):
         myMock = MockUtil()
+        xfer = tempfile.mkdtemp()
         theArgs = {'stgdir': '.',
-                   'xferdir': '.'}
+                   'xferdir': xfer}
 
         myMock.setReturn([(('tar1.tar', 12345, MD5TESTSUM),
                            ('tar1.tar', 456789, MD5TESTSUM + 'a'))])
-        with patch('archivetools.DES_archive.DES_tarball.tar_size', return_value=101010) as ts:
-            with patch('archivetools.DES_archive.DES_tarball') as tball:
-                instance = tball.return_value
-                instance.tarfile = 'myTar.tar'
-                instance.tar_size = 12345
-                instance.md5sum = MD5TESTSUM
-                instance.file_class = bu.CLASSES[3]
+        try:
+            with patch('archivetools.DES_archive.DES_tarball.tar_size', return_value=101010) as ts:
+                with patch('archivetools.DES_archive.DES_tarball') as tball:
+                    instance = tball.return_value
+                    instance.tarfile = 'myTar.tar'
+                    instance.tar_size = 12345
+                    instance.md5sum = MD5TESTSUM
+                    instance.file_class = bu.CLASSES[3]
+                    instance.compression = None
+                    instance.get_index.return_value = {'myTar/a': (0, 512, 10)}
+                    instance.contents = [('myTar/a', 10, MD5TESTSUM)]
+                    instance.references = []
+                    test = da.DES_archive(theArgs, myMock, bu.CLASSES[3], 2)
+                    test.update_db_unit(instance, '/the/dir')
+                    # the update is held back, and logged
+                    self.assertEqual(myMock.getCount('commit'), 0)
+                    self.assertEqual(len(test.pending), 1)
+                    self.assertEqual(test.pending_log.load(), test.pending)
+                    test.flush_db_units()
+                    # the index, contents, directory, unit, and summary
+                    self.assertEqual(myMock.getCount('executemany'), 5)
+                    self.assertEqual(test.pending, [])
+                    self.assertFalse(os.path.exists(test.pending_log.filename))
+        finally:
+            shutil.rmtree(xfer)
+
+    def test_DES_archive_flush_db_units(self):
+        xfer = tempfile.mkdtemp()
+        try:
+            util = ldb.LocalUtil(':memory:', ltype='TEST')
+            cur = util.cursor()
+            cur.execute("insert into BACKUP_DIR (PATH,STATUS,CLASS) values ('dir0',0,'%s')" % (bu.CLASSES[3]))
+            cur.execute("insert into BACKUP_DIR (PATH,STATUS,CLASS) values ('dir1',0,'%s')" % (bu.CLASSES[3]))
+            bu.rebuild_summary(cur)
+            theArgs = {'stgdir': xfer, 'xferdir': xfer}
+            test = da.DES_archive(theArgs, util, bu.CLASSES[3], 2)
+            for i in range(2):
+                mytar = MagicMock(tarfile='dir%i.tar' % i, tar_size=100, md5sum=MD5TESTSUM, file_class=bu.CLASSES[3],
+                                  compression=None, contents=[('dir%i/a' % i, 10, MD5TESTSUM)], references=[])
+                mytar.get_index.return_value = {'dir%i/a' % i: (0, 512, 10)}
+                test.update_db_unit(mytar, 'dir%i' % i)
+            # a run which stopped after committing some of its updates is replayed without
+            # repeating them
+            test.pending = test.pending[:1]
+            test.flush_db_units(commit=False)
+            cur.execute('commit')
+            test2 = da.DES_archive(theArgs, util, bu.CLASSES[3], 2)
+            self.assertEqual(test2.pending, [])
+            self.assertEqual([tb.get_tar_name() for tb in test2.dir_list], ['dir0.tar', 'dir1.tar'])
+            for table in ('BACKUP_UNIT', 'BACKUP_UNIT_INDEX', 'BACKUP_CONTENT'):
+                cur.execute("select count(*) from %s" % (table))
+                self.assertEqual(cur.fetchall(), [(2,)])
+            cur.execute("select count(*) from BACKUP_DIR where STATUS=1")
+            self.assertEqual(cur.fetchall(), [(2,)])
+            self.assertFalse(os.path.exists(test.pending_log.filename))
+            # the summary was kept up to date, counting the replayed updates once
+            summary = dict([(key, (val['num'], val['size'])) for key, val in bu.get_summary(cur).iteritems() if val['num']])
+            self.assertEqual(summary, {('DIR', bu.CLASSES[3], 1): (2, 0),
+                                       ('UNIT', bu.CLASSES[3], 2): (2, 200)})
+            bu.rebuild_summary(cur)
+            self.assertEqual(dict([(key, (val['num'], val['size'])) for key, val in bu.get_summary(cur).iteritems()]), summary)
+            util.close()
+        finally:
+            shutil.rmtree(xfer)
+
+    def test_estimate_tar_size(self):
+        self.assertEqual(da.estimate_tar_size({}), 10240)
+        self.assertEqual(da.estimate_tar_size({'a': [100, MD5TESTSUM], 'b': [None, MD5TESTSUM]}), 10240 + 2048 + 100)
+
+    def test_DES_archive_make_directory_tars_parallel(self):
+        myMock = MockUtil()
+        myMock.reqfree = 0
+        myMock.getfreespace = MagicMock(return_value=10**12)
+        myMock.pingvals = [True] * 4
+        src = tempfile.mkdtemp()
+        stg = tempfile.mkdtemp()
+        try:
+            jobs = []
+            for i in range(4):
+                os.mkdir(os.path.join(src, 'dir%i' % i))
+                text = 'file number %i' % i
+                with open(os.path.join(src, 'dir%i' % i, 'file.dat'), 'w') as flh:
+                    flh.write(text)
+                jobs.append(('dir%i' % i, {'file.dat': [len(text), hashlib.md5(text).hexdigest()]}, src))
+            # make one of the directories fail its md5sum check
+            jobs[2][1]['file.dat'][1] = MD5TESTSUM
+            with patch.object(da.DES_archive, 'restore'):
+                test = da.DES_archive({'stgdir': stg, 'xferdir': stg, 'verify': True}, myMock, bu.CLASSES[3], 2)
+            done = test.make_directory_tars_parallel(jobs, 2)
+            self.assertEqual(done, ['dir0', 'dir1', 'dir3'])
+            self.assertEqual([tb.get_tar_name() for tb in test.dir_list], ['dir0.tar', 'dir1.tar', 'dir3.tar'])
+            for tb in test.dir_list:
+                self.assertEqual(tb.get_md5sum(), bu.generate_md5sum(os.path.join(stg, tb.get_tar_name())))
+            self.assertEqual(test.archive_size, sum([tb.tar_size for tb in test.dir_list]))
+        finally:
+            shutil.rmtree(src)
+            shutil.rmtree(stg)
+
+    def test_DES_archive_stream(self):
+        myMock = MockUtil()
+        myMock.pingvals = [True] * 4
+        src = tempfile.mkdtemp()
+        stg = tempfile.mkdtemp()
+        xfer = tempfile.mkdtemp()
+        theArgs = {'stgdir': stg, 'xferdir': xfer, 'verify': True, 'stream': True}
+        try:
+            jobs = []
+            for i in range(3):
+                os.mkdir(os.path.join(src, 'dir%i' % i))
+                text = 'file number %i' % i * (i + 1) * 100
+                with open(os.path.join(src, 'dir%i' % i, 'file.dat'), 'w') as flh:
+                    flh.write(text)
+                jobs.append(('dir%i' % i, {'file.dat': [len(text), hashlib.md5(text).hexdigest()]}, src))
+            jobs[1][1]['file.dat'][1] = MD5TESTSUM
+            with patch.object(da.DES_archive, 'restore'):
                 test = da.DES_archive(theArgs, myMock, bu.CLASSES[3], 2)
-                test.update_db_unit(instance, '/the/dir')
+            test.make_directory_tar(*jobs[0])
+            with self.assertRaises(bu.ChecksumError):
+                test.make_directory_tar(*jobs[1])
+            test.make_directory_tar(*jobs[2])
+            # nothing but the tape tar is written to the staging directory
+            self.assertEqual(os.listdir(stg), [test.archive_base])
+            test.park()
+            tape = test.archive_name
+            tar = tarfile.open(tape)
+            self.assertEqual(tar.getnames(), ['dir0.tar', 'dir2.tar'])
+            for tb in test.dir_list:
+                member = tar.getmember(tb.get_tar_name())
+                self.assertEqual(member.size, tb.tar_size)
+                self.assertEqual(bu.md5sum_fileobj(tar.extractfile(member)), tb.get_md5sum())
+                unit = tarfile.open(fileobj=tar.extractfile(member))
+                self.assertEqual(unit.getnames(), [tb.get_tar_name()[:-4], tb.get_tar_name()[:-4] + '/file.dat'])
+            tar.close()
+
+            # simulate a unit tar which was not completely written, and one on the staging directory
+            with open(tape, 'ab') as flh:
+                flh.write('x' * 700)
+            with open(os.path.join(stg, 'staged.tar'), 'w') as flh:
+                flh.write('y' * 10240)
+            units = [(tb.get_tar_name(), tb.tar_size, tb.get_md5sum(), test.archive_base) for tb in test.dir_list]
+            units.append(('dir1.tar', 10240, MD5TESTSUM, test.archive_base))
+            myMock.setReturn([(('staged.tar', 10240, hashlib.md5('y' * 10240).hexdigest()),),
+                              tuple(units)])
+            test2 = da.DES_archive(theArgs, myMock, bu.CLASSES[3], 2)
+            self.assertEqual(test2.archive_name, tape)
+            self.assertEqual([tb.get_tar_name() for tb in test2.dir_list], ['staged.tar', 'dir0.tar', 'dir2.tar'])
+            self.assertEqual(test2.archive_size, 10240 + units[0][1] + units[1][1])
+            cwd = os.getcwd()
+            try:
+                with patch.object(da.DES_archive, 'update_db_tape'):
+                    test2.generate()
+            finally:
+                os.chdir(cwd)
+            self.assertEqual(os.listdir(stg), [])
+            final = os.path.join(xfer, test.archive_base)
+            self.assertEqual(test2.archive_md5, bu.generate_md5sum(final))
+            tar = tarfile.open(final)
+            self.assertEqual(tar.getnames(), ['dir0.tar', 'dir2.tar', 'staged.tar'])
+            tar.close()
+            # read a file straight from the tape tar using the index
+            index = bu.read_index(final + '.index')
+            self.assertEqual(sorted(index.keys()), ['dir0.tar', 'dir2.tar', 'staged.tar'])
+            self.assertEqual(index['staged.tar']['size'], 10240)
+            with open(final, 'rb') as flh:
+                unit = index['dir2.tar']
+                unit_tar = tarfile.open(fileobj=bu.FileSection(flh, unit['data_offset'], unit['size']), mode='r:')
+                # the member index of the resumed unit tars is in the database
+                members = test.dir_list[1].get_index()
+                tarinfo = bu.read_member(unit_tar, members['dir2/file.dat'][0])
+                self.assertEqual(tarinfo.name, 'dir2/file.dat')
+                self.assertEqual(tarinfo.offset_data, members['dir2/file.dat'][1])
+                self.assertEqual(unit_tar.extractfile(tarinfo).read(), 'file number 2' * 300)
+        finally:
+            shutil.rmtree(src)
+            shutil.rmtree(stg)
+            shutil.rmtree(xfer)
 
     @patch('archivetools.DES_archive.os')
     @patch('archivetools.DES_archive.DES_tarball')
@@ -774,6 +1520,219 @@ class TestDES_archive(unittest.TestCase):
                     if 'file_class' in line:
                         self.assertTrue(bu.CLASSES[3] in line)
 
+class TestBackupPlan(unittest.TestCase):
+
+    def test_get_candidates(self):
+        myMock = MockUtil()
+        myMock.setReturn([(('path/a', 'coadd', 1, 10, 1000),
+                           ('path/b', 'coadd', 2, 1, None),
+                           ('path/c', 'sne', 1, 2, 500))])
+        cands = bp.get_candidates(myMock.cursor(), 5)
+        self.assertEqual(sorted(cands.keys()), ['coadd', 'sne'])
+        self.assertEqual(cands['coadd'], [('path/a', bp.TAR_OVERHEAD + 10 * bp.FILE_OVERHEAD + 1000, 1),
+                                          ('path/b', bp.TAR_OVERHEAD + bp.FILE_OVERHEAD, 2)])
+        myMock.setReturn([((12345,),)])
+        self.assertEqual(bp.get_staged_size(myMock.cursor(), 'coadd'), 12345)
+        myMock.setReturn([((None,),)])
+        self.assertEqual(bp.get_staged_size(myMock.cursor(), 'coadd'), 0)
+
+    def test_get_candidates_catalog(self):
+        util = ldb.LocalUtil(':memory:', ltype='TEST')
+        cur = util.cursor()
+        for path in ('OPS/r1_p01', 'OPS/r2_p01', 'OPS/r3_p01'):
+            bu.execute(cur, "insert into BACKUP_DIR (PATH,CLASS,STATUS,PRIORITY,RELEASE_DATE) values (:1,'finalcut',0,1,TO_DATE('20190101', 'YYYYMMDD'))", [path])
+        files = [(1, 'a.fits', 'OPS/r1_p01/red/immask', 100), (2, 'b.fits', 'OPS/r1_p01', 50), (3, 'c.fits', 'OPS/r2_p010', 70), (4, 'd.fits', 'OPS/r2xp01/log', 90)]
+        for fid, fname, path, size in files:
+            bu.execute(cur, "insert into DESFILE (ID,FILENAME,FILESIZE) values (:1,:2,:3)", [fid, fname, size])
+            bu.execute(cur, "insert into FILE_ARCHIVE_INFO (FILENAME,ARCHIVE_NAME,PATH,DESFILE_ID) values (:1,'desar2home',:2,:3)", [fname, path, fid])
+        # the files in subdirectories are counted, a directory without any is still planned,
+        # and the files of other directories are not counted
+        cands = bp.get_candidates(cur, 5)
+        self.assertEqual(sorted(cands['finalcut']), [('OPS/r1_p01', bp.TAR_OVERHEAD + 2 * bp.FILE_OVERHEAD + 150, 1),
+                                                     ('OPS/r2_p01', bp.TAR_OVERHEAD, 1),
+                                                     ('OPS/r3_p01', bp.TAR_OVERHEAD, 1)])
+        util.close()
+
+    def test_plan_tapes(self):
+        dirs = [('a', 60, 2), ('b', 45, 1), ('c', 40, 3), ('d', 30, 3), ('e', 25, 3), ('f', 150, 1)]
+        tapes = bp.plan_tapes(dirs, 100, 0.05, 20)
+        # every directory is in exactly one tape tar
+        self.assertEqual(sorted(sum([t['paths'] for t in tapes], [])), ['a', 'b', 'c', 'd', 'e', 'f'])
+        self.assertEqual(tapes[0]['staged'], 20)
+        for tape in tapes:
+            self.assertEqual(tape['complete'], tape['size'] >= 95)
+            if len(tape['paths']) > 1:
+                self.assertTrue(tape['size'] <= 105)
+        # the staged data and the largest directory fill the first tape tar, the oversized
+        # directory gets its own, and the rest are left partial
+        self.assertEqual([t['size'] for t in tapes], [105, 150, 85, 30])
+        self.assertEqual([t['complete'] for t in tapes], [True, True, False, False])
+        self.assertEqual(tapes[0]['paths'], ['a', 'e'])
+        self.assertEqual(tapes[0]['priority'], 2)
+        self.assertEqual(tapes[2]['priority'], 1)
+        report = bp.format_plan('coadd', tapes, 100, 0.05)
+        self.assertTrue('4 tape tars planned' in report)
+        self.assertEqual(bp.plan_tapes([], 100), [])
+
+class TestLocalDb(unittest.TestCase):
+
+    def test_translate(self):
+        sql, binds = ldb.translate("update PROD.BACKUP_TAPE set STATUS=:2 where NAME=:1 and CREATED_DATE > TO_DATE('2019-01-01 10:11:12', 'YYYY-MM-DD HH24:MI:SS')")
+        self.assertEqual(sql, "update BACKUP_TAPE set STATUS=?2 where NAME=?1 and CREATED_DATE > TO_DATE('2019-01-01 10:11:12', 'YYYY-MM-DD HH24:MI:SS')")
+        self.assertEqual(binds, 2)
+        self.assertEqual(ldb.to_date('20190102', 'YYYYMMDD'), '2019-01-02 00:00:00')
+        self.assertIsNone(ldb.translate_merge("select 1 from dual"))
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            util = ldb.LocalUtil(os.path.join(tmpdir, 'test.db'))
+            cur = util.cursor()
+            cur.prepare("merge into BACKUP_UNIT bu using dual on (bu.name=:1) when matched then update set tape_tar=:2,status=1 when not matched then insert (NAME,TAPE_TAR,STATUS,TAR_SIZE) values (:3,:4,1,:5)")
+            cur.executemany(None, [('unit1', 'tape1', 'unit1', 'tape1', 10)])
+            cur.execute("insert into BACKUP_UNIT (NAME,STATUS) values ('unit2',2)")
+            cur.executemany(None, [('unit2', 'tape1', 'unit2', 'tape1', 20)])
+            cur.execute('commit')
+            cur.execute("select NAME,TAPE_TAR,STATUS,TAR_SIZE from BACKUP_UNIT order by NAME")
+            self.assertEqual(cur.fetchall(), [('unit1', 'tape1', 1, 10), ('unit2', 'tape1', 1, None)])
+            util.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_synthetic(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            root = os.path.join(tmpdir, 'archive')
+            dirs = syn.make_tree(root, 'raw', 2, scale=1e-5)
+            self.assertEqual(len(dirs), 2)
+            util = ldb.LocalUtil(os.path.join(tmpdir, 'test.db'))
+            syn.load_catalog(util, root, dirs)
+            util = ldb.LocalUtil(os.path.join(tmpdir, 'test.db'))
+            self.assertEqual(util.root, root)
+            cur = util.cursor()
+            cur.execute("select PATH,CLASS,STATUS from BACKUP_DIR where RELEASE_DATE <= TO_DATE('%s', 'YYYY-MM-DD HH24:MI:SS') order by PATH" % (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+            self.assertEqual(cur.fetchall(), [(d['path'], 'raw', 0) for d in dirs])
+            # the catalog matches the files
+            fpath, fname, size, md5, compression = dirs[0]['files'][0]
+            self.assertEqual(compression, '.fz')
+            self.assertEqual(bu.generate_md5sum(os.path.join(root, fpath, fname + compression)), md5)
+            cur.execute("select t1.filename,t1.filesize,t1.md5sum from desfile t1, file_archive_info t2 where t1.filename = t2.filename and t2.path='%s'" % (dirs[0]['path']))
+            self.assertEqual(len(cur.fetchall()), len(dirs[0]['files']))
+            util.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_dialect(self):
+        sql, binds = ldb.translate("select NAME from BACKUP_TAPE where CREATED_DATE<add_months(SYSDATE, :1) or TRANSFER_DATE>systimestamp")
+        self.assertEqual(sql, "select NAME from BACKUP_TAPE where CREATED_DATE<add_months(%s, ?1) or TRANSFER_DATE>%s" % (ldb.NOW, ldb.NOW))
+        self.assertEqual(ldb.add_months('2019-03-31 10:00:00', -1), '2019-02-28 10:00:00')
+        self.assertEqual(ldb.add_months('2019-11-15 00:00:00', 14), '2021-01-15 00:00:00')
+
+        util = bu.get_util('sqlite::memory:', None, ltype='TEST')
+        self.assertTrue(isinstance(util, ldb.LocalUtil))
+        cur = util.cursor()
+        cur.execute("insert into BACKUP_TAPE (NAME,CREATED_DATE) values ('old',TO_DATE('20180101', 'YYYYMMDD'))")
+        cur.execute("insert into BACKUP_TAPE (NAME,CREATED_DATE) values ('new',SYSTIMESTAMP)")
+        cur.execute("select NAME,CREATED_DATE from BACKUP_TAPE where CREATED_DATE<add_months(SYSDATE, :1)", [-6])
+        # dates are returned as datetimes, as from Oracle
+        self.assertEqual(cur.fetchall(), [('old', datetime.datetime(2018, 1, 1))])
+
+        cur.execute("insert into DESFILE (ID,FILENAME,COMPRESSION) values (1,'a.fits','.fz')")
+        cur.execute("insert into DESFILE (ID,FILENAME,COMPRESSION) values (2,'b.fits',null)")
+        gtt = util.load_gtt_filename([{'filename': 'a.fits', 'compression': '.fz'}, {'filename': 'c.fits', 'compression': None}])
+        cur.execute("select df.ID from DESFILE df, %s gtt where gtt.FILENAME=df.FILENAME" % (gtt))
+        self.assertEqual(cur.fetchall(), [(1,)])
+        gtt = util.load_id_gtt([2, 3])
+        cur.execute("select df.FILENAME from DESFILE df, %s gtt where gtt.ID=df.ID" % (gtt))
+        self.assertEqual(cur.fetchall(), [('b.fits',)])
+        util.close()
+
+    def test_make_catalog(self):
+        util = ldb.LocalUtil(':memory:', ltype='TEST')
+        self.assertEqual(syn.make_catalog(util, 5, 10, batch=12), 50)
+        cur = util.cursor()
+        cur.execute("select count(*),count(distinct PFW_ATTEMPT_ID) from DESFILE")
+        self.assertEqual(cur.fetchall(), [(50, 5)])
+        # more attempts are numbered after those already made
+        syn.make_catalog(util, 2, 3)
+        cur.execute("select min(ID),max(ID) from PFW_ATTEMPT")
+        self.assertEqual(cur.fetchall(), [(1, 7)])
+        # the finished attempts are found by archive_setup
+        dirlist = []
+        with capture_output():
+            aset.add_dirs(cur, util, dirlist)
+        self.assertEqual(len(dirlist), 7)
+        self.assertTrue(all([d[2] < datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') for d in dirlist]))
+        util.close()
+
+    def test_locate(self):
+        util = ldb.LocalUtil(':memory:', ltype='TEST')
+        cur = util.cursor()
+        cur.execute("insert into BACKUP_DIR (PATH,STATUS,UNIT_NAME) values ('OPS/a/r1',1,'unit1')")
+        cur.execute("insert into BACKUP_DIR (PATH,STATUS,UNIT_NAME) values ('OPS/a/r1/p01',1,'unit2')")
+        cur.execute("insert into BACKUP_UNIT (NAME,CREATED_DATE,TAPE_TAR) values ('unit1','2019-01-01 00:00:00','tape1')")
+        cur.execute("insert into BACKUP_UNIT (NAME,CREATED_DATE,TAPE_TAR) values ('unit2','2019-01-02 00:00:00','tape2')")
+        cur.execute("insert into BACKUP_TAPE (NAME,CREATED_DATE,TRANSFER_DATE) values ('tape1','2019-01-03 00:00:00','2019-01-04 00:00:00')")
+        bu.reset_statement_stats()
+        with capture_output():
+            # the deepest archived directory is found
+            data = bu.locate(util, rootpath='OPS/a/r1/p01/red/file.fits')
+            self.assertEqual((data['unit'], data['unitdate'], data['tape']), ('unit2', datetime.datetime(2019, 1, 2), None))
+            data = bu.locate(util, rootpath='OPS/a/r1/p02')
+            self.assertEqual((data['unit'], data['tape'], data['tapedate'], data['transdate']),
+                             ('unit1', 'tape1', datetime.datetime(2019, 1, 3), datetime.datetime(2019, 1, 4)))
+            data = bu.locate(util, rootpath='OPS/b')
+            self.assertIsNone(data['unit'])
+        # in one statement
+        self.assertEqual(bu.get_statement_stats()['executes'], 3)
+        self.assertEqual(bu.get_statement_stats()['parses'], 1)
+        util.close()
+
+    def test_get_file_data(self):
+        util = ldb.LocalUtil(':memory:', ltype='TEST')
+        cur = util.cursor()
+        files = [(1, 'a.fits', 'OPS/r1_p01', '.fz'), (2, 'b.fits', 'OPS/r1_p01/red/immask', None), (3, 'c.fits', 'OPS/r1xp01/red', None),
+                 (4, 'd.fits', 'OPS/r1_p010', None)]
+        for fid, fname, path, compression in files:
+            bu.execute(cur, "insert into DESFILE (ID,FILENAME,FILESIZE,MD5SUM,COMPRESSION) values (:1,:2,:3,:4,:5)", [fid, fname, fid * 10, 'md5%i' % fid, compression])
+            bu.execute(cur, "insert into FILE_ARCHIVE_INFO (FILENAME,ARCHIVE_NAME,PATH,COMPRESSION,DESFILE_ID) values (:1,'desar2home',:2,:3,:4)", [fname, path, compression, fid])
+        # the files in subdirectories are included, but not those of other directories
+        self.assertEqual(rb.get_file_data(cur, 'OPS/r1_p01'), {'a.fits.fz': [10, 'md51'], 'b.fits': [20, 'md52']})
+        util.close()
+
+    def test_archive_files(self):
+        cwd = os.getcwd()
+        for stream in ([], ['--stream']):
+            tmpdir = tempfile.mkdtemp()
+            try:
+                root = os.path.join(tmpdir, 'archive')
+                for ddir in ('staging', 'transfer'):
+                    os.makedirs(os.path.join(tmpdir, ddir))
+                dirs = syn.make_tree(root, 'finalcut', 3, scale=1e-5)
+                util = ldb.LocalUtil(os.path.join(tmpdir, 'test.db'), ltype='TEST')
+                syn.load_catalog(util, root, dirs)
+                argv = sys.argv
+                sys.argv = ['run_backup', '--stgdir', os.path.join(tmpdir, 'staging'), '--xferdir', os.path.join(tmpdir, 'transfer'),
+                            '--free', '0b'] + stream
+                try:
+                    args = rb.parse_options()
+                finally:
+                    sys.argv = argv
+                with capture_output():
+                    rb.archive_files(util, args)
+                # each directory is tarred once
+                cur = util.cursor()
+                cur.execute("select count(*),count(distinct NAME) from BACKUP_UNIT")
+                self.assertEqual(cur.fetchall(), [(3, 3)])
+                cur.execute("select count(*) from BACKUP_DIR where STATUS=1")
+                self.assertEqual(cur.fetchall(), [(3,)])
+                summary = bu.get_summary(cur)
+                self.assertEqual(summary[('DIR', 'finalcut', 0)]['num'], 0)
+                self.assertEqual(summary[('DIR', 'finalcut', 1)]['num'], 3)
+                util.close()
+            finally:
+                os.chdir(cwd)
+                shutil.rmtree(tmpdir)
+
 class TestArchiveSetup(unittest.TestCase):
     # no test of main()
     rootid = 1234567
@@ -897,8 +1856,9 @@ class TestArchiveSetup(unittest.TestCase):
         myMock.setReturn([(('20130101',),('20180619',),('20181125',))])
         mylist = []
 
-        count = aset.get_all_raw(myMock.cursor(), 'select nite from exposure', 'sne', mylist)
+        count, last = aset.get_all_raw(myMock.cursor(), 'select nite from exposure', 'sne', mylist)
         self.assertEqual(count, 2)
+        self.assertEqual(last, '20181125')
         self.assertTrue('DTS' in mylist[0][0])
 
     def test_add_dirs(self):
@@ -930,11 +1890,41 @@ class TestArchiveSetup(unittest.TestCase):
         self.assertEqual(mylist[2][3], 2)
         print mylist[-1]
 
+    def test_watermarks(self):
+        self.assertEqual(aset.scan_start('raw', '20190110', 7), '20190103')
+        self.assertEqual(aset.scan_start('pipeline', '2019-01-10 12:00:00', 1), '2019-01-09 12:00:00')
+        self.assertIsNone(aset.scan_start('pipeline', None, 7))
+
+        util = ldb.LocalUtil(':memory:', ltype='TEST')
+        cur = util.cursor()
+        syn.make_catalog(util, 4, 2)
+        marks = aset.get_watermarks(cur)
+        self.assertEqual(marks, {'pipeline': None, 'raw': None, 'snmanifest': None})
+        with capture_output():
+            dirlist = []
+            last = aset.add_dirs(cur, util, dirlist)
+            self.assertEqual(len(dirlist), 4)
+            cur.execute("select max(END_TIME) from TASK")
+            self.assertEqual(last, cur.fetchall()[0][0])
+            # nothing has ended since the last scan
+            self.assertIsNone(aset.add_dirs(cur, util, [], last))
+            cur.executemany("insert into EXPOSURE (FILENAME,NITE) values (:1,:2)", [('a', '20190101'), ('b', '20190105'), ('c', '20190105')])
+            dirlist = []
+            self.assertEqual(aset.get_raw(cur, util, dirlist, '20190103'), '20190105')
+            self.assertEqual([ddir[0] for ddir in dirlist], ['DTS/raw/20190105'])
+        aset.set_watermarks(cur, marks, {'pipeline': last, 'raw': '20190105', 'snmanifest': None})
+        marks = aset.get_watermarks(cur)
+        self.assertEqual(marks, {'pipeline': last, 'raw': '20190105', 'snmanifest': None})
+        # the marks are not moved backwards
+        aset.set_watermarks(cur, marks, {'pipeline': None, 'raw': '20190101', 'snmanifest': '20190102'})
+        self.assertEqual(aset.get_watermarks(cur), {'pipeline': last, 'raw': '20190105', 'snmanifest': '20190102'})
+        util.close()
+
     def test_junk_runs(self):
-        myMock = MockUtil()
-        myMock.setReturn = [(('/path/1', ) ,('/path/2', ))]
+        myMock = MockUtil(data=[[('/path/1', 'finalcut'), ('/path/2', 'finalcut')]])
         aset.junk_runs(myMock)
-        self.assertEqual(myMock.getCount('prepare'), 1)
+        # the delete, and the change to the summary
+        self.assertEqual(myMock.getCount('prepare'), 2)
 
     def test_parse_options(self):
         temp = copy.deepcopy(sys.argv)
@@ -1447,6 +2437,41 @@ class TestWhereis(unittest.TestCase):
 
         sys.argv = temp
 
+    @patch('where_is.Util')
+    def test_main_filelist(self, mockUtil):
+        temp = copy.deepcopy(sys.argv)
+        tmpdir = tempfile.mkdtemp()
+        unitdate = datetime.datetime(2018, 6, 15, 20, 0, 18)
+        tapedate = datetime.datetime(2018, 6, 16, 2, 55, 0)
+        transdate = datetime.datetime(2018, 6, 16, 3, 15, 25)
+        base = {'path': 'a/path', 'dir': 'a/path', 'unit': None, 'unitdate': None, 'tape': None, 'tapedate': None, 'transdate': None}
+        results = [dict(base, filename='one.fits', unit='unitA', unitdate=unitdate, tape='tapeA', tapedate=tapedate, transdate=transdate),
+                   dict(base, filename='two.fits', unit='unitA', unitdate=unitdate, tape='tapeA', tapedate=tapedate, transdate=transdate),
+                   dict(base, filename='three.fits', unit='unitB', unitdate=unitdate),
+                   dict(base, filename='four.fits'),
+                   dict(base, filename='five.fits', path=None, dir=None)]
+        try:
+            flist = os.path.join(tmpdir, 'files.list')
+            with open(flist, 'w') as flh:
+                flh.write("# files to find\none.fits\ntwo.fits\n\nthree.fits\nfour.fits\nfive.fits\n")
+            sys.argv = ['where_is.py', '--filelist=%s' % flist]
+            with patch('where_is.locate_files', return_value=results) as mockLocate:
+                with capture_output() as (out, err):
+                    wis.main()
+                    output = out.getvalue().strip()
+            self.assertEqual(mockLocate.call_args[0][1], ['one.fits', 'two.fits', 'three.fits', 'four.fits', 'five.fits'])
+            lines = output.split('\n')
+            self.assertTrue(lines[0].startswith('Tape Tar: tapeA'))
+            self.assertTrue(transdate.strftime("%Y-%m-%d") in lines[0])
+            self.assertTrue('unitA' in lines[1])
+            self.assertEqual(lines[2].strip(), 'one.fits')
+            self.assertTrue('not transferred' not in output)
+            self.assertTrue(output.index('unitB') < output.index('four.fits') < output.index('five.fits'))
+            self.assertTrue(lines[-1].startswith('5 files: 2 in 1 Tape Tars, 1 only in a Unit Tar, 1 not in a Unit Tar yet, 1 not found'))
+        finally:
+            shutil.rmtree(tmpdir)
+            sys.argv = temp
+
 
 if __name__ == '__main__':
     unittest.main()